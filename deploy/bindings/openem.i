@@ -42,6 +42,35 @@ namespace std {
   %template(VectorVectorClassification) vector<vector<openem::classify::Classification>>;
 };
 
+// Image data may be any C contiguous buffer of bytes, such as a uint8
+// numpy array, which is copied without first converting it to a list.
+// Other sequences are converted element by element as before.
+%typemap(in) const std::vector<uint8_t>& data (std::vector<uint8_t> temp) {
+  Py_buffer view;
+  if (PyObject_GetBuffer($input, &view,
+                         PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) == 0) {
+    if (view.itemsize == 1) {
+      const uint8_t* begin = static_cast<const uint8_t*>(view.buf);
+      temp.assign(begin, begin + view.len);
+      $1 = &temp;
+    }
+    PyBuffer_Release(&view);
+  } else {
+    PyErr_Clear();
+  }
+  if ($1 == NULL) {
+    std::vector<uint8_t>* ptr = NULL;
+    int res = swig::asptr($input, &ptr);
+    if (!SWIG_IsOK(res) || !ptr) {
+      SWIG_exception_fail(SWIG_ArgError(res),
+          "in method '$symname', argument $argnum of type '$type'");
+    }
+    temp = *ptr;
+    if (SWIG_IsNewObj(res)) delete ptr;
+    $1 = &temp;
+  }
+}
+
 %include "error_codes.h"
 %include "image.h"
 %include "video.h"
@@ -0,0 +1,66 @@
+""" Benchmarks of keyframe finding and classification csv loading """
+import csv
+import types
+import numpy as np
+import pytest
+
+import openem.Classify
+from openem.Count import KeyframeFinder, KEYFRAME_OFFSET
+
+from conftest import DETECT_SHAPE, sequence
+
+# Input of the count model, (batch, sequence length, features) with
+# two models of 8 species and 3 cover values
+INPUT_SHAPE = (None, 256, 34)
+
+@pytest.fixture(scope='module')
+def finder():
+    # The graph is only used to run the network, give the input shape
+    # directly instead of loading a model.
+    finder = KeyframeFinder.__new__(KeyframeFinder)
+    finder.input_tensor = types.SimpleNamespace(shape=INPUT_SHAPE)
+    finder.img_width = DETECT_SHAPE[1]
+    finder.img_height = DETECT_SHAPE[0]
+    return finder
+
+@pytest.mark.benchmark(group='count')
+def bench_generate_sequence(benchmark, rng, finder):
+    classifications, detections = sequence(rng, finder.sequenceSize())
+    input_data = benchmark(finder._generateSequence,
+                           classifications, detections)
+    assert input_data.shape == INPUT_SHAPE[1:]
+
+@pytest.mark.benchmark(group='count')
+def bench_find_keyframe_segments(benchmark, rng, finder):
+    length = finder.sequenceSize()
+    classifications, _ = sequence(rng, length, fill=1.0)
+    # Network output with a peak for each of a few fish on a noise floor
+    result = rng.uniform(0, 0.02, length)
+    for peak in rng.choice(np.arange(KEYFRAME_OFFSET, length), 6,
+                           replace=False):
+        result[peak] = rng.uniform(0.2, 0.6)
+    keyframes = benchmark(lambda: finder._findKeyframeSegments(
+        result.copy(), classifications))
+    assert len(keyframes) > 0
+
+@pytest.fixture(scope='module')
+def classify_csv(tmp_path_factory):
+    rng = np.random.RandomState(0)
+    path = tmp_path_factory.mktemp('classify') / 'classify.csv'
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['frame', 'video_id',
+                         *[f'species_{idx}' for idx in range(8)],
+                         'cover_0', 'cover_1', 'cover_2'])
+        for frame_num in range(20000):
+            if rng.uniform() < 0.3:
+                continue
+            writer.writerow([frame_num, 'video',
+                             *rng.dirichlet(np.ones(8)).round(5),
+                             *rng.dirichlet(np.ones(3)).round(5)])
+    return str(path)
+
+@pytest.mark.benchmark(group='io')
+def bench_classify_from_csv(benchmark, classify_csv):
+    classifications = benchmark(openem.Classify.IO.from_csv, classify_csv)
+    assert len(classifications) > 0
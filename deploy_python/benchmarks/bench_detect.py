@@ -0,0 +1,78 @@
+""" Benchmarks of detector post processing and detection csv loading """
+import csv
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import openem.Detect
+from openem.Detect.SSD import SSDDetector, decodeBoxes
+from openem.Detect.RetinaNet import RetinaNetDetector, RetinaNetPreprocessor
+
+from conftest import FedModel, DETECT_SHAPE, ssd_output, retinanet_output
+
+BATCH = 4
+
+class FedSSD(SSDDetector, FedModel):
+    pass
+
+class FedRetinaNet(RetinaNetDetector, FedModel):
+    def __init__(self, output, image_shape=DETECT_SHAPE):
+        FedModel.__init__(self, [None, *image_shape, 3], output)
+        self.image_shape = image_shape
+        self.network_aspect = image_shape[1] / image_shape[0]
+        self.preprocessor = RetinaNetPreprocessor()
+        self._imageSizes = None
+
+@pytest.mark.benchmark(group='detect')
+def bench_decode_boxes(benchmark, rng):
+    output = ssd_output(rng, 1)[0]
+    boxes = benchmark(decodeBoxes, output[:, :4], output[:, -8:-4],
+                      output[:, -4:], DETECT_SHAPE)
+    assert boxes.shape == (output.shape[0], 4)
+
+@pytest.mark.benchmark(group='detect')
+def bench_ssd_postprocess(benchmark, rng, frame):
+    tf.compat.v1.disable_eager_execution()
+    detector = FedSSD([None, *DETECT_SHAPE, 3], ssd_output(rng, BATCH))
+    detector.tf_session = tf.compat.v1.Session()
+    def run():
+        # Only the image sizes are needed by the post processing
+        detector._imageSizes = [frame.shape] * BATCH
+        detector.images = []
+        return detector.process()
+    # The NMS op is added to the graph on every call, so keep the number
+    # of rounds fixed.
+    result = benchmark.pedantic(run, rounds=20, warmup_rounds=1)
+    assert len(result) == BATCH
+
+@pytest.mark.benchmark(group='detect')
+def bench_retinanet_postprocess(benchmark, rng, frame):
+    detector = FedRetinaNet(retinanet_output(rng, BATCH))
+    def run():
+        detector._imageSizes = [frame.shape] * BATCH
+        detector.images = []
+        return detector.process(threshold=0.5, frame=0, video_id='video')
+    result = benchmark(run)
+    assert len(result) == BATCH
+
+@pytest.fixture(scope='module')
+def detect_csv(tmp_path_factory):
+    rng = np.random.RandomState(0)
+    path = tmp_path_factory.mktemp('detect') / 'detect.csv'
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['video_id', 'frame', 'x', 'y', 'w', 'h',
+                         'detection_conf', 'detection_species'])
+        for frame_num in range(20000):
+            if rng.uniform() < 0.3:
+                continue
+            for _ in range(rng.randint(1, 3)):
+                writer.writerow(['video', frame_num,
+                                 *rng.uniform(0, 500, 4).round(2),
+                                 round(rng.uniform(), 4), rng.randint(1, 8)])
+    return str(path)
+
+@pytest.mark.benchmark(group='io')
+def bench_detect_from_csv(benchmark, detect_csv):
+    detections = benchmark(openem.Detect.IO.from_csv, detect_csv)
+    assert len(detections) > 0
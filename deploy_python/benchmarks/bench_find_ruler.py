@@ -0,0 +1,36 @@
+""" Benchmarks of ruler finding and region of interest extraction """
+import numpy as np
+import pytest
+
+from openem.FindRuler import rulerEndpoints, findRoi, rectify, RoiSampler
+from openem.image import crop
+
+from conftest import DETECT_SHAPE, ruler_mask
+
+@pytest.mark.benchmark(group='find_ruler')
+def bench_ruler_endpoints(benchmark):
+    endpoints = benchmark(rulerEndpoints, ruler_mask())
+    assert endpoints.shape == (2, 2)
+
+@pytest.fixture(scope='module')
+def ruler(frame):
+    """ Endpoints and roi of the synthetic ruler, scaled to the frame """
+    mask = ruler_mask()
+    scale = frame.shape[1] / mask.shape[1]
+    endpoints = rulerEndpoints(mask) * scale
+    roi_mask = rectify(np.kron(mask, np.ones((2, 2), dtype=np.uint8)),
+                       endpoints)
+    return endpoints, findRoi(roi_mask, 100)
+
+@pytest.mark.benchmark(group='find_ruler')
+def bench_rectify_and_crop(benchmark, frame, ruler):
+    endpoints, roi = ruler
+    image = benchmark(lambda: crop(rectify(frame, endpoints), roi))
+    assert image.ndim == 3
+
+@pytest.mark.benchmark(group='find_ruler')
+def bench_roi_sampler(benchmark, frame, ruler):
+    endpoints, roi = ruler
+    sampler = RoiSampler(frame.shape[:2], endpoints, roi, DETECT_SHAPE)
+    image = benchmark(sampler, frame)
+    assert image.shape[:2] == DETECT_SHAPE
@@ -0,0 +1,37 @@
+""" Benchmarks of image preprocessing """
+import numpy as np
+import pytest
+
+from openem.image import resize_and_fill, force_aspect
+from openem.Detect.SSD import SSDDetector
+from openem.Detect.RetinaNet import RetinaNetPreprocessor
+from openem.Classify import Classifier
+from openem.FindRuler import RulerMaskFinder
+
+from conftest import DETECT_SHAPE
+
+@pytest.mark.benchmark(group='preprocess')
+@pytest.mark.parametrize('model', [SSDDetector, Classifier, RulerMaskFinder],
+                         ids=lambda model: model.__name__)
+def bench_preprocessor(benchmark, frame, model):
+    height, width = DETECT_SHAPE
+    image = benchmark(model.preprocessor, frame, width, height)
+    assert image.shape == (height, width, 3)
+
+@pytest.mark.benchmark(group='preprocess')
+def bench_retinanet_preprocessor(benchmark, frame):
+    height, width = DETECT_SHAPE
+    image = benchmark(RetinaNetPreprocessor(), frame, width, height)
+    assert image.shape == (height, width, 3)
+
+@pytest.mark.benchmark(group='image')
+def bench_resize_and_fill(benchmark, frame):
+    image, _ = benchmark(resize_and_fill, frame, DETECT_SHAPE)
+    assert image.shape[:2] == DETECT_SHAPE
+
+@pytest.mark.benchmark(group='image')
+def bench_force_aspect(benchmark, frame):
+    # A 4:3 crop padded to the 2:1 detector aspect
+    crop = np.ascontiguousarray(frame[:, :960])
+    image = benchmark(force_aspect, crop, 2.0)
+    assert image.shape[1] == 2 * image.shape[0]
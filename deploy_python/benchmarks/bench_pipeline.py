@@ -0,0 +1,47 @@
+""" End to end benchmarks of the deployment library on synthetic models """
+import pytest
+
+from pipeline import Pipeline, STAGES, write_video
+from synthetic_models import write_models
+
+# Ruler frames plus two detector batches
+NUM_FRAMES = 32
+ROUNDS = 3
+WARMUP_ROUNDS = 1
+
+@pytest.fixture(scope='module')
+def model_dir(tmp_path_factory):
+    model_dir = str(tmp_path_factory.mktemp('models'))
+    write_models(model_dir)
+    return model_dir
+
+@pytest.fixture(scope='module')
+def video(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('video') / 'video.avi')
+    write_video(path, NUM_FRAMES)
+    return path
+
+def _run(benchmark, pipeline, video):
+    result = benchmark.pedantic(pipeline.process, args=(video,),
+                                rounds=ROUNDS, warmup_rounds=WARMUP_ROUNDS)
+    # Stage timings include the warmup rounds. With --benchmark-disable the
+    # pipeline runs once and there are no stats.
+    if benchmark.disabled:
+        return result
+    num_frames = NUM_FRAMES * (ROUNDS + WARMUP_ROUNDS)
+    benchmark.extra_info['fps'] = num_frames / sum(pipeline.timings.values())
+    for stage in STAGES:
+        benchmark.extra_info[stage + '_ms_per_frame'] = \
+            1000 * pipeline.timings[stage] / num_frames
+    return result
+
+@pytest.mark.benchmark(group='pipeline')
+def bench_pipeline_ssd(benchmark, model_dir, video):
+    num_frames, keyframes = _run(benchmark, Pipeline(model_dir), video)
+    assert num_frames == NUM_FRAMES
+
+@pytest.mark.benchmark(group='pipeline')
+def bench_pipeline_retinanet(benchmark, model_dir, video):
+    pipeline = Pipeline(model_dir, retinanet=True)
+    num_frames, keyframes = _run(benchmark, pipeline, video)
+    assert num_frames == NUM_FRAMES
@@ -0,0 +1,126 @@
+""" Synthetic inputs shared by the deployment library benchmarks
+
+Nothing here needs a GPU, network access or model files. Models are
+replaced by FedModel, which returns a fixed network output from process
+so the pre and post processing of the real model classes is measured.
+"""
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import numpy as np
+import cv2
+import pytest
+
+from openem.models import ImageModel
+from openem.Detect import Detection
+from openem.Classify import Classification
+
+# Size of the video frames fed to the models
+FRAME_SHAPE = (720, 1280, 3)
+# (height, width) of the detector input
+DETECT_SHAPE = (360, 720)
+
+class FedModel(ImageModel):
+    """ ImageModel whose process returns a fixed network output instead
+        of running a graph. Mix in after a model class, e.g.
+        class FedSSD(SSDDetector, FedModel) """
+    def __init__(self, input_shape, output):
+        """ input_shape: list of (batch, height, width, channels)
+            output: array or list of arrays returned by process
+        """
+        self.input_shape = list(input_shape)
+        self.output = output
+        self.images = None
+
+    def process(self):
+        if self.images is None:
+            return None
+        self.images = None
+        # Post processing may work in place, so return a copy
+        if isinstance(self.output, list):
+            return [np.copy(out) for out in self.output]
+        return np.copy(self.output)
+
+@pytest.fixture
+def rng():
+    """ Random generator seeded for each benchmark, so inputs do not
+        depend on which benchmarks run """
+    return np.random.RandomState(0)
+
+@pytest.fixture(scope='session')
+def frame():
+    """ A smooth synthetic BGR video frame """
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 256, FRAME_SHAPE).astype(np.uint8)
+    return cv2.GaussianBlur(image, (0, 0), 3)
+
+def ssd_output(rng, batch, num_anchors=8000, num_classes=8, num_objects=5):
+    """ Returns SSD network output of loc, conf, anchors and variances.
+        Most anchors are confidently background, a few are objects. """
+    loc = rng.normal(0, 0.5, (batch, num_anchors, 4))
+    logits = rng.normal(0, 1, (batch, num_anchors, num_classes))
+    logits[:, :, 0] += 5.0
+    for image_idx in range(batch):
+        objects = rng.choice(num_anchors, num_objects, replace=False)
+        logits[image_idx, objects, 0] -= 10.0
+        logits[image_idx, objects, rng.randint(1, num_classes)] += 5.0
+    conf = np.exp(logits)
+    conf /= conf.sum(axis=2, keepdims=True)
+    centers = rng.uniform(0.05, 0.95, (num_anchors, 2))
+    sizes = rng.uniform(0.02, 0.3, (num_anchors, 2))
+    anchors = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=1)
+    anchors = np.broadcast_to(anchors, (batch, num_anchors, 4))
+    variances = np.broadcast_to([0.1, 0.1, 0.2, 0.2], (batch, num_anchors, 4))
+    return np.concatenate([loc, conf, anchors, variances],
+                          axis=2).astype(np.float32)
+
+def retinanet_output(rng, batch, max_detections=300, num_classes=7):
+    """ Returns RetinaNet nms output of x1, y1, x2, y2, label and class
+        scores for each detection, in detector input coordinates. """
+    height, width = DETECT_SHAPE
+    x0 = rng.uniform(-20, width, (batch, max_detections))
+    y0 = rng.uniform(-20, height, (batch, max_detections))
+    x1 = x0 + rng.uniform(10, 200, (batch, max_detections))
+    y1 = y0 + rng.uniform(10, 100, (batch, max_detections))
+    label = rng.randint(0, num_classes, (batch, max_detections))
+    scores = rng.uniform(0, 1, (batch, max_detections, num_classes))
+    return np.concatenate([np.stack([x0, y0, x1, y1, label], axis=2),
+                           scores], axis=2).astype(np.float32)
+
+def sequence(rng, num_frames, num_species=8, num_cover=3, fill=0.7):
+    """ Returns per frame lists of classifications and detections, with a
+        detection in a fraction of the frames """
+    classifications = []
+    detections = []
+    for frame_num in range(num_frames):
+        if rng.uniform() > fill:
+            classifications.append([])
+            detections.append([])
+            continue
+        species = rng.dirichlet(np.ones(num_species))
+        cover = rng.dirichlet(np.ones(num_cover))
+        classifications.append([Classification(species=species,
+                                               cover=cover,
+                                               frame=frame_num,
+                                               video_id='video')])
+        location = np.array([rng.uniform(0, 600), rng.uniform(0, 300),
+                             rng.uniform(20, 120), rng.uniform(10, 60)])
+        detections.append([Detection(location=location,
+                                     confidence=rng.uniform(),
+                                     species=rng.randint(1, num_species),
+                                     frame=frame_num,
+                                     video_id='video')])
+    return classifications, detections
+
+def ruler_mask(shape=DETECT_SHAPE, angle=12.0):
+    """ Returns an 8-bit mask of a ruler rotated by angle degrees """
+    mask = np.zeros(shape, dtype=np.uint8)
+    center = (shape[1] / 2, shape[0] / 2)
+    length = shape[1] * 0.7
+    dx = np.cos(np.radians(angle)) * length / 2
+    dy = np.sin(np.radians(angle)) * length / 2
+    cv2.line(mask,
+             (int(center[0] - dx), int(center[1] - dy)),
+             (int(center[0] + dx), int(center[1] + dy)),
+             255, thickness=12)
+    return mask
@@ -0,0 +1,264 @@
+""" End to end throughput of the deployment library
+
+Runs a video through every stage of the OpenEM pipeline: decode, find
+ruler, roi extraction, detect, classify and count, as done for the test
+videos by train/openem_train/test.py. Reports the frames per second of
+the whole pipeline and the time spent in each stage.
+
+By default the synthetic models of synthetic_models and a synthetic
+video are used, so neither trained models nor example data are needed.
+The timings then show the cost of the library around the networks;
+give --model-dir to time real models.
+"""
+import argparse
+import os
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from openem.FindRuler import RulerMaskFinder, rulerEndpoints, rectify
+from openem.FindRuler import findRoi, RoiSampler
+from openem.Detect.SSD import SSDDetector
+from openem.Detect.RetinaNet import RetinaNetDetector
+from openem.Classify import Classifier
+from openem.Count import KeyframeFinder
+from openem.image import get_det_image
+
+from synthetic_models import MODEL_FILES, write_models
+
+# Order in which the stages run and are reported
+STAGES = ['decode', 'find_ruler', 'roi', 'detect', 'classify', 'count']
+
+def write_video(path, num_frames, shape=(720, 1280), fps=30, seed=0):
+    """ Writes a synthetic video of a smooth random scene drifting across
+        the frame
+
+    path: Path of the video, the codec is picked from the extension
+    num_frames: Number of frames to write
+    shape: (height, width) of the frames
+    """
+    rng = np.random.RandomState(seed)
+    scene = rng.randint(0, 256, (shape[0], shape[1] * 2, 3)).astype(np.uint8)
+    scene = cv2.GaussianBlur(scene, (0, 0), 3)
+    fourcc = cv2.VideoWriter_fourcc(*('mp4v' if path.endswith('.mp4')
+                                      else 'MJPG'))
+    writer = cv2.VideoWriter(path, fourcc, fps, (shape[1], shape[0]))
+    if not writer.isOpened():
+        raise IOError("Failed to open video {}!".format(path))
+    for frame_num in range(num_frames):
+        offset = (frame_num * 4) % shape[1]
+        writer.write(np.ascontiguousarray(
+            scene[:, offset:offset + shape[1]]))
+    writer.release()
+
+class Pipeline:
+    """ Models of the deployment library and the time spent in each stage
+        of processing videos with them """
+    def __init__(self, model_dir, retinanet=False, batch_size=8,
+                 ruler_frames=16):
+        """ Load the models
+
+        model_dir: Directory with the models, laid out as
+                   synthetic_models.MODEL_FILES
+        retinanet: Whether to detect with RetinaNet instead of SSD
+        batch_size: Number of frames run through the detector at once
+        ruler_frames: Number of frames averaged to find the ruler
+        """
+        path = lambda name: os.path.join(model_dir, MODEL_FILES[name])
+        self.mask_finder = RulerMaskFinder(path('find_ruler'))
+        if retinanet:
+            self.detector = RetinaNetDetector(path('detect_retinanet'))
+        else:
+            self.detector = SSDDetector(path('detect'))
+        self.retinanet = retinanet
+        self.classifier = Classifier(path('classify'))
+        # The image size is set for each video from its roi
+        self.keyframe_finder = KeyframeFinder(path('count'), 1, 1)
+        self.batch_size = batch_size
+        self.ruler_frames = ruler_frames
+        self.timings = OrderedDict((stage, 0.0) for stage in STAGES)
+
+    @contextmanager
+    def _stage(self, stage):
+        """ Adds the time spent in the block to the stage """
+        start = time.perf_counter()
+        yield
+        self.timings[stage] += time.perf_counter() - start
+
+    def _read(self, reader):
+        """ Returns the next frame of the video or None at its end """
+        with self._stage('decode'):
+            ok, frame = reader.read()
+        return frame if ok else None
+
+    def _find_roi(self, frames):
+        """ Returns the ruler endpoints and roi from the mean mask of
+            frames """
+        with self._stage('find_ruler'):
+            height, width = frames[0].shape[:2]
+            mask_sum = np.zeros((height, width))
+            for start in range(0, len(frames), self.batch_size):
+                for frame in frames[start:start + self.batch_size]:
+                    self.mask_finder.addImage(frame)
+                for mask in self.mask_finder.process():
+                    mask_sum += cv2.resize(mask, (width, height))
+            mask = (mask_sum * (255.0 / mask_sum.max())).astype(np.uint8)
+            endpoints = rulerEndpoints(mask)
+            roi = findRoi(rectify(mask, endpoints), 0)
+        return endpoints, roi
+
+    def _detect_and_classify(self, rois, first_frame):
+        """ Returns detections and classifications of a batch of rois """
+        with self._stage('detect'):
+            for roi in rois:
+                self.detector.addImage(roi)
+            if self.retinanet:
+                detections = self.detector.process(threshold=0.5,
+                                                   frame=first_frame)
+            else:
+                detections = self.detector.process()
+        with self._stage('classify'):
+            # Classify the detections of the whole batch at once
+            counts = []
+            for roi, frame_detections in zip(rois, detections):
+                for detection in frame_detections:
+                    self.classifier.addImage(
+                        get_det_image(roi, detection.location))
+                counts.append(len(frame_detections))
+            scores = self.classifier.process() or []
+            classifications = []
+            for count in counts:
+                classifications.append(scores[:count])
+                scores = scores[count:]
+        return detections, classifications
+
+    def process(self, video_path):
+        """ Processes a video, adding to the timings of each stage
+
+        Returns the number of frames and the list of keyframes
+        """
+        reader = cv2.VideoCapture(video_path)
+        if not reader.isOpened():
+            raise IOError("Failed to open video {}!".format(video_path))
+
+        # The first frames are kept to be detected after finding the ruler
+        frames = []
+        while len(frames) < self.ruler_frames:
+            frame = self._read(reader)
+            if frame is None:
+                break
+            frames.append(frame)
+        if not frames:
+            raise IOError("No frames in video {}!".format(video_path))
+        endpoints, roi = self._find_roi(frames)
+        with self._stage('roi'):
+            sampler = RoiSampler(frames[0].shape, endpoints, roi)
+
+        detections = []
+        classifications = []
+        num_frames = 0
+        while True:
+            while len(frames) < self.batch_size:
+                frame = self._read(reader)
+                if frame is None:
+                    break
+                frames.append(frame)
+            if not frames:
+                break
+            batch = frames[:self.batch_size]
+            frames = frames[self.batch_size:]
+            with self._stage('roi'):
+                rois = [sampler(frame) for frame in batch]
+            batch_detections, batch_classifications = \
+                self._detect_and_classify(rois, num_frames)
+            detections += batch_detections
+            classifications += batch_classifications
+            num_frames += len(batch)
+        reader.release()
+
+        with self._stage('count'):
+            # Only the best detection of each frame is counted
+            detections = [sorted(frame_detections,
+                                 key=lambda det: det.confidence,
+                                 reverse=True)[:1]
+                          for frame_detections in detections]
+            self.keyframe_finder.img_width = roi[2]
+            self.keyframe_finder.img_height = roi[3]
+            keyframes = self.keyframe_finder.process(classifications,
+                                                     detections)
+        return num_frames, keyframes
+
+def report(num_frames, timings):
+    """ Returns a table of the frames per second and per stage latency
+
+    num_frames: Number of frames processed
+    timings: Dict of stage to seconds spent in it
+    """
+    total = sum(timings.values())
+    lines = ["{} frames in {:.2f} s, {:.1f} frames per second".format(
+        num_frames, total, num_frames / total)]
+    lines.append("{:<12}{:>12}{:>10}".format("stage", "ms / frame", "share"))
+    for stage, seconds in timings.items():
+        lines.append("{:<12}{:>12.2f}{:>9.1f}%".format(
+            stage, 1000 * seconds / num_frames, 100 * seconds / total))
+    return "\n".join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Times the deployment library end to end on a video")
+    parser.add_argument("--model-dir",
+                        help="Directory with the models, laid out as in "
+                             "<ModelDir>/deploy. Defaults to synthetic "
+                             "models.")
+    parser.add_argument("--video",
+                        help="Path to the video. Defaults to a synthetic "
+                             "video.")
+    parser.add_argument("--frames",
+                        type=int,
+                        default=150,
+                        help="Number of frames of the synthetic video")
+    parser.add_argument("--depth",
+                        type=int,
+                        default=2,
+                        help="Number of convolutions run on each image by "
+                             "the synthetic models")
+    parser.add_argument("--retinanet",
+                        action="store_true",
+                        help="Detect with RetinaNet instead of SSD")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=8,
+                        help="Number of frames run through the detector "
+                             "at once")
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=1,
+                        help="Number of times to process the video, after "
+                             "a first untimed run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        model_dir = args.model_dir
+        if model_dir is None:
+            model_dir = os.path.join(work_dir, 'models')
+            write_models(model_dir, args.depth)
+        video_path = args.video
+        if video_path is None:
+            video_path = os.path.join(work_dir, 'video.avi')
+            write_video(video_path, args.frames)
+
+        pipeline = Pipeline(model_dir, args.retinanet, args.batch_size)
+        # Warm up the sessions, then only time the following runs
+        pipeline.process(video_path)
+        pipeline.timings = OrderedDict((stage, 0.0) for stage in STAGES)
+        num_frames = 0
+        for _ in range(args.repeat):
+            frames, keyframes = pipeline.process(video_path)
+            num_frames += frames
+        print("Found {} keyframes".format(len(keyframes)))
+        print(report(num_frames, pipeline.timings))
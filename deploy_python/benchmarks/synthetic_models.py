@@ -0,0 +1,234 @@
+""" Tiny frozen graphs standing in for the OpenEM deployment models
+
+Each graph has the input and output tensor names and shapes the model
+classes of the deployment library expect, so the whole pipeline from
+video decode to keyframes can be run and timed without trained models.
+The outputs are fixed network outputs, nudged by a small feature of the
+input so the graph is not folded away, and are plausible enough for the
+post processing: the ruler mask holds a ruler, the detectors find a few
+objects and the keyframe finder peaks where there are detections.
+
+A few strided convolutions are run on every image to stand in for the
+network cost. Their number is set with depth.
+"""
+import argparse
+import os
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+# Input (height, width) of each model, as in train/train.ini
+FIND_RULER_SHAPE = (360, 640)
+DETECT_SHAPE = (360, 720)
+CLASSIFY_SHAPE = (300, 300)
+# Species including background and cover categories of the classifier
+NUM_SPECIES = 8
+NUM_COVER = 3
+# Frames and features of a keyframe finder sequence
+COUNT_STEPS = 256
+COUNT_FEATURES = NUM_SPECIES + NUM_COVER + 4 + 2
+# Padding before and after each sequence, openem.Count.KEYFRAME_OFFSET
+KEYFRAME_OFFSET = 32
+
+# Model file of each model, relative to the model directory. Follows the
+# layout of <ModelDir>/deploy written by the training library.
+MODEL_FILES = {'find_ruler': os.path.join('find_ruler', 'find_ruler.pb'),
+               'detect': os.path.join('detect', 'detect.pb'),
+               'detect_retinanet': os.path.join('detect',
+                                                'detect_retinanet.pb'),
+               'classify': os.path.join('classify', 'classify.pb'),
+               'count': os.path.join('count', 'count.pb')}
+
+def _image_input(name, shape):
+    """ Returns a float image placeholder of (height, width) shape """
+    return tf.compat.v1.placeholder(tf.float32, (None, *shape, 3), name=name)
+
+def _feature(images, depth, rng):
+    """ Returns a (batch,) feature in -1 to 1 of the images, after depth
+        strided 3x3 convolutions with 8 channels """
+    net = images
+    channels = 3
+    for _ in range(depth):
+        weights = rng.normal(0, 1.0 / (3 * np.sqrt(channels)),
+                             (3, 3, channels, 8)).astype(np.float32)
+        net = tf.nn.relu(tf.nn.conv2d(net, weights, 2, 'SAME'))
+        channels = 8
+    return tf.tanh(tf.reduce_mean(net, axis=[1, 2, 3]) / 100.0)
+
+def _batched(value, feature, scale=0.0):
+    """ Tiles a fixed output over the batch, adding scale times the feature
+        of each image """
+    value = tf.constant(value.astype(np.float32))
+    batch = tf.shape(feature)[0]
+    tiled = tf.tile(value[tf.newaxis], [batch] + [1] * len(value.shape))
+    nudge = tf.reshape(feature * scale, [-1] + [1] * len(value.shape))
+    return tiled + nudge
+
+def ssd_graph(depth=2, num_anchors=8000, num_classes=NUM_SPECIES,
+              num_objects=5, seed=0):
+    """ Returns a frozen graph with the tensors of openem.Detect.SSD
+
+    Output is loc, conf, anchors and variances of every anchor. Most
+    anchors are confidently background, num_objects are not.
+    """
+    rng = np.random.RandomState(seed)
+    graph = tf.Graph()
+    with graph.as_default():
+        images = _image_input('input_1', DETECT_SHAPE)
+        feature = _feature(images, depth, rng)
+        loc = rng.normal(0, 0.5, (num_anchors, 4))
+        logits = rng.normal(0, 1, (num_anchors, num_classes))
+        logits[:, 0] += 5.0
+        objects = rng.choice(num_anchors, num_objects, replace=False)
+        logits[objects, 0] -= 10.0
+        logits[objects, rng.randint(1, num_classes, num_objects)] += 5.0
+        centers = rng.uniform(0.05, 0.95, (num_anchors, 2))
+        sizes = rng.uniform(0.02, 0.3, (num_anchors, 2))
+        anchors = np.concatenate([centers - sizes / 2, centers + sizes / 2],
+                                 axis=1)
+        variances = np.tile([0.1, 0.1, 0.2, 0.2], (num_anchors, 1))
+        conf = tf.nn.softmax(_batched(logits, feature, 0.1))
+        tf.identity(tf.concat([_batched(loc, feature, 0.01),
+                               conf,
+                               _batched(anchors, feature),
+                               _batched(variances, feature)], axis=2),
+                    name='output_node0')
+    return graph.as_graph_def()
+
+def retinanet_graph(depth=2, max_detections=300,
+                    num_classes=NUM_SPECIES - 1, num_objects=5, seed=0):
+    """ Returns a frozen graph with the tensors of openem.Detect.RetinaNet
+
+    Output is x1, y1, x2, y2, label and class scores of each detection in
+    network input coordinates. As in keras_retinanet, detections after the
+    num_objects found are padded with -1.
+    """
+    rng = np.random.RandomState(seed)
+    height, width = DETECT_SHAPE
+    graph = tf.Graph()
+    with graph.as_default():
+        images = _image_input('input_1', DETECT_SHAPE)
+        feature = _feature(images, depth, rng)
+        detections = np.full((max_detections, 5 + num_classes), -1.0)
+        x0 = rng.uniform(0, width * 0.8, num_objects)
+        y0 = rng.uniform(0, height * 0.8, num_objects)
+        labels = rng.randint(0, num_classes, num_objects)
+        scores = rng.uniform(0, 0.1, (num_objects, num_classes))
+        scores[np.arange(num_objects), labels] = rng.uniform(0.5, 1.0,
+                                                             num_objects)
+        detections[:num_objects, 0] = x0
+        detections[:num_objects, 1] = y0
+        detections[:num_objects, 2] = x0 + rng.uniform(40, width * 0.2,
+                                                       num_objects)
+        detections[:num_objects, 3] = y0 + rng.uniform(20, height * 0.2,
+                                                       num_objects)
+        detections[:num_objects, 4] = labels
+        detections[:num_objects, 5:] = scores
+        with tf.compat.v1.name_scope('nms/map/TensorArrayStack/'):
+            tf.identity(_batched(detections, feature),
+                        name='TensorArrayGatherV3')
+    return graph.as_graph_def()
+
+def classify_graph(depth=2, seed=0):
+    """ Returns a frozen graph with the tensors of openem.Classify
+
+    Outputs are the species and cover probabilities of each image.
+    """
+    rng = np.random.RandomState(seed)
+    graph = tf.Graph()
+    with graph.as_default():
+        images = _image_input('data', CLASSIFY_SHAPE)
+        feature = _feature(images, depth, rng)
+        species = rng.normal(0, 1, NUM_SPECIES)
+        species[rng.randint(1, NUM_SPECIES)] += 3.0
+        cover = rng.normal(0, 1, NUM_COVER)
+        tf.nn.softmax(_batched(species, feature, 0.1), name='cat_species_1')
+        tf.nn.softmax(_batched(cover, feature, 0.1), name='cat_cover_1')
+    return graph.as_graph_def()
+
+def find_ruler_graph(depth=2, angle=12.0, thickness=120, seed=0):
+    """ Returns a frozen graph with the tensors of openem.FindRuler
+
+    Output is a mask from 0 to 1 of a ruler thickness pixels wide, rotated
+    by angle degrees through the center of the image.
+    """
+    rng = np.random.RandomState(seed)
+    height, width = FIND_RULER_SHAPE
+    mask = np.zeros(FIND_RULER_SHAPE, dtype=np.float32)
+    dx = np.cos(np.radians(angle)) * width * 0.35
+    dy = np.sin(np.radians(angle)) * width * 0.35
+    cv2.line(mask,
+             (int(width / 2 - dx), int(height / 2 - dy)),
+             (int(width / 2 + dx), int(height / 2 + dy)),
+             0.9, thickness=thickness)
+    graph = tf.Graph()
+    with graph.as_default():
+        images = _image_input('input_1', FIND_RULER_SHAPE)
+        feature = _feature(images, depth, rng)
+        tf.clip_by_value(_batched(mask[:, :, np.newaxis], feature, 0.05),
+                         0.0, 1.0, name='output_node0')
+    return graph.as_graph_def()
+
+def count_graph(spacing=24):
+    """ Returns a frozen graph with the tensors of openem.Count
+
+    Output has a keyframe peak every spacing frames of the sequence,
+    scaled by how likely the frame is to hold a fish.
+    """
+    num_frames = COUNT_STEPS - 2 * KEYFRAME_OFFSET
+    peaks = np.zeros(num_frames, dtype=np.float32)
+    peaks[spacing // 2::spacing] = 0.5
+    graph = tf.Graph()
+    with graph.as_default():
+        sequences = tf.compat.v1.placeholder(
+            tf.float32, (None, COUNT_STEPS, COUNT_FEATURES), name='input_1')
+        # openem.Count reads output i as frame i - KEYFRAME_OFFSET. Species
+        # scores sum to one in every frame, feature 0 is the background
+        # score and is one for padding and frames without a detection.
+        frames = sequences[:, :num_frames, :NUM_SPECIES]
+        detected = tf.reduce_sum(frames[:, :, 1:], axis=2)
+        tf.multiply(detected, peaks, name='cumsum_values_1')
+    return graph.as_graph_def()
+
+def write_models(model_dir, depth=2, seed=0):
+    """ Writes every synthetic model into model_dir
+
+    model_dir: Directory to write to, the models are laid out as in
+               MODEL_FILES
+    depth: Number of convolutions run on each image by the image models
+    seed: Seed of the fixed network outputs
+
+    Returns dict of model name to path of its frozen graph.
+    """
+    graphs = {'find_ruler': find_ruler_graph(depth, seed=seed),
+              'detect': ssd_graph(depth, seed=seed),
+              'detect_retinanet': retinanet_graph(depth, seed=seed),
+              'classify': classify_graph(depth, seed=seed),
+              'count': count_graph()}
+    paths = {}
+    for name, graph_def in graphs.items():
+        path = os.path.join(model_dir, MODEL_FILES[name])
+        tf.io.write_graph(graph_def, os.path.dirname(path),
+                          os.path.basename(path), as_text=False)
+        paths[name] = path
+    return paths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Writes tiny frozen graphs with the tensors of the "
+                    "OpenEM deployment models")
+    parser.add_argument("model_dir",
+                        help="Directory to write the models to")
+    parser.add_argument("--depth",
+                        type=int,
+                        default=2,
+                        help="Number of convolutions run on each image")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help="Seed of the fixed network outputs")
+    args = parser.parse_args()
+    for path in write_models(args.model_dir, args.depth, args.seed).values():
+        print(path)
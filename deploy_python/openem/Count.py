@@ -76,7 +76,7 @@ class KeyframeFinder:
         # Iterate over each sequence to generate a batch request
         for sequence_idx in range(sequence_count):
             start_idx = sequence_idx*sequence_length
-            end_idx = max((sequence_idx+1)*sequence_length,len(detections))
+            end_idx = min((sequence_idx+1)*sequence_length,len(detections))
             classification_sublist=classifications[start_idx:end_idx]
             detections_sublist=detections[start_idx:end_idx]
             sequences.append(self._generateSequence(classification_sublist,
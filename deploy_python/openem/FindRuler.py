@@ -5,6 +5,7 @@ import cv2
 from openem.models import ImageModel
 from openem.models import Preprocessor
 from openem.image import crop
+from openem.image import affine_remap_maps
 
 class RulerMaskFinder(ImageModel):
     """ Class for finding ruler masks from raw images """
@@ -138,6 +139,16 @@ def rulerEndpoints(image_mask):
     inverse = np.vstack([inverse, [0,0,1]])
     return cv2.perspectiveTransform(endpoints, inverse)[0]
 
+def _rectifyMatrix(image_shape, endpoints):
+    """ Returns the 2x3 affine matrix used by rectify for an image of
+        the given (height, width) shape and ruler endpoints.
+    """
+    dst = np.array([[image_shape[1]*.1, image_shape[0]/2],
+                    [image_shape[1]*.9, image_shape[0]/2]])
+    rt_matrix,_ = cv2.estimateAffinePartial2D(np.array(endpoints),
+                                              dst)
+    return rt_matrix
+
 def rectify(image, endpoints):
     """ Rectifies an image such that the ruler(in endpoints) is flat
         image: array
@@ -145,14 +156,77 @@ def rectify(image, endpoints):
         endpoints: array
                    Represents 2 pair of endpoints for a ruler
     """
-    dst = np.array([[image.shape[1]*.1, image.shape[0]/2],
-                    [image.shape[1]*.9, image.shape[0]/2]])
-    rt_matrix,_ = cv2.estimateAffinePartial2D(endpoints,
-                                            dst)
+    rt_matrix = _rectifyMatrix(image.shape, endpoints)
     return cv2.warpAffine(image,
                           rt_matrix,
                           (image.shape[1],image.shape[0]))
 
+class RoiSampler:
+    """ Extracts the rectified region of interest of every frame of a
+        video in a single warp.
+
+        rectify followed by crop (and the resize done by a model's
+        preprocessor) costs three full-resolution passes per frame. As
+        the endpoints and roi are fixed for a video, the three steps are
+        composed into one affine transform whose remap tables are built
+        once and reused for each frame.
+    """
+    def __init__(self, image_shape, endpoints, roi, output_shape=None,
+                 interpolation=cv2.INTER_LINEAR):
+        """ Create a sampler for frames of a given size
+
+        image_shape: tuple
+                     (height, width) of the frames to be sampled
+        endpoints: array
+                   Represents 2 pair of endpoints for a ruler
+        roi: tuple
+             (x,y,w,h) tuple in rectified coordinates -- presumably from
+             openem.FindRuler.findRoi
+        output_shape: tuple
+                      (height, width) of the sampled image, for example the
+                      detector input size. Defaults to the size of the roi.
+        interpolation: int
+                       cv2 interpolation flag used when sampling
+        """
+        # Match the integer truncation done by openem.image.crop
+        x0=int(roi[0])
+        y0=int(roi[1])
+        roi_width=int(roi[0]+roi[2]) - x0
+        roi_height=int(roi[1]+roi[3]) - y0
+        if output_shape is None:
+            output_shape = (roi_height, roi_width)
+        self.output_shape = tuple(output_shape[:2])
+        self.interpolation = interpolation
+
+        # Source -> rectified -> cropped -> output scale
+        rectify_matrix = np.vstack([_rectifyMatrix(image_shape, endpoints),
+                                    [0,0,1]])
+        crop_matrix = np.array([[1,0,-x0],
+                                [0,1,-y0],
+                                [0,0,1]])
+        scale_matrix = np.array([[self.output_shape[1]/roi_width,0,0],
+                                 [0,self.output_shape[0]/roi_height,0],
+                                 [0,0,1]])
+        transform = np.matmul(scale_matrix,
+                              np.matmul(crop_matrix, rectify_matrix))
+        self.transform = transform[0:2]
+
+        # Build the lookup of source pixel locations for each output pixel
+        inverse = cv2.invertAffineTransform(self.transform)
+        self._map1, self._map2 = affine_remap_maps(inverse,
+                                                   self.output_shape)
+
+    def __call__(self, image):
+        """ Returns the region of interest of a frame
+
+        image: array
+               Frame of the same size given at construction
+        """
+        return cv2.remap(image,
+                         self._map1,
+                         self._map2,
+                         self.interpolation)
+
 
 def findRoi(image_mask, h_margin):
     """ Returns the roi of a given mask; with additional padding added
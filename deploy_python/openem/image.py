@@ -18,6 +18,47 @@ def crop(image, roi):
     cropped=np.copy(image[y0:y1,x0:x1])
     return cropped
 
+def affine_remap_maps(inverse, output_shape):
+    """ Returns fixed point cv2.remap tables that sample an image with an
+        affine transform
+
+    inverse: array
+             2x3 affine matrix mapping output pixel coordinates to source
+             image coordinates
+    output_shape: tuple
+                  (height, width) of the sampled image
+    """
+    out_height, out_width = output_shape[:2]
+    grid_x, grid_y = np.meshgrid(np.arange(out_width, dtype=np.float32),
+                                 np.arange(out_height, dtype=np.float32))
+    map_x = (inverse[0,0]*grid_x + inverse[0,1]*grid_y
+             + inverse[0,2]).astype(np.float32)
+    map_y = (inverse[1,0]*grid_x + inverse[1,1]*grid_y
+             + inverse[1,2]).astype(np.float32)
+    # Fixed point maps are considerably faster to apply in cv2.remap
+    return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+def get_det_image(image, location):
+    """ Returns a *copy* of the square region around a detection, matching
+        openem::detect::GetDetImage from the C++ library
+    image: ndarray
+           Represents image data
+    location: tuple
+              (x,y,w,h) tuple of the detection
+    """
+    x=int(location[0])
+    y=int(location[1])
+    w=int(location[2])
+    h=int(location[3])
+    # Grow the box vertically to a square around its center
+    y-=int((w-h)/2)
+    h=w
+    x=max(x,0)
+    y=max(y,0)
+    w=min(w,image.shape[1]-x)
+    h=min(h,image.shape[0]-y)
+    return crop(image,(x,y,w,h))
+
 def resize_and_fill(image, desired_shape):
     """
     Resize an image to a desired shape (height,width) and maintaining
@@ -1,9 +1,11 @@
 import unittest
 import os
-from openem.Count import KeyframeFinder
+from openem.Count import KeyframeFinder, KEYFRAME_OFFSET
 
 import openem.Detect
 import openem.Classify
+from openem.Detect import Detection
+from openem.Classify import Classification
 
 import cv2
 import numpy as np
@@ -48,3 +50,44 @@ class CountTest(tf.test.TestCase):
         except Exception as e:
             raised=True
         self.assertTrue(raised)
+
+class CountSequenceTest(tf.test.TestCase):
+    """ Runs the keyframe finder on a synthetic graph, no example data is
+        needed """
+    def _writePeakGraph(self, num_features, spacing):
+        """ Writes a count graph with a keyframe peak every spacing frames of
+            the sequence, wherever the frame holds species 1 """
+        seq_len = 256
+        num_frames = seq_len - 2 * KEYFRAME_OFFSET
+        peaks = np.zeros(num_frames, dtype=np.float32)
+        peaks[spacing // 2::spacing] = 0.5
+        graph = tf.Graph()
+        with graph.as_default():
+            sequences = tf.compat.v1.placeholder(
+                tf.float32, (None, seq_len, num_features), name='input_1')
+            tf.multiply(sequences[:, :num_frames, 1], peaks,
+                        name='cumsum_values_1')
+        pb_file = os.path.join(self.get_temp_dir(), "peaks.pb")
+        tf.io.write_graph(graph.as_graph_def(), self.get_temp_dir(),
+                          "peaks.pb", as_text=False)
+        return pb_file
+
+    def test_multipleSequences(self):
+        species = [0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+        cover = [0.0, 0.0, 1.0]
+        pb_file = self._writePeakGraph(len(species) + len(cover) + 4 + 2, 24)
+        finder=KeyframeFinder(pb_file, 720, 360)
+
+        # Video longer than one sequence, with a fish in every frame
+        num_frames = finder.sequenceSize() + 108
+        detections = [[Detection([100, 100, 200, 100], 0.9, 1, frame, 'a')]
+                      for frame in range(num_frames)]
+        classifications = [[Classification(species, cover, frame, 'a')]
+                           for frame in range(num_frames)]
+        keyframes = finder.process(classifications, detections)
+
+        # Only peaks on frames rather than padding are keyframes: seven in
+        # the first sequence, five on the 108 frames of the second
+        self.assertEqual(len(keyframes), 7 + 5)
+        self.assertEqual(sum(frame >= finder.sequenceSize()
+                             for frame in keyframes), 5)
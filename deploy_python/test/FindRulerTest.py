@@ -144,3 +144,24 @@ class RoiTests(tf.test.TestCase):
         bb_roi = openem.FindRuler.findRoi(img,0)
         crop=openem.FindRuler.crop(img, bb_roi)
         self.assertAllEqual(crop, np.ones((4,4)))
+
+    def test_roiSampler(self):
+        # Smooth random image so interpolation differences stay small
+        img=np.random.RandomState(0).uniform(0,255,(360,640,3))
+        img=cv2.GaussianBlur(img.astype(np.uint8),(9,9),3)
+        endpoints=np.array([[100.0,200.0],[500.0,150.0]])
+        roi=(50.7,100.2,400.5,150.9)
+
+        expected=openem.FindRuler.crop(
+            openem.FindRuler.rectify(img, endpoints), roi)
+        sampler=openem.FindRuler.RoiSampler(img.shape, endpoints, roi)
+        sampled=sampler(img)
+        self.assertEqual(sampled.shape, expected.shape)
+        self.assertAllClose(expected, sampled, atol=2)
+
+        # Sampling directly at a network's input size
+        sampler=openem.FindRuler.RoiSampler(img.shape, endpoints, roi,
+                                            output_shape=(360,720))
+        sampled=sampler(img)
+        self.assertEqual(sampled.shape, (360,720,3))
+        self.assertAllClose(cv2.resize(expected,(720,360)), sampled, atol=16)
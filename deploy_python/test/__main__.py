@@ -5,7 +5,7 @@ import tensorflow as tf
 from test.FindRulerTest import FindRulerTest
 from test.DetectionTest import DetectionTest
 from test.ClassifyTest import ClassifyTest
-from test.CountTest import CountTest
+from test.CountTest import CountTest, CountSequenceTest
 
 if __name__=="__main__":
     tf.test.main()
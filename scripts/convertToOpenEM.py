@@ -9,8 +9,47 @@ for generating truth files for `detection_metrics.py`
 
 import argparse
 import pandas as pd
-import progressbar
-import os
+
+def convertToOpenEM(retinanet_df, species_df):
+    """ Converts retinanet annotations to openem box annotations
+
+    Inputs:
+    retinanet_df: DataFrame with columns img, x1, y1, x2, y2, species_name
+    species_df: DataFrame with columns species, num (0-based species id)
+
+    Return:
+    DataFrame with openem box columns
+    """
+    # Images are either named <video>.mp4<sep><frame>.<ext> or
+    # <video>/<frame>.<ext>
+    img = retinanet_df.img.astype(str)
+    basename = img.str.replace(r'^.*/', '', regex=True)
+    mp4 = basename.str.extract(r'^(?P<video_id>.*?)\.mp4.(?P<frame>.*)$')
+    in_dir = img.str.extract(r'(?:^|/)(?P<video_id>[^/]*)/(?P<frame>[^/]*)$')
+    in_dir.loc[in_dir.frame.isna(), 'frame'] = basename
+    is_mp4 = mp4.video_id.notna()
+    video_id = mp4.video_id.where(is_mp4, in_dir.video_id.fillna(''))
+    frame = mp4.frame.where(is_mp4, in_dir.frame)
+    frame = frame.str.replace(r'(?<=[^/])\.[^./]*$', '', regex=True).astype(int)
+
+    species = dict(zip(species_df.species, species_df.num))
+    species_id_0 = retinanet_df.species_name.map(species)
+    unknown = species_id_0.isna()
+    if unknown.any():
+        raise ValueError("Unknown species {}!".format(
+            sorted(set(retinanet_df.species_name[unknown].astype(str)))))
+
+    return pd.DataFrame({
+        'video_id': video_id,
+        'frame': frame,
+        # Retinanet diagonals can be backwards
+        'x': retinanet_df[['x1', 'x2']].min(axis=1),
+        'y': retinanet_df[['y1', 'y2']].min(axis=1),
+        'width': (retinanet_df.x2 - retinanet_df.x1).abs(),
+        'height': (retinanet_df.y2 - retinanet_df.y1).abs(),
+        'theta': 0.0,
+        # OpenEM uses 1-based indexing on species
+        'species_id': species_id_0.astype(int) + 1})
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser(description=__doc__)
@@ -18,44 +57,9 @@ if __name__=="__main__":
     parser.add_argument("openem_output", help="OpenEM output csv file")
     parser.add_argument("--species-csv", required=True, help='Retinanet CSV file for species names + ids')
     args = parser.parse_args()
-    openem_cols=['video_id','frame','x','y','width','height','theta','species_id']
     retinanet_cols = ['img', 'x1','y1','x2','y2', 'species_name']
     retinanet_df = pd.read_csv(args.retinanet_input, header=None, names=retinanet_cols)
-
-
-
-    openem_df = pd.DataFrame(columns=openem_cols)
-    openem_df.to_csv(args.openem_output, index=False)
-    count = len(retinanet_df)
-    bar = progressbar.ProgressBar(max_value=count, redirect_stdout=True)
-
     species_df = pd.read_csv(args.species_csv, header=None, names=['species','num'])
 
-    for idx,row in bar(retinanet_df.iterrows()):
-        video_fname = os.path.basename(row.img)
-        mp4_pos = video_fname.find('.mp4')
-        if mp4_pos >= 0:
-            video_id = video_fname[:mp4_pos]
-            frame_with_ext = video_fname[mp4_pos+5:]
-            frame = int(os.path.splitext(frame_with_ext)[0])
-        else:
-            video_fname = row.img
-            video_id = os.path.basename(os.path.dirname(video_fname))
-            frame_with_ext = os.path.basename(video_fname)
-            frame = int(os.path.splitext(frame_with_ext)[0])
-        species_row = species_df.loc[species_df.species == row.species_name]
-        species_id_0 = species_row.iloc[0].num
-        species_id_1 = species_id_0 + 1
-        datum = {"video_id": video_id,
-                 "frame": frame,
-                 # Retinanet diagonals can be backwards
-                 "x": min(row.x1,row.x2),
-                 "y": min(row.y1,row.y2),
-                 "width": abs(row.x2-row.x1),
-                 "height": abs(row.y2-row.y1),
-                 "theta": 0.0,
-                 # OpenEM uses 1-based indexing on species
-                 'species_id': species_id_1}
-
-        datum_df = pd.DataFrame(data=[datum], columns=openem_cols)
-        datum_df.to_csv(args.openem_output, header=False, index=False, mode='a')
+    openem_df = convertToOpenEM(retinanet_df, species_df)
+    openem_df.to_csv(args.openem_output, index=False)
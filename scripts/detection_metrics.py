@@ -4,14 +4,26 @@
 
 This script sweeps across different keep thresholds based on the provided
 CLI arguments (`--keep-threshold-[min,max,steps]`) and generates a
-precision/recall graph. It also calculates 'double count' metric which is
+precision/recall graph. Detections are matched once and the statistics for
+every threshold come from cumulative counts over the detections sorted by
+confidence. It also calculates 'double count' metric which is
 the number of boxes that matched a truth box, but already had a box associated
 with it. Imagine two boxes around the same object, with slightly different
-confidences.
+confidences. With `--full-curve` the exact curve is output instead, with a
+row per distinct detection confidence. Both keep the detections with a
+confidence above the threshold. The output matrix is read by
+make_pr_graph.py.
+
+When the truth has a species_id and the detections a det_species column,
+average precision is reported per species, along with their mean (mAP).
+For these, detections only match truth boxes of the same species and double
+counts are false positives.
 
 The True Positive is based on the IoU of the detection box against the truth
 data. If the detection box is not within the IoU threshold of the truth it is
-counted as a false positive.
+counted as a false positive. Within a frame, detections are visited by
+descending confidence and each takes the unmatched truth box it overlaps
+most; a detection overlapping only taken truth boxes is a double count.
 
 The false negatives are calculated per frame, such that if a frame has 4 truth
 detections, but 2 inference detections, 2 false negatives are added to the
@@ -20,111 +32,277 @@ metric.
 """
 
 import argparse
+import os
+from multiprocessing import Pool
 import pandas as pd
-import progressbar
 import numpy as np
 
-def _rowToBoxDict(row):
-    """ Converts a row from a csv to a dictionary """
-    box_dict={}
-    box_dict['x'] = row.x
-    box_dict['y'] = row.y
-    # Support both row formats for detect versus truth
-    try:
-        box_dict['w'] = row.width
-        box_dict['h'] = row.height
-    except:
-        box_dict['w'] = row.w
-        box_dict['h'] = row.h
-    return box_dict
-def _intersection_over_union(boxA, boxB):
-    """ Computes intersection over union for two bounding boxes.
+def _boxes(df):
+    """ Returns array of x, y, w, h supporting both row formats for detect
+        versus truth """
+    if 'width' in df.columns:
+        return df[['x', 'y', 'width', 'height']].values.astype(np.float64)
+    return df[['x', 'y', 'w', 'h']].values.astype(np.float64)
+
+def _iou_matrix(boxesA, boxesB):
+    """ Computes intersection over union for every pair of bounding boxes.
+        Coordinates are truncated to whole pixels and the intersection
+        includes both edges.
         Inputs:
-        boxA -- First box. Must be a dict containing x, y, w, h.
-        boxB -- Second box. Must be a dict containing x, y, w, h.
+        boxesA -- Nx4 array of x, y, w, h.
+        boxesB -- Mx4 array of x, y, w, h.
         Return:
-        Intersection over union.
+        NxM array of intersection over union.
     """
+    boxA = np.trunc(boxesA)[:, None, :]
+    boxB = np.trunc(boxesB)[None, :, :]
     # determine the (x, y)-coordinates of the intersection rectangle
-    xA = max(int(boxA["x"]), int(boxB["x"]))
-    yA = max(int(boxA["y"]), int(boxB["y"]))
-    xB = min(int(boxA["x"]) + int(boxA["w"]), int(boxB["x"]) + int(boxB["w"]))
-    yB = min(int(boxA["y"]) + int(boxA["h"]), int(boxB["y"]) + int(boxB["h"]))
+    xA = np.maximum(boxA[..., 0], boxB[..., 0])
+    yA = np.maximum(boxA[..., 1], boxB[..., 1])
+    xB = np.minimum(boxA[..., 0] + boxA[..., 2], boxB[..., 0] + boxB[..., 2])
+    yB = np.minimum(boxA[..., 1] + boxA[..., 3], boxB[..., 1] + boxB[..., 3])
 
     # compute the area of intersection rectangle
     interX = xB - xA + 1
     interY = yB - yA + 1
-    if interX < 0 or interY < 0:
-        iou = 0.0
-    else:
-        interArea = float((xB - xA + 1) * (yB - yA + 1))
-        # compute the area of both the prediction and ground-truth
-        # rectangles
-        boxAArea = int(boxA["w"]) * int(boxA["h"])
-        boxBArea = int(boxB["w"]) * int(boxB["h"])
-
-        # compute the intersection over union by taking the intersection
-        # area and dividing it by the sum of prediction + ground-truth
-        # areas - the interesection area
-        if float(boxAArea + boxBArea - interArea) <= 0.0:
-            return 0.01
-        try:
-            iou = interArea / float(boxAArea + boxBArea - interArea)
-        except:
-            print("interArea: {}".format(interArea))
-            print("Union: {}".format(float(boxAArea + boxBArea - interArea)))
-        # return the intersection over union value
-    return iou
-
-def calculateStats(truth, detections, keep_threshold):
-    eval_detects = detections.loc[detections.det_conf > keep_threshold]
-    count = len(eval_detects)
-    true_positives = 0
-    false_positives = 0
-    false_negatives = 0
-    double_counts = 0
-
-    matches={}
-    # Iterate over all detections from inference over keep threshold
-    # calculate true and false positives
-    for idx, row in eval_detects.iterrows():
-        matching_truth_df = truth.loc[(truth.video_id == row.video_id) & (truth.frame == row.frame)]
-        if len(matching_truth_df) == 0:
-            false_positives += 1
+    disjoint = (interX < 0) | (interY < 0)
+    interArea = interX * interY
+    # compute the area of both the prediction and ground-truth
+    # rectangles, degenerate unions get a small overlap
+    union = boxA[..., 2] * boxA[..., 3] + boxB[..., 2] * boxB[..., 3]
+    union = union - interArea
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(union <= 0, 0.01, interArea / union)
+    return np.where(disjoint, 0.0, iou)
+
+def _match_frame(truth_boxes, detect_boxes, detect_conf, iou_threshold):
+    """ Matches the detections of one frame to its truth boxes.
+        Detections are visited by descending confidence and take the
+        unmatched truth box they overlap most. A detection overlapping only
+        truth boxes that were already taken is a double count.
+        Inputs:
+        truth_boxes -- Nx4 array of truth boxes.
+        detect_boxes -- Mx4 array of detection boxes.
+        detect_conf -- Array of M detection confidences.
+        iou_threshold -- IoU above which a detection matches a truth box.
+        Return:
+        Tuple of boolean arrays (hit, double), one element per detection.
+    """
+    iou = _iou_matrix(truth_boxes, detect_boxes)
+    overlaps = iou > iou_threshold
+    hit = overlaps.any(axis=0)
+    double = np.zeros(len(detect_conf), dtype=bool)
+    taken = np.zeros(len(truth_boxes), dtype=bool)
+    for det_idx in np.argsort(-detect_conf, kind='stable'):
+        if not hit[det_idx]:
+            continue
+        candidates = overlaps[:, det_idx] & ~taken
+        if candidates.any():
+            taken[np.argmax(np.where(candidates, iou[:, det_idx], -1.0))] = True
         else:
-            got_match = False
-            for truth_idx, truth_row in matching_truth_df.iterrows():
-                truth_box = _rowToBoxDict(truth_row)
-                canidate_box = _rowToBoxDict(row)
-                iou = _intersection_over_union(truth_box, canidate_box)
-                if iou > args.iou_threshold:
-                    got_match = True
-                    if truth_row.name in matches:
-                        double_counts += 1
-                    else:
-                        matches[truth_row.name] = row
-                    break
-
-            if got_match == True:
-                true_positives += 1
-            else:
-                false_positives += 1
-
-    counted=[]
-    for idx, row in truth.iterrows():
-        matching_detection_df = eval_detects.loc[(eval_detects.video_id == row.video_id) & (eval_detects.frame == row.frame)]
-        boxes_in_truth=len(truth.loc[(truth.video_id == row.video_id) & (truth.frame == row.frame)])
-        boxes_in_detection = len(matching_detection_df)
-        if boxes_in_detection < boxes_in_truth:
-            vid_tag=f"{row.video_id}_{row.frame}"
-            if not vid_tag in counted:
-                counted.append(vid_tag)
-                false_negatives += (boxes_in_truth - boxes_in_detection)
-                print(f"False Negatives {false_negatives} @ {vid_tag}")
-
-    precision = true_positives / (true_positives + false_positives)
-    recall = true_positives / (true_positives + false_negatives)
-    return (precision, recall, double_counts / true_positives)
+            double[det_idx] = True
+    return hit, double
+
+def _match_groups(truth, detections, truth_keys, detect_keys, iou_threshold):
+    """ Matches detections to the truth boxes sharing their group keys.
+        Inputs:
+        truth -- DataFrame of truth boxes.
+        detections -- DataFrame of detections.
+        truth_keys -- Columns of truth identifying a group.
+        detect_keys -- Corresponding columns of detections.
+        iou_threshold -- IoU above which a detection matches a truth box.
+        Return:
+        Tuple of boolean arrays (hit, double), one element per detection.
+    """
+    conf = detections.det_conf.values.astype(np.float64)
+    hit = np.zeros(len(detections), dtype=bool)
+    double = np.zeros(len(detections), dtype=bool)
+    truth_groups = truth.groupby(truth_keys).indices
+    truth_boxes = _boxes(truth)
+    detect_boxes = _boxes(detections)
+    for key, det_idx in detections.groupby(detect_keys).indices.items():
+        truth_idx = truth_groups.get(key)
+        if truth_idx is None:
+            continue
+        hit[det_idx], double[det_idx] = _match_frame(
+            truth_boxes[truth_idx], detect_boxes[det_idx], conf[det_idx],
+            iou_threshold)
+    return hit, double
+
+def hasSpecies(truth, detections):
+    """ Returns whether truth and detections have species columns """
+    return ('species_id' in truth.columns and
+            'det_species' in detections.columns)
+
+def _match_video(task):
+    """ Matches the detections of one video, ignoring species and, if
+        both have species columns, within each species.
+        Inputs:
+        task -- Tuple of truth, detections and IoU threshold of one video.
+        Return:
+        Tuple of detection positions and boolean arrays hit, double,
+        species_hit and species_double. The species arrays are all False
+        without species columns.
+    """
+    truth, detections, iou_threshold = task
+    keys = ['video_id', 'frame']
+    hit, double = _match_groups(truth, detections, keys, keys, iou_threshold)
+    species_hit = np.zeros(len(detections), dtype=bool)
+    species_double = np.zeros(len(detections), dtype=bool)
+    if hasSpecies(truth, detections):
+        species_hit, species_double = _match_groups(
+            truth, detections, keys + ['species_id'], keys + ['det_species'],
+            iou_threshold)
+    return (detections.position.values, hit, double, species_hit,
+            species_double)
+
+def matchDetections(truth, detections, iou_threshold, workers=1):
+    """ Matches detections to truth boxes of the same frame, both ignoring
+        species and, if both have species columns, within each species.
+        Videos are matched in a process pool if workers is more than one.
+        Inputs:
+        truth -- DataFrame of truth boxes.
+        detections -- DataFrame of detections.
+        iou_threshold -- IoU above which a detection matches a truth box.
+        workers -- Number of worker processes.
+        Return:
+        DataFrame with columns hit, double, species_hit and
+        species_double, one row per detection in the same order.
+    """
+    detections = detections.assign(position=np.arange(len(detections)))
+    truth_videos = dict(list(truth.groupby('video_id')))
+    empty_truth = truth.iloc[:0]
+    tasks = [(truth_videos.get(video_id, empty_truth), video_dets,
+              iou_threshold)
+             for video_id, video_dets in detections.groupby('video_id')]
+    columns = ['hit', 'double', 'species_hit', 'species_double']
+    matches = {column: np.zeros(len(detections), dtype=bool)
+               for column in columns}
+    if workers > 1:
+        with Pool(workers) as pool:
+            results = pool.map(_match_video, tasks, chunksize=1)
+    else:
+        results = map(_match_video, tasks)
+    for position, *values in results:
+        for column, value in zip(columns, values):
+            matches[column][position] = value
+    return pd.DataFrame(matches, columns=columns)
+
+def cumulativeStats(truth, detections, matches):
+    """ Computes detection counts at every keep threshold in one pass.
+        The counts for a keep threshold are the cumulative sums over the
+        detections above it.
+        Inputs:
+        truth -- DataFrame of truth boxes.
+        detections -- DataFrame of detections.
+        matches -- Output of matchDetections.
+        Return:
+        Dict of arrays over detections sorted by descending confidence,
+        element i counting the first i detections (conf, true_positives,
+        false_positives, false_negatives, double_counts). Element 0 is
+        the empty set, its conf is infinite.
+    """
+    keys = ['video_id', 'frame']
+    conf = detections.det_conf.values.astype(np.float64)
+    hit = matches.hit.values
+    double = matches.double.values
+
+    # A frame has false negatives while it has fewer detections than
+    # truth boxes, so each detection removes one until that count.
+    order = np.argsort(-conf, kind='stable')
+    truth_count = truth.groupby(keys).size().rename('truth_count')
+    truth_count = detections[keys].join(truth_count, on=keys)
+    truth_count = truth_count.truth_count.fillna(0).values[order]
+    rank = detections.iloc[order].groupby(keys).cumcount().values
+    removes_fn = rank < truth_count
+
+    def _cumsum(values):
+        return np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+    hit = hit[order]
+    return {
+        'conf': np.concatenate(([np.inf], conf[order])),
+        'true_positives': _cumsum(hit),
+        'false_positives': _cumsum(~hit),
+        'false_negatives': len(truth) - _cumsum(removes_fn),
+        'double_counts': _cumsum(double[order]),
+    }
+
+def statsAtThresholds(stats, keep_thresholds):
+    """ Looks up precision, recall and double count rate for detections
+        with confidence above each keep threshold.
+        Inputs:
+        stats -- Output of cumulativeStats.
+        keep_thresholds -- Array of keep thresholds.
+        Return:
+        Nx3 array of precision, recall and double counts / true positives.
+    """
+    conf = stats['conf']
+    # Number of detections with confidence strictly above the threshold.
+    num_kept = np.searchsorted(-conf[1:], -np.asarray(keep_thresholds),
+                               side='left')
+    tp = stats['true_positives'][num_kept]
+    fp = stats['false_positives'][num_kept]
+    fn = stats['false_negatives'][num_kept]
+    doubles = stats['double_counts'][num_kept]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.stack((tp / (tp + fp), tp / (tp + fn), doubles / tp),
+                        axis=1)
+
+def fullCurve(stats):
+    """ Returns precision, recall and double count rate at a keep
+        threshold just below every distinct detection confidence, so each
+        step of the curve is included. As in statsAtThresholds, detections
+        above the threshold are kept.
+        Inputs:
+        stats -- Output of cumulativeStats.
+        Return:
+        Nx4 array of keep threshold, precision, recall and double counts /
+        true positives, by descending threshold. Empty without detections.
+    """
+    conf = np.unique(stats['conf'][1:])[::-1]
+    keep_thresholds = np.nextafter(conf, -np.inf)
+    return np.column_stack((keep_thresholds,
+                            statsAtThresholds(stats, keep_thresholds)))
+
+def averagePrecision(truth, detections, matches):
+    """ Computes average precision per species.
+        Detections only match truth boxes of their species, and double
+        counts are false positives. Precision is interpolated to be non
+        increasing with recall and integrated over every recall step.
+        Inputs:
+        truth -- DataFrame of truth boxes.
+        detections -- DataFrame of detections.
+        matches -- Output of matchDetections.
+        Return:
+        DataFrame with columns species_id, num_truth and ap, empty without
+        species columns.
+    """
+    results = []
+    if not hasSpecies(truth, detections):
+        return pd.DataFrame(results, columns=['species_id', 'num_truth', 'ap'])
+    # Species zero marks frames without fish.
+    species_ids = sorted(set(truth.species_id) | set(detections.det_species))
+    species_ids = [i for i in species_ids if i != 0]
+    for species_id in species_ids:
+        num_truth = int((truth.species_id == species_id).sum())
+        is_species = (detections.det_species == species_id).values
+        conf = detections.det_conf.values[is_species]
+        order = np.argsort(-conf, kind='stable')
+        true_pos = (matches.species_hit.values[is_species] &
+                    ~matches.species_double.values[is_species])[order]
+        tp = np.cumsum(true_pos)
+        fp = np.cumsum(~true_pos)
+        ap = np.nan
+        if num_truth > 0:
+            recall = np.concatenate(([0.0], tp / num_truth, [1.0]))
+            precision = np.concatenate(([0.0], tp / np.maximum(tp + fp, 1),
+                                        [0.0]))
+            precision = np.maximum.accumulate(precision[::-1])[::-1]
+            steps = np.flatnonzero(recall[1:] != recall[:-1])
+            ap = np.sum((recall[steps + 1] - recall[steps]) *
+                        precision[steps + 1])
+        results.append((species_id, num_truth, ap))
+    return pd.DataFrame(results, columns=['species_id', 'num_truth', 'ap'])
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser(description=__doc__)
@@ -145,6 +323,20 @@ if __name__=="__main__":
                         type=float,
                         default=0.4,
                         help="IoU threshold for determining True Positive")
+    parser.add_argument("--full-curve",
+                        action="store_true",
+                        help="Output a row per distinct detection confidence "
+                             "instead of sweeping the keep thresholds")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=os.cpu_count(),
+                        help="Number of processes matching videos")
+    parser.add_argument("--species",
+                        help="Comma separated species names, in the order "
+                             "of the one-based species IDs")
+    parser.add_argument("--output-ap",
+                        type=str,
+                        help="If supplied, writes AP per species to a csv")
     parser.add_argument("--output-matrix",
                         type=str,
                         help="If supplied, dumps the matrix to a file, else just prints")
@@ -153,16 +345,30 @@ if __name__=="__main__":
 
     detections=pd.read_csv(args.detect_csv)
     truth = pd.read_csv(args.truth)
-    results=[]
     keep_thresholds = np.linspace(args.keep_threshold_min,
                                   args.keep_threshold_max,
                                   args.keep_threshold_steps)
-    bar = progressbar.ProgressBar(redirect_stdout=True)
-    for keep_threshold in bar(keep_thresholds):
-        result_tuple = calculateStats(truth, detections, keep_threshold)
-        results.append([keep_threshold, *result_tuple])
+    matches = matchDetections(truth, detections, args.iou_threshold,
+                              args.workers)
+    stats = cumulativeStats(truth, detections, matches)
+    if args.full_curve:
+        matrix = fullCurve(stats)
+    else:
+        matrix = np.column_stack((keep_thresholds,
+                                  statsAtThresholds(stats, keep_thresholds)))
 
-    matrix = np.array(results)
+    if hasSpecies(truth, detections):
+        ap = averagePrecision(truth, detections, matches)
+        if args.species:
+            names = args.species.split(',')
+            ap['species'] = [names[int(i) - 1] if 0 < int(i) <= len(names)
+                             else '' for i in ap.species_id]
+        print(ap.to_string(index=False))
+        print(f"mAP: {ap.ap[ap.num_truth > 0].mean():.4f}")
+        if args.output_ap:
+            ap.to_csv(args.output_ap, index=False)
+    else:
+        print("No species columns, skipping average precision")
     print(matrix)
     if args.output_matrix:
         np.save(args.output_matrix, matrix)
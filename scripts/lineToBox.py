@@ -14,67 +14,60 @@ FishBoxDetection = namedtuple(
 
 def processTransformation(inputFile, outputFile, aspectRatios):
     inputFrame=pd.read_csv(inputFile)
-    frameBuffer=[]
-    for _,row in inputFrame.iterrows():
-        if row.species_id != 0:
-            width=math.hypot(row.x2-row.x1,row.y2-row.y1)
-            # Aspect ratio is height / width despite comment in ini file!
-            aspectRatio=float(aspectRatios[row.species_id-1])
-            height=width * aspectRatio
+    species_id=inputFrame.species_id.values
+    valid=species_id != 0
+    x1=inputFrame.x1.values[valid]
+    y1=inputFrame.y1.values[valid]
+    x2=inputFrame.x2.values[valid]
+    y2=inputFrame.y2.values[valid]
 
-            # Calculate theta of the box atan (in radians)
-            theta=math.atan2(row.y2-row.y1,row.x2-row.x1)
-            # phi is the angle of the perpendicular line
-            # It is also the angle of shift to apply to x1,y1 to get x,y
+    width=np.hypot(x2-x1,y2-y1)
+    # Aspect ratio is height / width despite comment in ini file!
+    aspectRatio=np.array(aspectRatios, dtype=float)[species_id[valid]-1]
+    height=width * aspectRatio
 
-            # Construct and utilize a translation matrix
-            # Start can flip to keep the box right-handed
-            start=[row.x1,row.y1]
+    # Calculate theta of the box atan (in radians)
+    theta=np.arctan2(y2-y1,x2-x1)
+    # phi is the angle of the perpendicular line
+    # It is also the angle of shift to apply to x1,y1 to get x,y
 
-            # If we are pitched higher than 90 degrees normalize to make
-            # box logic easier and swap start/finish to invert direction
-            if theta > (math.pi / 2):
-                theta=theta-math.pi
-                start=[row.x2,row.y2]
-            elif theta < -(math.pi/2):
-                theta=theta+math.pi
-                start=[row.x2,row.y2]
-            elif math.isclose(theta, math.pi/2):
-                pass
-            elif math.isclose(theta, -math.pi/2):
-                start=[row.x2,row.y2]
-                theta=math.pi/2
+    # If we are pitched higher than 90 degrees normalize to make
+    # box logic easier and swap start/finish to invert direction
+    # Start can flip to keep the box right-handed
+    above=theta > (math.pi / 2)
+    below=~above & (theta < -(math.pi / 2))
+    up=~above & ~below & _isclose(theta, math.pi / 2)
+    down=~above & ~below & ~up & _isclose(theta, -math.pi / 2)
+    theta=np.where(above, theta - math.pi, theta)
+    theta=np.where(below, theta + math.pi, theta)
+    theta=np.where(down, math.pi / 2, theta)
+    flip=above | below | down
+    startX=np.where(flip, x2, x1)
+    startY=np.where(flip, y2, y1)
 
-            phi=theta-(math.pi/2)
-            xShift=math.cos(phi)*(height/2)
-            yShift=math.sin(phi)*(height/2)
-            Translation=np.array([[1,0,xShift],
-                                  [0,1,yShift],
-                                  [0,0,1]])
-            xyz=Translation.dot([start[0],start[1],1])
+    phi=theta-(math.pi/2)
+    xShift=np.cos(phi)*(height/2)
+    yShift=np.sin(phi)*(height/2)
 
-            frameBuffer.append(FishBoxDetection(video_id=row.video_id,
-                                                frame=row.frame,
-                                                x=xyz[0],
-                                                y=xyz[1],
-                                                width=width,
-                                                height=height,
-                                                theta=theta,
-                                                species_id=row.species_id))
-        else:
-            frameBuffer.append(FishBoxDetection(video_id=row.video_id,
-                                                frame=row.frame,
-                                                x=None,
-                                                y=None,
-                                                width=None,
-                                                height=None,
-                                                theta=None,
-                                                species_id=row.species_id))
-
-    outputFrame=pd.DataFrame(data=frameBuffer,
+    outputFrame=pd.DataFrame({'video_id': inputFrame.video_id,
+                              'frame': inputFrame.frame},
                              columns=list(FishBoxDetection._fields))
+    for name, values in [('x', startX+xShift),
+                         ('y', startY+yShift),
+                         ('width', width),
+                         ('height', height),
+                         ('theta', theta)]:
+        column=np.full(len(inputFrame), np.nan)
+        column[valid]=values
+        outputFrame[name]=column
+    outputFrame['species_id']=species_id
     outputFrame.to_csv(outputFile, index=False)
 
+def _isclose(values, target):
+    """ Elementwise math.isclose with default tolerance """
+    return np.abs(values-target) <= 1e-09 * np.maximum(np.abs(values),
+                                                       abs(target))
+
 if __name__=="__main__":
     parser=argparse.ArgumentParser()
     parser.add_argument("-c", "--config",
@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 
-""" Makes a PR curve based on output from generate_detection_metrics.py """
+""" Makes a PR curve based on output from detection_metrics.py
+
+The data file is the matrix saved with `--output-matrix`, either a keep
+threshold sweep or the full curve from `--full-curve`. The AP csv saved with
+`--output-ap` may be given to show the mAP.
+"""
 
 import argparse
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 
 if __name__=="__main__":
@@ -11,6 +17,7 @@ if __name__=="__main__":
     parser.add_argument('data_file')
     parser.add_argument('--output', default="pr.png")
     parser.add_argument("--doubles", action="store_true")
+    parser.add_argument("--ap", help="AP csv from detection_metrics.py")
     args = parser.parse_args()
 
     matrix = np.load(args.data_file)
@@ -43,6 +50,11 @@ if __name__=="__main__":
         ax2.set_ylabel('Doubles / Total Truth', color='red')
         ax2.tick_params(axis='y', labelcolor='red')
 
+    if args.ap:
+        ap = pd.read_csv(args.ap)
+        ap = ap.ap[ap.num_truth > 0]
+        ax1.set_title(f"mAP: {ap.mean():.4f}")
+
     fig.legend(loc='lower left')
     fig.tight_layout()
     plt.savefig(args.output)
@@ -5,11 +5,13 @@ import json
 import pandas as pd
 import os
 import os.path
+import sys
 from collections import namedtuple
+from functools import partial
+from multiprocessing import Pool
 import progressbar
 import configparser
 import numpy as np
-import matplotlib.pyplot as plt
 
 FishBoxDetection = namedtuple(
     'FishBoxDetection',
@@ -23,79 +25,113 @@ def _getScientificName(jsonSpecies):
     scientificName=jsonSpecies.split('(')[0].strip().capitalize()
     return scientificName
 
-def _getTrackQuality(tracks, frame : int):
+def _trackQuality(track):
     """
     ignore=hand covering
     entering=clear (or not found)
     exiting=no view
     """
-    trackAtFrame=None
-    quality=2
-    for track in tracks:
-       if int(track["frame_added"]) == frame:
-           trackAtFrame=track
-           break
-    if trackAtFrame:
-        if trackAtFrame["count_label"] == "entering":
-            quality=2
-        elif trackAtFrame["count_label"] == "ignore":
-            quality=1
-        else:
-            quality=0
-
-    return quality
-
+    if track["count_label"] == "entering":
+        return 2
+    elif track["count_label"] == "ignore":
+        return 1
+    else:
+        return 0
 
-def _convertLocalizationsFromFile(inputPath, speciesNames):
+def _trackQualities(tracks):
+    """ Returns dict of frame to quality of the first track added at that
+        frame, frames without a track have quality 2 """
+    qualities={}
+    for track in tracks:
+        frame=int(track["frame_added"])
+        if frame not in qualities:
+            qualities[frame]=_trackQuality(track)
+    return qualities
+
+def _loadTracksAndDetections(inputPath, streaming):
+    """ Returns tracks and an iterable of detections of a tator json file.
+        With streaming the detections are parsed one at a time, which needs
+        the ijson package.
+    """
+    if not streaming:
+        with open(inputPath, 'r') as data:
+            obj=json.load(data)
+        return obj["tracks"], obj["detections"]
+
+    import ijson
+    with open(inputPath, 'rb') as data:
+        # Only keep the fields needed for the track qualities
+        tracks=[{"frame_added": track["frame_added"],
+                 "count_label": track.get("count_label")}
+                for track in ijson.items(data, 'tracks.item')]
+    def _detections():
+        with open(inputPath, 'rb') as data:
+            yield from ijson.items(data, 'detections.item')
+    return tracks, _detections()
+
+def _convertLocalizationsFromFile(inputPath, speciesNameMap, streaming=False):
+    """ Converts the box detections of a tator json file
+
+    Inputs:
+    inputPath: Path to the json file, named after the video
+    speciesNameMap: Dict of species name to openem species id
+    streaming: Whether to parse the detections one at a time
+
+    Return:
+    Tuple of dict of detection columns, including the cover of each
+    detection, and stats (boxes, ignored, unknown, unknownNames)
+    """
     base=os.path.basename(inputPath)
     video_id=os.path.splitext(base)[0]
 
-    # List of detections in openem tuple format
-    oemDetections=[]
-    oemCovers=[]
-    with open(inputPath, 'r') as data:
-        obj=json.load(data)
-        detections=obj["detections"]
-        tracks=obj["tracks"]
-        boxes=0
-        ignored=0
-        unknown=0
-        unknownNames=set()
-
-        for detection in detections:
-            if detection["type"] == "box":
-                name=_getScientificName(detection["species"])
-                if name not in speciesNameMap:
-                    unknown=unknown+1
-                    unknownNames.add(name)
-                    continue
-
-                frame=int(detection["frame"])
-                oemDetections.append(
-                    FishBoxDetection(
-                        video_id=video_id,
-                        frame=frame,
-                        x=float(detection["x"]),
-                        y=float(detection["y"]),
-                        width=float(detection["w"]),
-                        height=float(detection["h"]),
-                        species_id=speciesNameMap[name],
-                        theta=0
-                    )
-                )
-
-                #For now assume all localizations are non-covered
-                oemCovers.append(
-                    Cover(video_id=video_id,
-                          frame=frame,
-                          cover=_getTrackQuality(tracks,frame)
-                    )
-                )
-                boxes=boxes+1
-            else:
-                ignored=ignored+1
-
-    return (oemDetections, (boxes,ignored, unknown, unknownNames), oemCovers)
+    tracks, detections=_loadTracksAndDetections(inputPath, streaming)
+    qualities=_trackQualities(tracks)
+
+    columns={name: [] for name in
+             ['frame', 'x', 'y', 'width', 'height', 'species_id', 'cover']}
+    ignored=0
+    unknown=0
+    unknownNames=set()
+
+    for detection in detections:
+        if detection["type"] == "box":
+            name=_getScientificName(detection["species"])
+            if name not in speciesNameMap:
+                unknown=unknown+1
+                unknownNames.add(name)
+                continue
+
+            frame=int(detection["frame"])
+            columns['frame'].append(frame)
+            columns['x'].append(float(detection["x"]))
+            columns['y'].append(float(detection["y"]))
+            columns['width'].append(float(detection["w"]))
+            columns['height'].append(float(detection["h"]))
+            columns['species_id'].append(speciesNameMap[name])
+            #For now assume all localizations are non-covered
+            columns['cover'].append(qualities.get(frame, 2))
+        else:
+            ignored=ignored+1
+
+    dtypes={'x': float, 'y': float, 'width': float, 'height': float}
+    columns={name: np.array(values, dtype=dtypes.get(name, np.int64))
+             for name, values in columns.items()}
+    columns['video_id']=np.full(len(columns['frame']), video_id, dtype=object)
+    boxes=len(columns['frame'])
+    return (columns, (boxes, ignored, unknown, unknownNames))
+
+def _mergeColumns(fileColumns):
+    """ Concatenates the detection columns of several files into the
+        detection and cover DataFrames """
+    if not fileColumns:
+        return (pd.DataFrame(columns=FishBoxDetection._fields),
+                pd.DataFrame(columns=Cover._fields))
+    merged={name: np.concatenate([columns[name] for columns in fileColumns])
+            for name in fileColumns[0]}
+    merged['theta']=np.zeros(len(merged['frame']), dtype=np.int64)
+    df=pd.DataFrame({name: merged[name] for name in FishBoxDetection._fields})
+    coverDf=pd.DataFrame({name: merged[name] for name in Cover._fields})
+    return df, coverDf
 
 if __name__=="__main__":
     parser=argparse.ArgumentParser(description="Converts tator json annotations to csv")
@@ -115,6 +151,13 @@ if __name__=="__main__":
                         required=True)
     parser.add_argument("-d", "--directory",
                         help="Path to input file")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=os.cpu_count(),
+                        help="Number of processes converting files")
+    parser.add_argument("--streaming",
+                        action="store_true",
+                        help="Parse detections one at a time to limit memory on very large files (requires ijson)")
 
     args=parser.parse_args()
 
@@ -134,17 +177,17 @@ if __name__=="__main__":
     for idx,name in enumerate(speciesNames):
         speciesNameMap[name] = idx+1
 
-    data=[]
-    covers=[]
+    convert=partial(_convertLocalizationsFromFile,
+                    speciesNameMap=speciesNameMap,
+                    streaming=args.streaming)
     if args.input:
-        fileData, stats=_convertLocalizationsFromFile(args.input,
-                                                      speciesNameMap)
+        fileColumns, stats=convert(args.input)
         print(f"Processed {stats[0]} box localizations")
         print(f"Ignored {stats[1]} localizations due to wrong type")
         if stats[2]:
             print(f"Ignored {stats[2]} localizations due to unknown species")
             print(f"Unknown names = {stats[3]}")
-        data.extend(fileData)
+        allColumns=[fileColumns]
     else:
         dirContents=os.listdir(args.directory)
         filesToProcess=[]
@@ -153,31 +196,30 @@ if __name__=="__main__":
             comps=os.path.splitext(fname)
             if len(comps) > 1:
                 if comps[1][1:] == 'json':
-                    filesToProcess.append(fname)
+                    filesToProcess.append(
+                        os.path.join(args.directory,fname))
         progressbar.streams.wrap_stderr()
         bar=progressbar.ProgressBar(prefix='Files',
+                                    max_value=len(filesToProcess),
                                     redirect_stdout=True,
                                     redirect_stderr=True)
         stats=np.zeros(3)
         unknownNames=set()
-        for fname in bar(filesToProcess):
-            fileData, fileStats, cover=_convertLocalizationsFromFile(
-                os.path.join(args.directory,fname),
-                speciesNameMap)
-            data.extend(fileData)
-            covers.extend(cover)
-
-            stats=stats+np.array(fileStats[:3])
-            unknownNames=unknownNames.union(fileStats[3])
+        allColumns=[]
+        # Files are converted in parallel, results come back in file order
+        with Pool(max(1, args.workers)) as pool:
+            for fileColumns, fileStats in bar(pool.imap(convert,
+                                                         filesToProcess)):
+                allColumns.append(fileColumns)
+                stats=stats+np.array(fileStats[:3])
+                unknownNames=unknownNames.union(fileStats[3])
         print(f"Processed {stats[0]} box localizations")
         print(f"Ignored {stats[1]} localizations due to wrong type (i.e. dot)")
         if stats[2]:
             print(f"Ignored {stats[2]} localizations due to unknown species")
             print(f"Unknown names = {unknownNames}")
 
-
-    df=pd.DataFrame(columns=FishBoxDetection._fields,
-                 data=data)
+    df, coverDf=_mergeColumns(allColumns)
     videos_list=df['video_id'].unique()
     videos_df=pd.DataFrame(columns=['video_id'],
                             data=videos_list)
@@ -188,7 +230,4 @@ if __name__=="__main__":
     test=df.drop(train.index)
     test.to_csv(args.testOutput, index=False)
 
-
-    coverDf=pd.DataFrame(columns=Cover._fields,
-                         data=covers)
     coverDf.to_csv(args.coverOutput,index=False)
@@ -1,70 +1,249 @@
 #!/usr/bin/env python3
 
-""" Upload a result set or training set to tator for analysis """
+""" Upload a result set or training set to tator for analysis
+
+Rows are uploaded in batches by a pool of worker threads sharing one
+pooled HTTP session. Media already in tator is fetched in bulk up front,
+missing media is uploaded once. Completed rows are written to a journal so
+an interrupted upload can be resumed by running the same command again.
+"""
 import argparse
-import pytator
 import csv
+import json
 import progressbar
 import sys
 import signal
 import os
+import threading
+import time
 import configparser
 import pandas as pd
+import requests
 
-from multiprocessing import Pool, Value
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import partial
+from urllib3.exceptions import NewConnectionError
 
-progress = Value('i', 0)
+# REST endpoints, relative to the tator url
+MEDIA_LIST_ENDPOINT = "EntityMedias/{project}"
+MEDIA_ENDPOINT = "EntityMedia/{media_id}"
+LOCALIZATIONS_ENDPOINT = "Localizations/{project}"
 
 def exit_func(_,__):
     print("SIGINT detected")
     os._exit(0)
 
-def process_box(args, tator, species_names, truth_data, row):
-    media_element = uploadMedia(args, tator, row)
-    if media_element == None:
-        print("ERROR: Could not find media element!")
+def _never_sent(err):
+    """ Returns whether a connection error happened before the request
+        was sent, i.e. while connecting """
+    if isinstance(err, requests.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0], 'reason', None) if err.args else None
+    return isinstance(reason, NewConnectionError)
+
+class TatorRest:
+    """ Client for the tator REST calls made by the upload. Worker threads
+        share one session, so connections are kept alive and reused. """
+    def __init__(self, url, token, project,
+                 pool_size=4, retries=5, backoff=0.5, timeout=60):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.project = project
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({"Authorization": f"Token {token}",
+                                     "Content-Type": "application/json",
+                                     "Accept-Encoding": "gzip"})
+        self._pytator = None
+
+    def _request(self, method, endpoint, **kwargs):
+        """ Makes a request, retrying with exponential backoff on
+            connection errors, throttling and server errors. A POST may
+            have created objects before failing, so it is only retried when
+            throttled or when the connection failed before sending. """
+        idempotent = method != 'POST'
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.request(method,
+                                                f"{self.url}/{endpoint}",
+                                                timeout=self.timeout,
+                                                **kwargs)
+                status = response.status_code
+                if status != 429 and (status < 500 or not idempotent):
+                    response.raise_for_status()
+                    return response.json() if response.content else None
+                error = requests.HTTPError(
+                    f"{status} from {endpoint}",
+                    response=response)
+            except requests.ConnectionError as err:
+                if not idempotent and not _never_sent(err):
+                    raise
+                error = err
+            except requests.Timeout as err:
+                if not idempotent:
+                    raise
+                error = err
+            if attempt < self.retries:
+                time.sleep(self.backoff * (2 ** attempt))
+        raise error
+
+    def media_list(self, params):
+        """ Returns list of media elements matching the filter params """
+        result = self._request(
+            'GET', MEDIA_LIST_ENDPOINT.format(project=self.project),
+            params=params)
+        return result or []
+
+    def media(self, media_id):
+        """ Returns the media element with the given id """
+        return self._request('GET', MEDIA_ENDPOINT.format(media_id=media_id))
+
+    def add_localizations(self, objs):
+        """ Creates many localizations in one request """
+        return self._request(
+            'POST', LOCALIZATIONS_ENDPOINT.format(project=self.project),
+            json={"many": objs})
+
+    def uploader(self):
+        """ Returns the pytator client used for uploads, creating it on the
+            first call. Callers must not make the first call concurrently. """
+        if self._pytator is None:
+            import pytator
+            self._pytator = pytator.Tator(self.url, self.token, self.project)
+        return self._pytator
+
+    def upload_file(self, media_type_id, path, section, name):
+        """ Uploads a media file, using pytator for the upload protocol """
+        self.uploader().Media.uploadFile(media_type_id,
+                                         path,
+                                         progressBars=False,
+                                         section=section,
+                                         fname=name)
+
+class MediaCache:
+    """ Thread safe map of media names to media elements, uploading media
+        that is not in tator yet """
+    def __init__(self, args, client):
+        self.args = args
+        self.client = client
+        self._elements = {}
+        self._lock = threading.Lock()
+        self._name_locks = {}
+
+    def prefetch(self):
+        """ Fetches all media of the media type in one request """
+        elements = self.client.media_list({"type": self.args.media_type_id})
+        with self._lock:
+            for element in reversed(elements):
+                self._elements[element['name']] = element
+        return len(elements)
+
+    def _name_lock(self, name):
+        with self._lock:
+            return self._name_locks.setdefault(name, threading.Lock())
+
+    def get(self, row):
+        """ Returns the media element for a row, uploading the media if
+            needed, or None if there is no media for the row """
+        args = self.args
+        try:
+            img_file=f"{int(row['frame']):04d}.{args.img_ext}"
+        except:
+            print(f"Skipping {row}")
+            return
+        img_path=os.path.join(args.img_base_dir, row['video_id'], img_file)
+        if args.media_type == "image":
+            desired_name = f"{row['video_id']}_{row['frame']}.{args.img_ext}"
+        else:
+            desired_name = f"{row['video_id']}.{args.img_ext}"
+
+        # Workers needing the same media wait for the first one to fetch
+        # or upload it.
+        with self._name_lock(desired_name):
+            element = self._elements.get(desired_name)
+            if element is None:
+                search = self.client.media_list({"name": desired_name})
+                if not search:
+                    print(f"Uploading file...{desired_name}")
+                    # Workers share one pytator client, created once
+                    with self._lock:
+                        self.client.uploader()
+                    self.client.upload_file(args.media_type_id,
+                                            img_path,
+                                            args.section,
+                                            desired_name)
+                    search = self.client.media_list({"name": desired_name})
+                if not search:
+                    return None
+                element = search[0]
+            if 'width' not in element or 'height' not in element:
+                element = self.client.media(element['id'])
+            with self._lock:
+                self._elements[desired_name] = element
+            return element
+
+class ProgressJournal:
+    """ Append only record of uploaded rows of the input file """
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        if os.path.exists(path):
+            with open(path, 'r') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line of an interrupted write
+                        continue
+                    self.completed.update(range(entry['start'],
+                                                entry['stop']))
+        self._file = open(path, 'a')
+        if self._file.tell() > 0:
+            # Terminate an interrupted last line
+            with open(path, 'rb') as journal:
+                journal.seek(-1, os.SEEK_END)
+                if journal.read(1) != b'\n':
+                    self._file.write('\n')
+        self._lock = threading.Lock()
+
+    def record(self, start, stop):
+        """ Records rows start to stop (exclusive) as uploaded """
+        with self._lock:
+            self._file.write(json.dumps({"start": start, "stop": stop})+"\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
 
+def process_box(args, species_names, media_element, row):
     obj = None
-    if media_element and args.localization_type_id:
+    if args.localization_type_id:
         species_id_0 = int(float(row['species_id'])-1)
-        add=True
-        if args.threshold:
-            if confidence < args.threshold:
-                add=False
-        if add:
-            obj = make_localization_obj(args,
-                                   tator,
-                                   args.localization_type_id,
-                                   media_element,
-                                   frame=int(row['frame']),
-                                   x=float(row['x']),
-                                   y=float(row['y']),
-                                   width=float(row['width']),
-                                   height=float(row['height']),
-                                   confidence=None,
-                                   species=species_names[species_id_0])
-    with progress.get_lock():
-        progress.value += 1
+        obj = make_localization_obj(args,
+                                    args.localization_type_id,
+                                    media_element,
+                                    frame=int(row['frame']),
+                                    x=float(row['x']),
+                                    y=float(row['y']),
+                                    width=float(row['width']),
+                                    height=float(row['height']),
+                                    confidence=None,
+                                    species=species_names[species_id_0])
     return obj
-def process_line(args, tator, species_names, row):
-    print("ERROR: Line mode --- Not supported")
 
-def process_detect(args, tator, species_names, truth_data, row):
-    if type(truth_data) != type(None):
-        if row['frame'] == '':
-            return
-        match=truth_data.loc[(truth_data.video_id == row['video_id']) & (truth_data.frame == int(row['frame']))]
-        if len(match) == 0:
-            return
-        else:
-            pass
-    media_element = uploadMedia(args, tator, row)
-    if media_element == None:
-        print("ERROR: Could not find media element!")
+def process_line(args, species_names, media_element, row):
+    print("ERROR: Line mode --- Not supported")
 
+def process_detect(args, species_names, media_element, row):
     obj = None
-    if media_element and args.localization_type_id:
+    if args.localization_type_id:
         species_id_0 = int(float(row['det_species'])-1)
         confidence = float(row['det_conf'])
         add=True
@@ -73,22 +252,32 @@ def process_detect(args, tator, species_names, truth_data, row):
                 add=False
         if add:
             obj = make_localization_obj(args,
-                                   tator,
-                                   args.localization_type_id,
-                                   media_element,
-                                   frame=int(row['frame']),
-                                   x=float(row['x']),
-                                   y=float(row['y']),
-                                   width=float(row['w']),
-                                   height=float(row['h']),
-                                   confidence=confidence,
-                                   species=species_names[species_id_0])
-    with progress.get_lock():
-        progress.value += 1
+                                        args.localization_type_id,
+                                        media_element,
+                                        frame=int(row['frame']),
+                                        x=float(row['x']),
+                                        y=float(row['y']),
+                                        width=float(row['w']),
+                                        height=float(row['h']),
+                                        confidence=confidence,
+                                        species=species_names[species_id_0])
     return obj
 
+def in_truth(truth_index, row):
+    """ Returns whether the row is in the truth set, all rows are if there
+        is no truth set """
+    if truth_index is None:
+        return True
+    if row['frame'] == '':
+        return False
+    return (row['video_id'], int(row['frame'])) in truth_index
+
+def make_truth_index(truth_data):
+    """ Returns set of (video_id, frame) in the truth data """
+    return set(zip(truth_data.video_id.astype(str),
+                   truth_data.frame.astype(int)))
+
 def make_localization_obj(args,
-                          tator,
                           box_type,
                           media_el,
                           frame,
@@ -108,46 +297,92 @@ def make_localization_obj(args,
         obj.update({"frame": frame})
     return obj
 
+def uploadBatch(client, media_cache, journal, process_func, rows, start, stop):
+    """ Makes the localizations of rows start to stop and adds them with one
+        request
 
-media_list_cache={}
-def uploadMedia(args, tator, row):
-    """ Attempts to upload the media in the row to tator
-        if already there, skips, but either way returns the
-        media element information. """
-    vid_dir=os.path.join(args.img_base_dir, row['video_id'])
-    global media_list_cache
-    try:
-        img_file=f"{int(row['frame']):04d}.{args.img_ext}"
-    except:
-        print(f"Skipping {row}")
-        return
-    img_path=os.path.join(vid_dir, img_file)
-    if args.media_type == "image":
-        desired_name = f"{row['video_id']}_{row['frame']}.{args.img_ext}"
-    else:
-        desired_name = f"{row['video_id']}.{args.img_ext}"
-    if desired_name in media_list_cache:
-        return media_list_cache[desired_name]
-    else:
-        media_element_search=tator.Media.filter({"name": desired_name})
-        if media_element_search == None:
-            print(f"Uploading file...{desired_name}")
-            tator.Media.uploadFile(args.media_type_id,
-                                   img_path,
-                                   progressBars=False,
-                                   section=args.section,
-                                   fname=desired_name)
-            media_element_search=tator.Media.filter({"name": desired_name})
-        if media_element_search:
-            result = tator.Media.get(media_element_search[0]['id'])
-            media_list_cache[desired_name] = result
-            return result
+    Return: number of localizations added
+    """
+    objs=[]
+    for row in rows[start:stop]:
+        media_element = media_cache.get(row)
+        if media_element is None:
+            print("ERROR: Could not find media element!")
+            continue
+        obj = process_func(media_element, row)
+        if obj:
+            objs.append(obj)
+    if objs:
+        client.add_localizations(objs)
+    if journal:
+        journal.record(start, stop)
+    return len(objs)
+
+def makeBatches(indices, batch_size):
+    """ Splits sorted row indices into (start, stop) ranges of contiguous
+        rows no longer than batch_size """
+    batches=[]
+    for index in indices:
+        if (batches and batches[-1][1] == index and
+                batches[-1][1] - batches[-1][0] < batch_size):
+            batches[-1][1] += 1
         else:
-            return None
+            batches.append([index, index+1])
+    return [tuple(batch) for batch in batches]
+
+def upload(args, client, rows, process_func, truth_index=None,
+           journal_path=None, batch_size=200):
+    """ Uploads the localizations of the rows with a pool of workers
 
+    Inputs:
+    args: Parsed arguments describing the media and localization types
+    client: TatorRest client
+    rows: List of row dicts from the input csv
+    process_func: Function making a localization from media element and row
+    truth_index: Set of (video_id, frame) to restrict upload to, or None
+    journal_path: Path to progress journal, or None to upload all rows
+    batch_size: Maximum number of rows per localization request
 
+    Return: Tuple of number of localizations added and number of batches
+    that failed
+    """
+    journal = ProgressJournal(journal_path) if journal_path else None
+    completed = journal.completed if journal else set()
+    pending = [idx for idx, row in enumerate(rows)
+               if idx not in completed and in_truth(truth_index, row)]
+    if journal and len(pending) < len(rows):
+        print(f"Resuming, {len(rows)-len(pending)} rows already uploaded or excluded")
+
+    media_cache = MediaCache(args, client)
+    print(f"Found {media_cache.prefetch()} media elements")
+
+    batches = makeBatches(pending, batch_size)
+    added = 0
+    failed = 0
+    bar = progressbar.ProgressBar(max_value=max(len(pending), 1),
+                                  redirect_stdout=True)
+    done = 0
+    with ThreadPoolExecutor(max_workers=args.pool_size) as executor:
+        futures = {executor.submit(uploadBatch, client, media_cache,
+                                   journal, process_func, rows,
+                                   start, stop): (start, stop)
+                   for start, stop in batches}
+        for future in as_completed(futures):
+            start, stop = futures[future]
+            try:
+                added += future.result()
+            except Exception as err:
+                print(f"ERROR: Failed to upload rows {start} to {stop}: {err}")
+                failed += 1
+            done += stop - start
+            bar.update(done)
+    bar.finish()
+    if journal:
+        journal.close()
+    return added, failed
 
 if __name__=="__main__":
+    import pytator
     parser = argparse.ArgumentParser(description=__doc__)
     parser = pytator.tator.cli_parser(parser)
     parser.add_argument("csvfile", help="test.csv, length.csv, or detect.csv")
@@ -161,11 +396,16 @@ if __name__=="__main__":
     parser.add_argument("--localization-type-id", type=int)
     parser.add_argument("--section", help="Section name to apply")
     parser.add_argument("--pool-size", type=int, default=4, help="Number of threads to use")
+    parser.add_argument("--batch-size", type=int, default=200, help="Localizations per request")
+    parser.add_argument("--retries", type=int, default=5, help="Retries of failed requests")
+    parser.add_argument("--journal", help="Progress journal, defaults to <csvfile>.journal")
+    parser.add_argument("--no-resume", action="store_true", help="Ignore an existing journal")
     parser.add_argument("--train-ini", help="If uploading boxes, this is required to convert species id to a string")
     parser.add_argument("--threshold", type=float, help="Discard boxes less than this value")
     parser.add_argument("--truth-data", type=str, help="Path to annotations.csv to exclude non-truth data")
     args = parser.parse_args()
-    tator = pytator.Tator(args.url, args.token, args.project)
+    client = TatorRest(args.url, args.token, args.project,
+                       pool_size=args.pool_size, retries=args.retries)
 
     signal.signal(signal.SIGINT, exit_func)
 
@@ -199,30 +439,23 @@ if __name__=="__main__":
         config.read(args.train_ini)
         species_names=config.get('Data', 'Species').split(',')
 
-    truth_data = None
+    truth_index = None
     if args.truth_data:
-        truth_data = pd.read_csv(args.truth_data)
-    partial_func = partial(function_map[mode], args, tator,
-                           species_names, truth_data)
-    pool=Pool(processes=args.pool_size)
+        truth_index = make_truth_index(pd.read_csv(args.truth_data))
+
+    journal_path = args.journal or f"{args.csvfile}.journal"
+    if args.no_resume and os.path.exists(journal_path):
+        os.remove(journal_path)
+
+    partial_func = partial(function_map[mode], args, species_names)
     input_data = list(input_data_reader)
     print(f"Processing {len(input_data)} elements")
-    #result = pool.map_async(partial_func, input_data)
-    bar = progressbar.ProgressBar(max_value=len(input_data),
-                                  redirect_stdout=True)
-
     print("Generating localizations...")
-    local_list=[]
-    for row in bar(input_data):
-        obj = partial_func(row)
-        if obj:
-            local_list.append(obj)
-
-        if len(local_list) == 200:
-            tator.Localization.addMany(local_list)
-            local_list=[]
-
-    tator.Localization.addMany(local_list)
-    #while result.ready() == False:
-    #    bar.update(progress.value)
-    #    result.wait(1)
+    added, failed = upload(args, client, input_data, partial_func,
+                           truth_index=truth_index,
+                           journal_path=journal_path,
+                           batch_size=args.batch_size)
+    print(f"Added {added} localizations")
+    if failed:
+        print(f"ERROR: {failed} batches failed, run again to resume")
+        sys.exit(-1)
@@ -37,8 +37,299 @@ class TestUtils (unittest.TestCase):
                                                        theta=phi)
                             areaOfRotation=areaOfBox(rotate_detection(detection))
                             self.assertTrue(math.isclose(areaOfRotation, trueArea))
-        
-        
+
+    def testBatchTransform(self):
+        import numpy as np
+        from openem_train.util.utils import batch_rotate_detections
+        from openem_train.util.utils import batch_bbox_for_line
+        from openem_train.util.utils import bbox_for_line
+        # Same rotations as testTransform, all at once
+        grid=np.meshgrid(range(10,300,50), range(10,300,50),
+                         range(10,300,50), range(10,300,50),
+                         range(0,400,7), indexing='ij')
+        boxes=np.stack([g.ravel() for g in grid], axis=1).astype(float)
+        corners=batch_rotate_detections(boxes)
+        self.assertEqual(corners.shape, (len(boxes), 4, 2))
+        s1=np.hypot(*(corners[:,0]-corners[:,1]).T)
+        s2=np.hypot(*(corners[:,1]-corners[:,2]).T)
+        self.assertTrue(np.allclose(s1*s2, boxes[:,2]*boxes[:,3]))
+
+        # Horizontal and vertical lines give rects around the line
+        rects=batch_bbox_for_line([[0, 0], [5, 20]], [[10, 0], [5, 0]],
+                                  [0.5, 1.0])
+        self.assertTrue(np.allclose(rects[0], [[0, -2.5], [10, 2.5]]))
+        self.assertTrue(np.allclose(rects[1], [[-5, 0], [15, 20]]))
+        rect=bbox_for_line(np.array([0, 0]), np.array([10, 0]), 0.5)
+        self.assertTrue(np.allclose(rect, rects[0]))
+
+    def testWarpParity(self):
+        import numpy as np
+        import cv2
+        import skimage.transform
+        from skimage.transform import AffineTransform
+        from openem_train.util.utils import warp_affine
+        # OpenCV and skimage use different bicubic kernels so compare
+        # crop statistics rather than exact pixels.
+        rng=np.random.RandomState(0)
+        img=rng.randint(0, 256, (360, 720, 3)).astype(np.uint8)
+        img=cv2.GaussianBlur(img, (0, 0), 3)
+        img=cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX)
+        for _ in range(10):
+            tform=AffineTransform(
+                scale=rng.uniform(0.5, 1.5),
+                rotation=rng.uniform(-0.2, 0.2),
+                translation=rng.uniform(-50, 400, 2))
+            for image in [img, img / 255.0]:
+                old=skimage.transform.warp(image, tform, mode='edge',
+                                           order=3, output_shape=(299, 299))
+                new=warp_affine(image, tform, (299, 299), order=3)
+                self.assertEqual(new.shape, old.shape)
+                diff=np.abs(new - old)
+                self.assertLess(diff.mean(), 0.005)
+                self.assertLess(diff.max(), 0.05)
+                self.assertLess(abs(new.mean() - old.mean()), 0.001)
+                self.assertLess(abs(new.std() - old.std()), 0.002)
+
+    def testFrameStore(self):
+        import tempfile
+        import numpy as np
+        from openem_train.util.frame_store import FrameStore
+        with tempfile.TemporaryDirectory() as store_dir:
+            store=FrameStore(store_dir)
+            images={frame: np.full((4,6,3), frame, dtype=np.uint8)
+                    for frame in [0, 3, 7]}
+            with store.writer('video') as writer:
+                for frame, image in images.items():
+                    writer.add(frame, image)
+            self.assertEqual(store.video_ids(), ['video'])
+            self.assertEqual(store.frames('video'), [0, 3, 7])
+            self.assertFalse(store.has('video', 1))
+            self.assertEqual(store.shape('video'), (4,6,3))
+            for frame, image in images.items():
+                self.assertTrue((store.read('video', frame) == image).all())
+
+    def testBestDetection(self):
+        import pandas as pd
+        from openem_train.util import utils
+        dets=pd.DataFrame({'video_id': ['a', 'a', 'a', 'b'],
+                           'frame': [1, 1, 2, 1],
+                           'x': [1.0, 2.0, 3.0, 4.0],
+                           'det_conf': [0.5, 0.9, 0.05, 0.2]})
+        index=utils.best_detection_index(dets)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(utils.get_best_detection('a', 1, index)['x'], 2.0)
+        with self.assertRaises(ValueError):
+            utils.get_best_detection('a', 1, dets)
+        self.assertIsNone(utils.get_best_detection('a', 2, index))
+        self.assertIsNone(utils.get_best_detection('c', 1, index))
+
+    def testImageFromArray(self):
+        import numpy as np
+        from openem_train.find_ruler import _image_from_array
+        class ListImage:
+            # Binding without the buffer typemap
+            def FromData(self, data, width, height, channels):
+                if not isinstance(data, list):
+                    raise TypeError("in method 'Image_FromData'")
+                self.args=(data, width, height, channels)
+                return 0
+        data=np.arange(24, dtype=np.uint8).reshape(2,4,3)
+        img=ListImage()
+        self.assertEqual(_image_from_array(img, data), 0)
+        self.assertEqual(img.args, (list(range(24)), 4, 2, 3))
+
+    def testExpectedFrames(self):
+        from openem_train.preprocess import _expected_frames
+        # Annotated frames are extracted besides the strided frames
+        self.assertEqual(_expected_frames(20, {3, 4, 25}, 8), {0, 3, 4, 8, 16})
+        self.assertEqual(_expected_frames(20, {3, 4}, 0), {3, 4})
+        self.assertEqual(_expected_frames(5, None, 2), {0, 2, 4})
+
+    def testImageCache(self):
+        import numpy as np
+        from openem_train.util.image_cache import ImageCache
+        cache=ImageCache(2.5 * 100 * 100 * 3 / (1024 * 1024))
+        load=lambda: np.zeros((100, 100, 3), dtype=np.uint8)
+        for key in [1, 2, 1, 3, 2]:
+            cache.get(key, load)
+        # Each insert beyond two images evicts the least recently used one.
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 4)
+        self.assertEqual(sorted(cache._images.keys()), [2, 3])
+        self.assertFalse(cache.get(3, load).flags.writeable)
+
+    def testBatchLoader(self):
+        import numpy as np
+        from openem_train.util.loader import BatchLoader
+        def make_batch(batch_idx):
+            # Every fourth batch is short to exercise the queue fallback.
+            size=3 if batch_idx % 4 == 3 else 4
+            return (np.random.rand(size, 5).astype(np.float32),
+                    {'idx': np.full((size,), batch_idx)})
+        expected=None
+        for num_workers in [0, 1, 3]:
+            loader=BatchLoader(make_batch, num_workers=num_workers,
+                               prefetch=3, seed=7)
+            batches=[next(loader) for _ in range(10)]
+            loader.close()
+            for batch_idx, (x, y) in enumerate(batches):
+                self.assertEqual(x.shape[0], 3 if batch_idx % 4 == 3 else 4)
+                self.assertTrue((y['idx'] == batch_idx).all())
+            if expected is None:
+                expected=batches
+            for (x, _), (x_exp, _) in zip(batches, expected):
+                self.assertTrue(np.array_equal(x, x_exp))
+
+    def testBatchedNms(self):
+        import numpy as np
+        from openem_train.ssd.ssd_utils import batched_nms
+        boxes=np.array([[0.0, 0.0, 0.5, 0.5],
+                        [0.05, 0.0, 0.55, 0.5],
+                        [0.5, 0.5, 1.0, 1.0],
+                        [0.0, 0.0, 0.5, 0.5],
+                        [0.6, 0.6, 0.6, 0.9]])
+        scores=np.array([0.6, 0.9, 0.3, 0.5, 0.8])
+        groups=np.array([0, 0, 0, 1, 0])
+        # Box 0 overlaps the better box 1 and box 4 has no area, boxes of
+        # group 1 are suppressed separately.
+        keep=batched_nms(boxes, scores, groups, 0.45, 10)
+        self.assertEqual(list(keep), [1, 4, 2, 3])
+        keep=batched_nms(boxes, scores, groups, 0.45, 1)
+        self.assertEqual(list(keep), [1, 3])
+
+    def testMediaManifest(self):
+        import os
+        import tempfile
+        from openem_train.util.manifest import MediaManifest
+        with tempfile.TemporaryDirectory() as work_dir:
+            root=os.path.join(work_dir, 'imgs')
+            for vid_id, frames in [('b', [1, 0]), ('a', [2])]:
+                os.makedirs(os.path.join(root, vid_id))
+                for frame in frames:
+                    path=os.path.join(root, vid_id, '{:04}.jpg'.format(frame))
+                    open(path, 'w').close()
+            manifest=MediaManifest(os.path.join(work_dir, 'manifest.sqlite'))
+            manifest.sync('imgs', root, ['jpg'])
+            paths=[os.path.relpath(p, root) for p in manifest.paths('imgs')]
+            self.assertEqual(paths, ['a/0002.jpg', 'b/0000.jpg', 'b/0001.jpg'])
+            manifest.update_video('imgs', root, 'a', ['jpg'], (6, 4))
+            self.assertEqual(manifest.dims('imgs', 'a', 2), (6, 4))
+            # Rewriting a video in place drops its recorded dims
+            manifest.update_video('imgs', root, 'a', ['jpg'])
+            self.assertIsNone(manifest.dims('imgs', 'a', 2))
+            manifest.update_video('imgs', root, 'a', ['jpg'], (6, 4))
+            os.remove(os.path.join(root, 'b', '0000.jpg'))
+            manifest.sync('imgs', root, ['jpg'])
+            self.assertEqual(len(manifest.paths('imgs')), 2)
+            self.assertEqual(manifest.video_ids('imgs'), ['a', 'b'])
+
+    def testDetectionMetrics(self):
+        import numpy as np
+        import pandas as pd
+        sys.path.append("../scripts")
+        import detection_metrics
+        truth=pd.DataFrame({'video_id': ['a', 'a', 'b'], 'frame': [1, 1, 1],
+                            'x': [0, 50, 0], 'y': [0, 50, 0],
+                            'width': [10, 10, 10], 'height': [10, 10, 10]})
+        dets=pd.DataFrame({'video_id': ['a', 'a', 'b', 'b'],
+                           'frame': [1, 1, 1, 2], 'x': [0, 100, 0, 0],
+                           'y': [0, 100, 0, 0], 'w': [10, 10, 10, 10],
+                           'h': [10, 10, 10, 10],
+                           'det_conf': [0.9, 0.6, 0.6, 0.3]})
+        # Species agnostic matching works without species columns
+        matches=detection_metrics.matchDetections(truth, dets, 0.4)
+        self.assertEqual(list(matches.hit), [True, False, True, False])
+        self.assertTrue(detection_metrics.averagePrecision(
+            truth, dets, matches).empty)
+        stats=detection_metrics.cumulativeStats(truth, dets, matches)
+        # Each row of the full curve matches the threshold sweep
+        curve=detection_metrics.fullCurve(stats)
+        self.assertEqual(len(curve), 3)
+        swept=detection_metrics.statsAtThresholds(stats, curve[:, 0])
+        self.assertTrue(np.allclose(curve[:, 1:], swept, equal_nan=True))
+        self.assertTrue(np.allclose(curve[:, 1:3],
+                                    [[1, 1/3], [2/3, 1], [0.5, 1]]))
+        self.assertTrue(np.allclose(
+            detection_metrics.statsAtThresholds(stats, [0.6])[0, :2],
+            [1, 1/3]))
+        # No detections give an empty curve
+        empty=dets.iloc[:0]
+        matches=detection_metrics.matchDetections(truth, empty, 0.4)
+        stats=detection_metrics.cumulativeStats(truth, empty, matches)
+        self.assertEqual(detection_metrics.fullCurve(stats).shape, (0, 4))
+
+    def testUploadToTator(self):
+        import argparse
+        import json
+        import os
+        import tempfile
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        sys.path.append("../scripts")
+        import uploadToTator
+        media=[{'id': 1, 'name': 'a_1.jpg', 'width': 100, 'height': 50},
+               {'id': 2, 'name': 'a_2.jpg', 'width': 100, 'height': 50}]
+        posted=[]
+        failures=[1]
+        class StubTator(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            def _reply(self, status, body):
+                data=json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            def do_GET(self):
+                self._reply(200, media)
+            def do_POST(self):
+                body=json.loads(self.rfile.read(
+                    int(self.headers['Content-Length'])))
+                # First request is throttled to exercise the retry
+                if failures:
+                    failures.pop()
+                    self._reply(429, {})
+                    return
+                posted.extend(body['many'])
+                self._reply(201, {})
+        server=ThreadingHTTPServer(('127.0.0.1', 0), StubTator)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            client=uploadToTator.TatorRest(
+                'http://127.0.0.1:{}/rest'.format(server.server_port),
+                'token', 1, backoff=0.01)
+            args=argparse.Namespace(media_type_id=3, media_type='image',
+                                    img_ext='jpg', img_base_dir='.',
+                                    section=None, localization_type_id=4,
+                                    threshold=0.5, pool_size=2)
+            rows=[{'video_id': 'a', 'frame': str(frame % 2 + 1), 'x': '10',
+                   'y': '5', 'w': '20', 'h': '10', 'det_conf': str(conf),
+                   'det_species': '2'}
+                  for frame, conf in enumerate([0.9, 0.2, 0.7, 0.8, 0.6])]
+            func=lambda media_el, row: uploadToTator.process_detect(
+                args, ['x', 'y'], media_el, row)
+            with tempfile.TemporaryDirectory() as work_dir:
+                journal=os.path.join(work_dir, 'journal')
+                added, failed=uploadToTator.upload(
+                    args, client, rows, func, truth_index={('a', 1)},
+                    journal_path=journal, batch_size=2)
+                # Rows of frame 2 are not in the truth set and the second
+                # row is below the threshold.
+                self.assertEqual((added, failed), (3, 0))
+                self.assertEqual(sorted(obj['Confidence'] for obj in posted),
+                                 [0.6, 0.7, 0.9])
+                self.assertEqual(posted[0]['x'], 0.1)
+                self.assertEqual(posted[0]['Species'], 'y')
+                # Uploaded rows are in the journal, so a rerun without the
+                # truth set only adds the frame 2 row above the threshold.
+                added, failed=uploadToTator.upload(
+                    args, client, rows, func, journal_path=journal)
+                self.assertEqual((added, failed), (1, 0))
+                self.assertEqual(len(posted), 4)
+        finally:
+            server.shutdown()
+            server.server_close()
+
 
 if __name__=="__main__":
     unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+__copyright__ = "Copyright (C) 2018 CVision AI."
+__license__ = "GPLv3"
+# This file is part of OpenEM, released under GPLv3.
+# OpenEM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OpenEM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures throughput of the affine augmentation warps.
+"""
+
+import argparse
+import math
+import time
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import skimage.transform
+from skimage.transform import AffineTransform
+from openem_train.util.utils import warp_affine
+
+def _random_tform(rng, out_size, img_shape):
+    """Returns a random crop transform similar to the training augmentation.
+    """
+    size = rng.uniform(100, 300)
+    tform = AffineTransform(translation=(
+        rng.uniform(size, img_shape[1] - size),
+        rng.uniform(size / 2, img_shape[0] - size / 2)))
+    tform = AffineTransform(rotation=rng.uniform(-10, 10) * math.pi / 180) + tform
+    tform = AffineTransform(scale=size / out_size) + tform
+    tform = AffineTransform(translation=(-out_size / 2, -out_size / 2)) + tform
+    return tform
+
+def main():
+    """Parses command line args and runs the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=
+        "Compares samples per second of skimage.transform.warp and the "
+        "OpenCV warp used by the training augmentation, on synthetic "
+        "frames and a thread pool like the dataset generators.")
+    parser.add_argument(
+        '--width', type=int, default=720,
+        help="Width of the synthetic frames.")
+    parser.add_argument(
+        '--height', type=int, default=360,
+        help="Height of the synthetic frames.")
+    parser.add_argument(
+        '--out_size', type=int, default=299,
+        help="Size of one side of the output crop.")
+    parser.add_argument(
+        '--samples', type=int, default=256,
+        help="Number of samples per measurement.")
+    parser.add_argument(
+        '--threads', type=int, nargs='+', default=[1, 8],
+        help="Thread pool sizes to measure.")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 256, (args.height, args.width, 3)).astype(np.uint8)
+    tforms = [_random_tform(rng, args.out_size, img.shape)
+              for _ in range(args.samples)]
+    out_shape = (args.out_size, args.out_size)
+    methods = {
+        'skimage': lambda t: skimage.transform.warp(
+            img, t, mode='edge', order=3, output_shape=out_shape),
+        'opencv': lambda t: warp_affine(img, t, out_shape, order=3),
+    }
+
+    for threads in args.threads:
+        with ThreadPool(threads) as pool:
+            for name, method in methods.items():
+                start = time.time()
+                pool.map(method, tforms)
+                elapsed = time.time() - start
+                print("{:8s} threads={:2d}: {:8.1f} samples/sec".format(
+                    name, threads, args.samples / elapsed))
+
+if __name__ == '__main__':
+    main()
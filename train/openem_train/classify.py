@@ -49,6 +49,7 @@ def train(config):
     from keras.callbacks import ModelCheckpoint
     from keras.callbacks import TensorBoard
     from keras.callbacks import LearningRateScheduler
+    from keras.callbacks import LambdaCallback
     from openem_train.inception.inception import inception_model
     from openem_train.inception.inception_dataset import InceptionDataset
     from openem_train.util.utils import find_epoch
@@ -58,6 +59,21 @@ def train(config):
     os.makedirs(config.checkpoints_dir('classify'), exist_ok=True)
     os.makedirs(tensorboard_dir, exist_ok=True)
 
+    # Set up dataset interface. The batch loaders fork their workers, so
+    # start them before a tensorflow session exists.
+    dataset = InceptionDataset(config)
+    train_gen = dataset.generate(
+        batch_size=config.classify_batch_size()).start()
+    validation_gen = None
+    validation_steps = None
+    if config.classify_do_validation():
+        validation_gen = dataset.generate_test(
+            batch_size=config.classify_val_batch_size()
+        ).start()
+        validation_steps = dataset.test_batches(
+            config.classify_val_batch_size()
+        )
+
     # Build the inception model.
     model = inception_model(
         input_shape=(config.classify_height(), config.classify_width(), 3),
@@ -73,9 +89,6 @@ def train(config):
         )
         model.load_weights(checkpoint)
 
-    # Set up dataset interface.
-    dataset = InceptionDataset(config)
-
     # Define learning rate schedule.
     def schedule(epoch):
         if epoch < 1:
@@ -113,27 +126,22 @@ def train(config):
 
     lr_sched = LearningRateScheduler(schedule=schedule)
 
+    # Report how often decoded ROIs were reused during each epoch.
+    cache_stats = LambdaCallback(
+        on_epoch_end=lambda epoch, logs: print(
+            "Epoch {} ROI cache: {}".format(
+                epoch + 1, dataset.crops_cache.stats(reset=True))))
+
     # Determine steps per epoch.
     batch_size = config.classify_batch_size()
     steps_per_epoch = config.classify_steps_per_epoch()
     if not steps_per_epoch:
         steps_per_epoch = dataset.train_batches(config.classify_batch_size())
 
-    # Set up validation generator.
-    validation_gen = None
-    validation_steps = None
-    if config.classify_do_validation():
-        validation_gen = dataset.generate_test(
-            batch_size=config.classify_val_batch_size()
-        )
-        validation_steps = dataset.test_batches(
-            config.classify_val_batch_size()
-        )
-
     # Fit the model.
     model.summary()
     model.fit_generator(
-        dataset.generate(batch_size=config.classify_batch_size()),
+        train_gen,
         steps_per_epoch=steps_per_epoch,
         epochs=config.classify_num_epochs(),
         verbose=1,
@@ -141,7 +149,8 @@ def train(config):
             checkpoint_best,
             checkpoint_periodic,
             tensorboard,
-            lr_sched
+            lr_sched,
+            cache_stats
         ],
         validation_data=validation_gen,
         validation_steps=validation_steps,
@@ -184,7 +193,8 @@ def predict(config):
 
         # Get video id from path.
         path, fname = os.path.split(img_path)
-        frame, _ = os.path.splitext(fname)
+        # Detection images are named <frame>-det<index>-conf<confidence>.jpg.
+        frame = os.path.splitext(fname)[0].split('-')[0]
         video_id = os.path.basename(os.path.normpath(path))
 
 
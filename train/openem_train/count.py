@@ -51,8 +51,19 @@ def train(config):
     from openem_train.rnn.rnn import rnn_model
     from openem_train.util.utils import find_epoch
 
-    # Create the dataset.
+    # Create the dataset. The batch loaders fork their workers, so start
+    # them before a tensorflow session exists.
     dataset = RNNDataset(config)
+    train_gen = dataset.generate(batch_size=config.count_batch_size()).start()
+    validation_gen = None
+    validation_steps = None
+    if config.count_do_validation():
+        validation_gen = dataset.generate_test(
+            batch_size=config.count_val_batch_size()
+        ).start()
+        validation_steps = dataset.test_batches(
+            config.count_val_batch_size()
+        )
 
     # Build the model.
     model = rnn_model(
@@ -119,21 +130,10 @@ def train(config):
     if not steps_per_epoch:
         steps_per_epoch = dataset.train_batches(config.count_batch_size())
 
-    # Set up validation generator.
-    validation_gen = None
-    validation_steps = None
-    if config.count_do_validation():
-        validation_gen = dataset.generate_test(
-            batch_size=config.count_val_batch_size()
-        )
-        validation_steps = dataset.test_batches(
-            config.count_val_batch_size()
-        )
-
     # Fit the model.
     model.summary()
     model.fit_generator(
-        dataset.generate(batch_size=config.count_batch_size()),
+        train_gen,
         steps_per_epoch=512,
         epochs=config.count_num_epochs(),
         verbose=1,
@@ -67,6 +67,44 @@ def train(config):
         input_shape=(config.detect_height(), config.detect_width(), 3),
         num_classes=config.num_classes())
     
+    # Get prior box layers from model.
+    prior_box_names = [
+        'conv4_3_norm_mbox_priorbox',
+        'fc7_mbox_priorbox',
+        'conv6_2_mbox_priorbox',
+        'conv7_2_mbox_priorbox',
+        'conv8_2_mbox_priorbox',
+        'pool6_mbox_priorbox']
+    priors = []
+    for prior_box_name in prior_box_names:
+        layer = model.get_layer(prior_box_name)
+        if layer is not None:
+            priors.append(layer.prior_boxes)
+    priors = np.vstack(priors)
+
+    # Set up bounding box utility.
+    bbox_util = BBoxUtility(config.num_classes(), priors)
+
+    # Set up dataset interface. The batch loaders fork their workers, so
+    # start them before a tensorflow session exists.
+    dataset = SSDDataset(
+        config,
+        bbox_util=bbox_util,
+        preproc=lambda x: x)
+    batch_size = config.detect_batch_size()
+    train_gen = dataset.generate_ssd(
+        batch_size=batch_size,
+        is_training=True).start()
+    val_batch_size = config.detect_val_batch_size()
+    validation_gen = None
+    validation_steps = None
+    if config.detect_do_validation():
+        validation_gen = dataset.generate_ssd(
+            batch_size=val_batch_size,
+            is_training=False
+        ).start()
+        validation_steps = dataset.nb_test_samples // val_batch_size
+
     # If initial epoch is nonzero we load the model from checkpoints 
     # directory.
     initial_epoch = config.detect_initial_epoch()
@@ -92,30 +130,6 @@ def train(config):
     model.compile(loss=loss_obj.compute_loss, optimizer=adam)
     model.summary()
 
-    # Get prior box layers from model.
-    prior_box_names = [
-        'conv4_3_norm_mbox_priorbox',
-        'fc7_mbox_priorbox',
-        'conv6_2_mbox_priorbox',
-        'conv7_2_mbox_priorbox',
-        'conv8_2_mbox_priorbox',
-        'pool6_mbox_priorbox']
-    priors = []
-    for prior_box_name in prior_box_names:
-        layer = model.get_layer(prior_box_name)
-        if layer is not None:
-            priors.append(layer.prior_boxes)
-    priors = np.vstack(priors)
-
-    # Set up bounding box utility.
-    bbox_util = BBoxUtility(config.num_classes(), priors)
-
-    # Set up dataset interface.
-    dataset = SSDDataset(
-        config,
-        bbox_util=bbox_util,
-        preproc=lambda x: x)
-
     # Set up keras callbacks.
     checkpoint_best = ModelCheckpoint(
         config.checkpoint_best('detect'),
@@ -136,27 +150,13 @@ def train(config):
         write_images=True)
 
     # Determine steps per epoch.
-    batch_size = config.detect_batch_size()
     steps_per_epoch = config.detect_steps_per_epoch()
     if not steps_per_epoch:
         steps_per_epoch = dataset.nb_train_samples // batch_size
 
-    # Set up validation generator.
-    val_batch_size = config.detect_val_batch_size()
-    validation_gen = None
-    validation_steps = None
-    if config.detect_do_validation():
-        validation_gen = dataset.generate_ssd(
-            batch_size=val_batch_size,
-            is_training=False
-        )
-        validation_steps = dataset.nb_test_samples // val_batch_size
-
     # Fit the model.
     model.fit_generator(
-        dataset.generate_ssd(
-            batch_size=batch_size,
-            is_training=True),
+        train_gen,
         steps_per_epoch=steps_per_epoch,
         epochs=config.detect_num_epochs(),
         verbose=1,
@@ -178,6 +178,7 @@ def predict(config):
     sys.path.append('../python')
     import openem
     from openem import Detect
+    from openem_train.util.frame_store import iterate_frames
 
     # Make a dict to contain detection results.
     det_data = {
@@ -204,9 +205,14 @@ def predict(config):
     if config.config.has_option('Detect', 'Threshold'):
         threshold= config.config.getfloat('Detect', 'Threshold')
 
+    if config.use_frame_store():
+        rois = iterate_frames(store_dir=config.train_rois_store_dir())
+    else:
+        rois = iterate_frames(paths=config.train_rois())
+
     images=set()
-    for img_path in config.train_rois():
-        images.add(os.path.basename(os.path.dirname(img_path)))
+    for video_id, frame, img in rois:
+        images.add(video_id)
         if limit:
             print(f"Limiting process to {limit} files.")
             if len(images) >= limit:
@@ -214,8 +220,6 @@ def predict(config):
             else:
                 count = count + 1
 
-
-        img = cv2.imread(img_path)
         # Add image to processing queue.
         detector.addImage(img)
 
@@ -225,9 +229,6 @@ def predict(config):
         # Write detection to dict.
         for dets in detections:
             for det in dets:
-                path, f = os.path.split(img_path)
-                frame, _ = os.path.splitext(f)
-                video_id = os.path.basename(os.path.normpath(path))
                 x, y, w, h = det.location
                 if det.confidence >= threshold:
                     det_data['video_id'].append(video_id)
@@ -238,7 +239,7 @@ def predict(config):
                     det_data['h'].append(h)
                     det_data['det_conf'].append(det.confidence)
                     det_data['det_species'].append(det.species)
-        print("Finished detection on {}".format(img_path))
+        print("Finished detection on {} frame {}".format(video_id, frame))
 
     # Write detections to csv.
     os.makedirs(config.inference_dir(), exist_ok=True)
@@ -24,6 +24,25 @@ from collections import defaultdict
 import pandas as pd
 import numpy as np
 
+def _image_from_array(img, data):
+    """Copies an image array into an openem Image.
+
+    Bindings built with the buffer typemap of openem.i copy the array
+    directly, older bindings only accept a list of pixel values.
+
+    # Arguments
+        img: openem.Image object.
+        data: Height by width by channels uint8 array.
+
+    # Returns
+        openem error code.
+    """
+    height, width, channels = data.shape
+    try:
+        return img.FromData(data, width, height, channels)
+    except TypeError:
+        return img.FromData(data.reshape(-1).tolist(), width, height, channels)
+
 def _save_model(config, model):
     """Loads best weights and converts to protobuf file.
 
@@ -57,6 +76,14 @@ def train(config):
     os.makedirs(config.checkpoints_dir('find_ruler'), exist_ok=True)
     os.makedirs(tensorboard_dir, exist_ok=True)
 
+    # Set up dataset interface. The batch loaders fork their workers, so
+    # start them before a tensorflow session exists.
+    dataset = UnetDataset(config)
+    train_gen = dataset.generate(
+        batch_size=config.find_ruler_batch_size()).start()
+    validation_gen = dataset.generate_validation(
+        batch_size=config.find_ruler_val_batch_size()).start()
+
     # Build the unet model.
     model = unet_model(
         input_shape=(config.find_ruler_height(), config.find_ruler_width(), 3)
@@ -72,9 +99,6 @@ def train(config):
         )
         model.load_weights(checkpoint)
 
-    # Set up dataset interface.
-    dataset = UnetDataset(config)
-
     # Define learning rate schedule.
     def schedule(epoch):
         if epoch < 10:
@@ -115,7 +139,7 @@ def train(config):
     # Fit the model.
     model.summary()
     model.fit_generator(
-        dataset.generate(batch_size=config.find_ruler_batch_size()),
+        train_gen,
         steps_per_epoch=60,
         epochs=config.find_ruler_num_epochs(),
         verbose=1,
@@ -125,9 +149,7 @@ def train(config):
             tensorboard,
             lr_sched
         ],
-        validation_data=dataset.generate_validation(
-            batch_size=config.find_ruler_val_batch_size()
-        ),
+        validation_data=validation_gen,
         validation_steps=len(dataset.test_idx)//config.find_ruler_val_batch_size(),
         initial_epoch=initial_epoch
     )
@@ -144,6 +166,7 @@ def predict(config):
     # Import deployment library.
     sys.path.append('../python')
     import openem
+    from openem_train.util.frame_store import FrameStore
 
     # Make a dict to contain find ruler results.
     find_ruler_data = {
@@ -166,12 +189,25 @@ def predict(config):
     if not status == openem.kSuccess:
         raise IOError("Failed to initialize ruler mask finder!")
 
-    for img_path in config.train_imgs():
+    # Images are either files or frames in a frame store.
+    store = None
+    if config.use_frame_store():
+        store = FrameStore(config.train_imgs_store_dir())
+        sources = [(v, f) for v in store.video_ids() for f in store.frames(v)]
+    else:
+        sources = config.train_imgs()
+
+    for source in sources:
 
         # Get video id from path.
-        path, fname = os.path.split(img_path)
-        frame, _ = os.path.splitext(fname)
-        video_id = os.path.basename(os.path.normpath(path))
+        if store is None:
+            img_path = source
+            path, fname = os.path.split(img_path)
+            frame, _ = os.path.splitext(fname)
+            video_id = os.path.basename(os.path.normpath(path))
+        else:
+            video_id, frame = source
+            img_path = "{} frame {}".format(video_id, frame)
 
         if num_masks[video_id] > 200:
             continue
@@ -182,7 +218,11 @@ def predict(config):
 
         # Load in image.
         img = openem.Image()
-        status = img.FromFile(img_path)
+        if store is None:
+            status = img.FromFile(img_path)
+        else:
+            data = store.read(video_id, frame)
+            status = _image_from_array(img, data)
         if not status == openem.kSuccess:
             continue
 
@@ -20,7 +20,7 @@ __license__ = "GPLv3"
 import os
 import random
 from collections import namedtuple
-from multiprocessing.pool import ThreadPool
+from functools import partial
 import pandas as pd
 import numpy as np
 import scipy.misc
@@ -29,6 +29,9 @@ from keras.applications.inception_v3 import preprocess_input
 from keras.utils import to_categorical
 from openem_train.util import img_augmentation
 from openem_train.util import utils
+from openem_train.util.frame_store import FrameStore
+from openem_train.util.image_cache import ImageCache
+from openem_train.util.loader import loader_for
 
 CLASS_NO_FISH_ID = 0
 CLASS_HAND_OVER_ID = 1
@@ -81,7 +84,7 @@ class SampleCfg:
         self.contrast = contrast
         self.saturation = saturation
         self.blurred_by_downscaling = blurred_by_downscaling
-        self.cache_img = False
+        self.cache_img = True
 
         w = np.clip(fish_classification.w, 200, 360)
         x = fish_classification.x
@@ -101,6 +104,14 @@ class SampleCfg:
     def __lt__(self, other):
         return True
 
+def _rand_or_05():
+    """Returns a random value in [0, 1) half of the time, otherwise 0.5
+       which leaves the augmentation unchanged.
+    """
+    if random.random() > 0.5:
+        return random.random()
+    return 0.5
+
 def guess_species(known_species, frame_id):
     """Returns a guess at a species based frames of known species and the
        frame with a detection having unknown species.
@@ -159,7 +170,16 @@ class InceptionDataset:
                 self.test_data_for_clip[d.video_id] = []
             self.test_data_for_clip[d.video_id].append(d)
 
-        self.crops_cache = {}
+        # Decoded ROIs reused across batches. Samples are repeated for
+        # class balancing so the same frame is read often. Each forked
+        # loader worker fills its own copy, so the configured size is split
+        # between the workers of the training and validation loaders.
+        num_loaders = 2 if config.classify_do_validation() else 1
+        num_procs = num_loaders * max(1, config.loader_num_workers())
+        self.crops_cache = ImageCache(config.classify_cache_mb() / num_procs)
+        self.frame_store = None
+        if config.use_frame_store():
+            self.frame_store = FrameStore(config.train_rois_store_dir())
 
         print('train samples: {} test samples {}'.format(len(self.train_data), len(self.test_data)))
 
@@ -186,84 +206,60 @@ class InceptionDataset:
         length = pd.read_csv(self.config.length_path())
         cover = pd.read_csv(self.config.cover_path())
         detections = pd.read_csv(self.config.detect_inference_path())
-        data = []
-
-        # Load in length data.
+        best = utils.best_detection_index(detections)
+        best = best[['x', 'y', 'w']].add_prefix('det_').reset_index()
+
+        def _samples(rows, species, cover_class, repeats):
+            """Returns FishClassification list with each row repeated,
+               keeping the order of the rows.
+            """
+            no_fish = (cover_class == CLASS_NO_FISH_ID).values
+            rows = pd.DataFrame({
+                'video_id': rows['video_id'].values,
+                'frame': rows['frame'].values,
+                'x': np.where(no_fish, 0, rows['det_x'].values),
+                'y': np.where(no_fish, 0, rows['det_y'].values),
+                'w': np.where(no_fish, 0, rows['det_w'].values),
+                'species_class': np.where(no_fish, 0, species),
+                'cover_class': cover_class.values,
+            })
+            rows = rows.iloc[np.repeat(np.arange(len(rows)), repeats)]
+            return [FishClassification(*r) for r in rows.itertuples(
+                index=False, name=None)]
+
+        # Load in length data. Rows with a fish and no detection are
+        # dropped by giving them zero repeats.
+        length = length.merge(best, how='left', on=['video_id', 'frame'])
+        has_det = length['det_x'].notna().values
+        is_fish = (length['species_id'] != 0).values
         known_species = {}
-        for _, row in length.iterrows():
-            if row['species_id'] == 0:
-                for _ in range(repeat_samples[CLASS_NO_FISH_ID]):
-                    data.append(
-                        FishClassification(
-                            video_id=row['video_id'],
-                            frame=row['frame'],
-                            x=0,
-                            y=0,
-                            w=0,
-                            species_class=0,
-                            cover_class=CLASS_NO_FISH_ID
-                        )
-                    )
-            else:
-                if row['video_id'] not in known_species:
-                    known_species[row['video_id']] = {}
-                known_species[row['video_id']][row['frame']] = row['species_id']
-                det = utils.get_best_detection(
-                    row['video_id'],
-                    row['frame'],
-                    detections
-                )
-                if not det is None:
-                    for _ in range(repeat_samples[CLASS_FISH_CLEAR_ID]):
-                        data.append(
-                            FishClassification(
-                                video_id=det['video_id'],
-                                frame=det['frame'],
-                                x=det['x'],
-                                y=det['y'],
-                                w=det['w'],
-                                species_class=row['species_id'],
-                                cover_class=CLASS_FISH_CLEAR_ID
-                            )
-                        )
+        fish = length[is_fish]
+        for vid, frame, spc in zip(fish['video_id'].tolist(),
+                                   fish['frame'].tolist(),
+                                   fish['species_id'].tolist()):
+            known_species.setdefault(vid, {})[frame] = spc
+        length_cover = pd.Series(
+            np.where(is_fish, CLASS_FISH_CLEAR_ID, CLASS_NO_FISH_ID))
+        length_repeats = np.where(
+            is_fish,
+            np.where(has_det, repeat_samples[CLASS_FISH_CLEAR_ID], 0),
+            repeat_samples[CLASS_NO_FISH_ID])
+        data = _samples(length, length['species_id'].values,
+                        length_cover, length_repeats)
 
         # Load in cover data.
-        for _, row in cover.iterrows():
-            if row['cover'] == CLASS_NO_FISH_ID:
-                for _ in range(repeat_samples[CLASS_NO_FISH_ID]):
-                    data.append(
-                        FishClassification(
-                            video_id=row['video_id'],
-                            frame=row['frame'],
-                            x=0,
-                            y=0,
-                            w=0,
-                            species_class=0,
-                            cover_class=CLASS_NO_FISH_ID
-                        )
-                    )
-            else:
-                det = utils.get_best_detection(
-                    row['video_id'],
-                    row['frame'],
-                    detections
-                )
-                if not det is None:
-                    species_class = guess_species(
-                        known_species[row['video_id']],
-                        row['frame'])
-                    for _ in range(repeat_samples[row['cover']]):
-                        data.append(
-                            FishClassification(
-                                video_id=det['video_id'],
-                                frame=det['frame'],
-                                x=det['x'],
-                                y=det['y'],
-                                w=det['w'],
-                                species_class=species_class,
-                                cover_class=row['cover']
-                            )
-                        )
+        cover = cover.merge(best, how='left', on=['video_id', 'frame'])
+        has_det = cover['det_x'].notna().values
+        is_fish = (cover['cover'] != CLASS_NO_FISH_ID).values
+        cover_species = np.zeros(len(cover), dtype=object)
+        for idx in np.flatnonzero(is_fish & has_det):
+            cover_species[idx] = guess_species(
+                known_species[cover['video_id'].iat[idx]],
+                cover['frame'].iat[idx])
+        cover_repeats = np.where(
+            is_fish & ~has_det, 0,
+            cover['cover'].map(repeat_samples).values)
+        data += _samples(cover, cover_species, cover['cover'], cover_repeats)
         return data, known_species
 
     def generate_x(self, cfg: SampleCfg):
@@ -275,12 +271,20 @@ class InceptionDataset:
         # Returns
             Randomized crop.
         """
-        img = scipy.misc.imread(
-            self.config.train_roi_img(
-                cfg.fish_classification.video_id,
-                cfg.fish_classification.frame
-            )
-        )
+        video_id = cfg.fish_classification.video_id
+        frame = cfg.fish_classification.frame
+        if self.frame_store is not None:
+            # Frame store is BGR, training data is RGB. Reads are memory
+            # mapped so there is nothing to cache.
+            img = self.frame_store.read(video_id, frame)[:, :, ::-1]
+        else:
+            def _load():
+                return scipy.misc.imread(
+                    self.config.train_roi_img(video_id, frame))
+            if cfg.cache_img:
+                img = self.crops_cache.get((video_id, frame), _load)
+            else:
+                img = _load()
 
         crop = utils.get_image_crop(
             full_rgb=img, rect=cfg.rect,
@@ -326,57 +330,79 @@ class InceptionDataset:
             cfg.fish_classification.cover_class
         )
 
-    def generate(self, batch_size, skip_pp=False):
-        """Generator function for inception training data.
+    def _make_batch(self, cfgs, skip_pp):
+        """Makes a batch from sample configs.
 
         # Arguments
-            batch_size: Batch size.
+            cfgs: List of SampleCfg objects.
             skip_pp: Boolean indicating whether to skip preprocessing.
         """
-        pool = ThreadPool(processes=8)
-        samples_to_process = []  # type: [SampleCfg]
+        batch_samples = [self.generate_xy(cfg) for cfg in cfgs]
+        x_batch = np.array([batch_sample[0] for batch_sample in batch_samples])
+        y_batch_species = np.array([batch_sample[1]
+            if batch_sample[1] is not None else 0 for batch_sample in batch_samples])
+        y_batch_cover = np.array([batch_sample[2] for batch_sample in batch_samples])
+        if not skip_pp:
+            x_batch = preprocess_input(x_batch)
+            y_batch_species = to_categorical(
+                y_batch_species,
+                num_classes=self.config.num_classes()
+            )
+            y_batch_cover = to_categorical(
+                y_batch_cover,
+                num_classes=3
+            )
+        return x_batch, {'cat_species': y_batch_species, 'cat_cover': y_batch_cover}
 
-        def rand_or_05():
-            if random.random() > 0.5:
-                return random.random()
-            return 0.5
+    def train_batch(self, batch_size, skip_pp, batch_idx):
+        """Makes a randomly sampled and augmented training batch.
 
-        while True:
+        # Arguments
+            batch_size: Batch size.
+            skip_pp: Boolean indicating whether to skip preprocessing.
+            batch_idx: Index of the batch, unused as batches are random.
+        """
+        cfgs = []
+        for _ in range(batch_size):
             sample = random.choice(self.train_data)  # type: FishClassification
-            cfg = SampleCfg(
+            cfgs.append(SampleCfg(
                 self.config,
                 fish_classification=sample,
-                saturation=rand_or_05(),
-                contrast=rand_or_05(),
-                brightness=rand_or_05(),
-                color_shift=rand_or_05(),
+                saturation=_rand_or_05(),
+                contrast=_rand_or_05(),
+                brightness=_rand_or_05(),
+                color_shift=_rand_or_05(),
                 shift_x_ratio=random.uniform(-0.1, 0.1),
                 shift_y_ratio=random.uniform(-0.1, 0.1),
                 angle=random.uniform(-10.0, 10.0),
                 hflip=random.choice([True, False]),
                 vflip=random.choice([True, False]),
                 blurred_by_downscaling=np.random.choice([1, 1, 1, 1, 1, 1, 1, 1, 2, 2.5, 3, 4])
-            )
-            samples_to_process.append(cfg)
-
-            if len(samples_to_process) == batch_size:
-                batch_samples = pool.map(self.generate_xy, samples_to_process)
-                x_batch = np.array([batch_sample[0] for batch_sample in batch_samples])
-                y_batch_species = np.array([batch_sample[1] 
-                    if batch_sample[1] is not None else 0 for batch_sample in batch_samples])
-                y_batch_cover = np.array([batch_sample[2] for batch_sample in batch_samples])
-                if not skip_pp:
-                    x_batch = preprocess_input(x_batch)
-                    y_batch_species = to_categorical(
-                        y_batch_species,
-                        num_classes=self.config.num_classes()
-                    )
-                    y_batch_cover = to_categorical(
-                        y_batch_cover,
-                        num_classes=3
-                    )
-                samples_to_process = []
-                yield x_batch, {'cat_species': y_batch_species, 'cat_cover': y_batch_cover}
+            ))
+        return self._make_batch(cfgs, skip_pp)
+
+    def test_batch(self, batch_size, skip_pp, batch_idx):
+        """Makes a validation batch, cycling through the validation data.
+
+        # Arguments
+            batch_size: Batch size.
+            skip_pp: Boolean indicating whether to skip preprocessing.
+            batch_idx: Index of the batch.
+        """
+        start = (batch_idx % max(1, self.test_batches(batch_size))) * batch_size
+        cfgs = [SampleCfg(self.config, fish_classification=sample)
+                for sample in self.test_data[start:start + batch_size]]
+        return self._make_batch(cfgs, skip_pp)
+
+    def generate(self, batch_size, skip_pp=False):
+        """Generator function for inception training data.
+
+        # Arguments
+            batch_size: Batch size.
+            skip_pp: Boolean indicating whether to skip preprocessing.
+        """
+        return loader_for(
+            self.config, partial(self.train_batch, batch_size, skip_pp))
 
     def generate_test(self, batch_size, skip_pp=False):
         """Generator function for inception validation data.
@@ -385,29 +411,6 @@ class InceptionDataset:
             batch_size: Batch size.
             skip_pp: Boolean indicating whether to skip preprocessing.
         """
-        pool = ThreadPool(processes=8)
-        samples_to_process = []  # type: [SampleCfg]
-
-        while True:
-            for sample in self.test_data[:int(len(self.test_data) // batch_size) * batch_size]:
-                cfg = SampleCfg(self.config, fish_classification=sample)
-                samples_to_process.append(cfg)
-
-                if len(samples_to_process) == batch_size:
-                    batch_samples = pool.map(self.generate_xy, samples_to_process)
-                    x_batch = np.array([batch_sample[0] for batch_sample in batch_samples])
-                    y_batch_species = np.array([batch_sample[1] 
-                        if batch_sample[1] is not None else 0 for batch_sample in batch_samples])
-                    y_batch_cover = np.array([batch_sample[2] for batch_sample in batch_samples])
-                    if not skip_pp:
-                        x_batch = preprocess_input(x_batch)
-                        y_batch_species = to_categorical(
-                            y_batch_species,
-                            num_classes=self.config.num_classes()
-                        )
-                        y_batch_cover = to_categorical(
-                            y_batch_cover,
-                            num_classes=3
-                        )
-                    samples_to_process = []
-                    yield x_batch, {'cat_species': y_batch_species, 'cat_cover': y_batch_cover}
+        return loader_for(
+            self.config, partial(self.test_batch, batch_size, skip_pp),
+            seed_offset=1)
@@ -18,147 +18,436 @@ __license__ = "GPLv3"
 """
 
 import os
-import sys
+import time
 from collections import defaultdict
+from collections import Counter
 from multiprocessing import Pool
-from multiprocessing.sharedctypes import Value
-from multiprocessing.context import TimeoutError
-from ctypes import c_longlong
 from multiprocessing.pool import ThreadPool
-from multiprocessing import cpu_count
 from functools import partial
+from functools import lru_cache
 import pandas as pd
-import scipy.misc
-import skimage
 from cv2 import VideoCapture
+from cv2 import imread
 from cv2 import imwrite
+from cv2 import remap
+from cv2 import INTER_CUBIC
+from cv2 import BORDER_REPLICATE
+from cv2 import IMWRITE_JPEG_QUALITY
+from cv2 import IMWRITE_PNG_COMPRESSION
+from cv2 import IMWRITE_WEBP_QUALITY
 import progressbar
 
-import numpy as np
+from openem_train.util.frame_store import FrameStore
+from openem_train.util.roi_transform import RoiTransform
 
-# Current value for multi-processed loops
-current=Value(c_longlong, 0)
+def _imwrite_params(ext, quality):
+    """Gets cv2.imwrite parameters for a codec quality.
 
-def _extract_images(vid, train_imgs_dir):
+    # Arguments
+        ext: Image file extension, determines the codec.
+        quality: Codec quality, None for the codec default.
+
+    # Returns
+        List of parameters for cv2.imwrite.
+    """
+    if quality is None:
+        return []
+    if ext in ('jpg', 'jpeg'):
+        return [IMWRITE_JPEG_QUALITY, quality]
+    if ext == 'png':
+        return [IMWRITE_PNG_COMPRESSION, quality]
+    if ext == 'webp':
+        return [IMWRITE_WEBP_QUALITY, quality]
+    return []
+
+def _extract_images(job, train_imgs_dir, ext='jpg', params=None, stride=1,
+                    store=None):
     """Extracts images from a single video.
 
     # Arguments
-        vid: Path to video.
+        job: Tuple containing path to video and set of frames to extract
+            besides every stride-th frame, or None.
         train_imgs_dir: Path to output images.
+        ext: Output image file extension.
+        params: Parameters passed to cv2.imwrite.
+        stride: Stride between extracted frames, 0 to only extract the
+            frames of the job.
+        store: FrameStore to write to instead of image files, or None.
 
     # Returns
-        Tuple containing video ID and number of frames.
+        Tuple containing video ID, number of frames and (width, height)
+        of the frames.
     """
+    vid, frames = job
     vid_id, _ = os.path.splitext(os.path.basename(vid))
+    if store is not None:
+        with store.writer(vid_id) as writer:
+            return _read_video(vid, frames, stride, writer.add)
     img_dir = os.path.join(train_imgs_dir, vid_id)
     os.makedirs(img_dir, exist_ok=True)
+
+    def _write(frame, img):
+        img_path = os.path.join(img_dir, '{:04}.{}'.format(frame, ext))
+        imwrite(img_path, img, params or [])
+    return _read_video(vid, frames, stride, _write)
+
+def _read_video(vid, frames, stride, write):
+    """Decodes the wanted frames of a video.
+
+    # Arguments
+        vid: Path to video.
+        frames: Set of frames to extract besides every stride-th frame,
+            or None.
+        stride: Stride between extracted frames, 0 to only extract frames.
+        write: Function called with frame number and image of each frame.
+
+    # Returns
+        Tuple containing video ID, number of frames and (width, height)
+        of the frames.
+    """
+    vid_id, _ = os.path.splitext(os.path.basename(vid))
     reader = VideoCapture(vid)
+    dims = None
     frame = 0
     while reader.isOpened():
-        ret, img = reader.read()
+        wanted = ((stride > 0 and frame % stride == 0) or
+                  (frames is not None and frame in frames))
+        # Frames that are not kept are grabbed without being retrieved.
+        if wanted:
+            ret, img = reader.read()
+        else:
+            ret = reader.grab()
         if not ret:
             break
-        img_path = os.path.join(img_dir, '{:04}.jpg'.format(frame))
-        imwrite(img_path, img)
+        if wanted:
+            write(frame, img)
+            dims = (img.shape[1], img.shape[0])
         frame += 1
-    current.value += 1
-    return (vid_id, frame)
+    reader.release()
+    return (vid_id, frame, dims)
+
+def _annotated_frames(config):
+    """Finds annotated frames for each video.
+
+    # Arguments
+        config: ConfigInterface object.
+
+    # Returns
+        Dict mapping video ID to set of annotated frames, padded by the
+        detection frame jitter.
+    """
+    jitter = 0
+    if config.config.has_option('Detect', 'FrameJitter'):
+        jitter = config.detect_frame_jitter()
+    annotations = [pd.read_csv(config.length_path())]
+    if os.path.exists(config.cover_path()):
+        annotations.append(pd.read_csv(config.cover_path()))
+    annotations = pd.concat(
+        [a[['video_id', 'frame']] for a in annotations]).dropna()
+    frames = defaultdict(set)
+    for video_id, group in annotations.groupby('video_id'):
+        annotated = group['frame'].astype(int).unique()
+        for offset in range(-jitter, jitter + 1):
+            frames[video_id].update(annotated + offset)
+    return frames
+
+def _expected_frames(num_frames, frames, stride):
+    """Returns frames that an extraction of a video is expected to produce.
+    """
+    expected = set(range(0, num_frames, stride)) if stride > 0 else set()
+    if frames is not None:
+        expected.update(f for f in frames if 0 <= f < num_frames)
+    return expected
+
+def _is_extracted(img_dir, num_frames, frames, ext, stride, store=None):
+    """Checks whether all expected images of a video are on disk.
+
+    # Arguments
+        img_dir: Directory of images for the video.
+        num_frames: Number of frames in the video.
+        frames: Set of frames to extract besides every stride-th frame,
+            or None.
+        ext: Image file extension.
+        stride: Stride between extracted frames, 0 to only extract frames.
+        store: FrameStore holding the images instead, or None.
+    """
+    expected = _expected_frames(num_frames, frames, stride)
+    if store is not None:
+        vid_id = os.path.basename(img_dir)
+        return expected.issubset(store.frames(vid_id))
+    if not os.path.isdir(img_dir):
+        return False
+    existing = set(os.listdir(img_dir))
+    for frame in expected:
+        if '{:04}.{}'.format(frame, ext) not in existing:
+            return False
+    return True
 
 def extract_images(config):
     """Extracts images from all videos.
 
+    Videos that already have a num_frames entry and all of their images on
+    disk are skipped, so an interrupted extraction can be resumed.
+
     # Arguments
         config: ConfigInterface object.
     """
 
     # Create directories to store images.
     os.makedirs(config.train_imgs_dir(), exist_ok=True)
+    ext = config.train_img_ext()
+    stride = config.extract_frame_stride()
+    params = _imwrite_params(ext, config.extract_quality())
+    # Training reads the annotated frames and their jittered neighbours,
+    # so they are extracted whatever the stride.
+    annotated = None
+    if config.extract_annotated_only() or stride > 1:
+        annotated = _annotated_frames(config)
+    if config.extract_annotated_only():
+        stride = 0
+    store = None
+    if config.use_frame_store():
+        store = FrameStore(config.train_imgs_store_dir())
+    manifest = config.media_manifest()
+
+    # Load number of frames of previously extracted videos.
+    done = {}
+    if os.path.exists(config.num_frames_path()):
+        previous = pd.read_csv(config.num_frames_path())
+        done = dict(zip(previous['video_id'], previous['num_frames']))
+
+    # Find videos that still need extracting.
+    jobs = []
+    vid_frames = []
+    for vid in config.train_vids():
+        vid_id, _ = os.path.splitext(os.path.basename(vid))
+        frames = None
+        if annotated is not None:
+            frames = annotated.get(vid_id, set())
+        img_dir = os.path.join(config.train_imgs_dir(), vid_id)
+        if vid_id in done and _is_extracted(img_dir, done[vid_id], frames,
+                                            ext, stride, store):
+            vid_frames.append((vid_id, done[vid_id]))
+        else:
+            jobs.append((vid, frames))
+    print("Extracting {} videos, {} already extracted.".format(
+        len(jobs), len(vid_frames)))
+
+    # Record progress as each video completes so it can be resumed.
+    with open(config.num_frames_path(), 'w') as num_frames_file:
+        num_frames_file.write('video_id,num_frames\n')
+        for vid_id, frames in vid_frames:
+            num_frames_file.write('{},{}\n'.format(vid_id, frames))
+        num_frames_file.flush()
+
+        # Make a pool to convert videos.
+        func = partial(
+            _extract_images,
+            train_imgs_dir=config.train_imgs_dir(),
+            ext=ext,
+            params=params,
+            stride=stride,
+            store=store)
+        bar = progressbar.ProgressBar(max_value=len(jobs),
+                                      redirect_stdout=True,
+                                      redirect_stderr=True)
+        with Pool(min(config.extract_num_workers(), max(1, len(jobs)))) as pool:
+            for vid_id, num_frames, dims in bar(
+                    pool.imap_unordered(func, jobs)):
+                vid_frames.append((vid_id, num_frames))
+                num_frames_file.write('{},{}\n'.format(vid_id, num_frames))
+                num_frames_file.flush()
+                if store is None:
+                    manifest.update_video('imgs', config.train_imgs_dir(),
+                                          vid_id, [ext], dims)
+
+    # Rewrite number of frames to csv in a stable order.
+    df = pd.DataFrame(vid_frames, columns=['video_id', 'num_frames'])
+    df = df.sort_values('video_id')
+    df.to_csv(config.num_frames_path(), index=False)
 
-    # Make a pool to convert videos.
-    pool = Pool(24)
-    current.value = 0
+def _extract_roi_batch(job, read, maps_for, roi_path=None, params=None):
+    """Extracts ROIs from a batch of frames of a single video.
 
-    # Start converting images.
-    func = partial(_extract_images, train_imgs_dir = config.train_imgs_dir())
-    vid_list=config.train_vids()
-    bar = progressbar.ProgressBar(max_value=len(vid_list),
-                                  redirect_stdout=True,
-                                  redirect_stderr=True)
-    ar = pool.map_async(func, vid_list)
-    vid_frames = None
-    while vid_frames == None:
-        try:
-            vid_frames = ar.get(2)
-        except TimeoutError as te:
-            pass
-        finally:
-            bar.update(current.value)
-
-
-    # Record total number of frames in each video.
-    vid_id, frames = list(map(list, zip(*vid_frames)))
-    num_frames = {
-        'video_id': vid_id,
-        'num_frames': frames
-    }
-
-    # Write number of frames to csv.
-    df = pd.DataFrame(num_frames)
-    df.to_csv(config.num_frames_path(), index=False)
+    # Arguments
+        job: Tuple containing video ID and list of frame numbers.
+        read: Function returning the image for a video ID and frame.
+        maps_for: Function returning cv2.remap tables for a video ID.
+        roi_path: Function returning output path for a video ID and frame,
+            or None to return the ROIs instead of writing them.
+        params: Parameters passed to cv2.imwrite.
+
+    # Returns
+        Tuple containing video ID, list of frame numbers and list of ROIs,
+        which is empty if the ROIs were written to files.
+    """
+    vid_id, frames = job
+    map1, map2 = maps_for(vid_id)
+    rois = []
+    for frame in frames:
+        roi = remap(read(vid_id, frame), map1, map2, INTER_CUBIC,
+                    borderMode=BORDER_REPLICATE)
+        if roi_path is None:
+            rois.append(roi)
+        else:
+            imwrite(roi_path(vid_id, frame), roi, params or [])
+    return vid_id, frames, rois
 
 def extract_rois(config):
     """Extracts region of interest.
 
+    Each frame is rectified and cropped around the ruler with the same
+    transform used for detection training. The transform of a video is
+    computed once and batches of frames are processed in parallel.
+
     # Arguments:
         config: ConfigInterface object.
     """
-    sys.path.append('../python')
-    import openem
-    import cv2
-
-    def _extract_roi(paths):
-        img_path, roi_path = paths
-        img = cv2.imread(img_path)
-        #roi = openem.Rectify(img, ((x1, y1), (x2, y2)))
-        
-        roi = np.copy(img[int(y1):int(y2),int(x1):int(x2)])
-        print("Saving ROI to: {}".format(roi_path))
-        #roi.ToFile(roi_path)
-        cv2.imwrite(roi_path, roi)
-
     # Create directories to store ROIs.
     os.makedirs(config.train_rois_dir(), exist_ok=True)
 
-    # Open find ruler results csv.
-    endpoints = pd.read_csv(config.find_ruler_inference_path())
+    # Load find ruler results.
+    roi_transform = RoiTransform(config)
+    dst_w = config.detect_width()
+    dst_h = config.detect_height()
+    num_workers = config.extract_num_workers()
+
+    # Find frames to extract for each video with ruler points.
+    store = None
+    if config.use_frame_store():
+        imgs = FrameStore(config.train_imgs_store_dir())
+        store = FrameStore(config.train_rois_store_dir())
+        vid_frames = {
+            vid_id: imgs.frames(vid_id)
+            for vid_id in imgs.video_ids()
+            if vid_id in roi_transform.ruler_points
+        }
+        read = imgs.read
+        roi_path = None
+        params = None
+    else:
+        img_paths = {}
+        vid_frames = defaultdict(list)
+        for img_path in config.train_imgs():
+            path, fname = os.path.split(img_path)
+            vid_id = os.path.basename(path)
+            if vid_id not in roi_transform.ruler_points:
+                continue
+            frame = int(os.path.splitext(fname)[0])
+            img_paths[(vid_id, frame)] = img_path
+            vid_frames[vid_id].append(frame)
+
+        def read(vid_id, frame):
+            return imread(img_paths[(vid_id, frame)])
+        for vid_id in vid_frames:
+            os.makedirs(os.path.join(config.train_rois_dir(), vid_id),
+                        exist_ok=True)
+        roi_path = config.train_roi_img
+        params = _imwrite_params(config.train_img_ext(),
+                                 config.extract_quality())
+
+    # Split videos into batches of frames, keeping batches of a video
+    # together so each video is written in order.
+    batch_size = config.extract_batch_size()
+    jobs = []
+    for vid_id in sorted(vid_frames):
+        frames = vid_frames[vid_id]
+        for idx in range(0, len(frames), batch_size):
+            jobs.append((vid_id, frames[idx:idx + batch_size]))
+    remaining = Counter(vid_id for vid_id, _ in jobs)
+
+    # Remap tables are reused by every batch of a video.
+    maps_for = lru_cache(maxsize=2 * num_workers)(
+        partial(roi_transform.maps_for_clip, dst_w=dst_w, dst_h=dst_h))
+    func = partial(
+        _extract_roi_batch,
+        read=read,
+        maps_for=maps_for,
+        roi_path=roi_path,
+        params=params)
+
+    # cv2 releases the GIL while decoding, warping and encoding so a
+    # thread pool scales without copying frames between processes.
+    bar = progressbar.ProgressBar(max_value=len(jobs),
+                                  redirect_stdout=True,
+                                  redirect_stderr=True)
+    manifest = config.media_manifest()
+    writer = None
+    num_rois = 0
+    start = time.time()
+    with ThreadPool(num_workers) as pool:
+        for vid_id, frames, rois in bar(pool.imap(func, jobs)):
+            num_rois += len(frames)
+            remaining[vid_id] -= 1
+            if store is not None:
+                if writer is None:
+                    writer = store.writer(vid_id)
+                for frame, roi in zip(frames, rois):
+                    writer.add(frame, roi)
+                if remaining[vid_id] == 0:
+                    writer.close()
+                    writer = None
+            elif remaining[vid_id] == 0:
+                manifest.update_video(
+                    'rois', config.train_rois_dir(), vid_id,
+                    [config.train_img_ext()], (dst_w, dst_h))
+    elapsed = time.time() - start
+    print("Extracted {} ROIs from {} videos in {:.1f}s ({:.1f} ROIs/s).".format(
+        num_rois, len(remaining), elapsed, num_rois / max(elapsed, 1e-9)))
+
+def _det_image_name(frame, det_idx, det_conf):
+    """Returns file name of a detection image.
 
-    # Build a map between video ID and list of enum containing image
-    # and roi paths.
-    lookup = {}
-    for img_path in config.train_imgs():
-        path, f = os.path.split(img_path)
-        vid_id = os.path.basename(path)
-        roi_dir = os.path.join(config.train_rois_dir(), vid_id)
-        os.makedirs(roi_dir, exist_ok=True)
-        roi_path = os.path.join(roi_dir, f)
-        if vid_id not in lookup:
-            lookup[vid_id] = []
-        lookup[vid_id].append((img_path, roi_path))
+    # Arguments
+        frame: Frame number.
+        det_idx: Index of the detection within its frame, so detections
+            with the same rounded confidence get different names.
+        det_conf: Detection confidence between 0 and 1.
+    """
+    return "{:04d}-det{}-conf{:04d}.jpg".format(
+        int(frame), int(det_idx), int(round(float(det_conf) * 1000)))
 
+def _extract_dets(job, rois_dir, ext, dets_dir, store=None):
+    """Extracts detection images from a single video.
 
-    bar = progressbar.ProgressBar(max_value=len(endpoints),
-                                  redirect_stdout=True,
-                                  redirect_stderr=True)
-    # Extract ROIs.
-    pool = ThreadPool(24) # Can't pickle _extract_roi so have to use ThreadPool
-    for _, row in bar(endpoints.iterrows()):
-        vid_id = row['video_id']
-        x1 = row['x1']
-        y1 = row['y1']
-        x2 = row['x2']
-        y2 = row['y2']
-        pool.map(_extract_roi, lookup[vid_id])
+    # Arguments
+        job: Tuple containing video ID and list of (frame, x, y, w, h,
+            det_conf) tuples sorted by frame.
+        rois_dir: Path to ROI images.
+        ext: File extension of ROI images.
+        dets_dir: Path to output detection images.
+        store: FrameStore containing ROIs to read instead of image files,
+            or None.
 
+    # Returns
+        Tuple containing video ID and number of detection images.
+    """
+    from openem.image import get_det_image
+    vid_id, dets = job
+    det_dir = os.path.join(dets_dir, vid_id)
+    os.makedirs(det_dir, exist_ok=True)
+    last_frame = None
+    roi = None
+    det_idx = 0
+    for frame, x, y, w, h, det_conf in dets:
+        # Each ROI is decoded once for all of its detections.
+        if frame == last_frame:
+            det_idx += 1
+        else:
+            det_idx = 0
+            if store is not None:
+                roi = store.read(vid_id, frame)
+            else:
+                roi_path = os.path.join(
+                    rois_dir, vid_id, "{:04d}.{}".format(frame, ext))
+                roi = imread(roi_path)
+                if roi is None:
+                    raise IOError("Failed to load image {}".format(roi_path))
+            last_frame = frame
+        det = get_det_image(roi, (x, y, w, h))
+        name = _det_image_name(frame, det_idx, det_conf)
+        imwrite(os.path.join(det_dir, name), det)
+    return vid_id, len(dets)
 
 def extract_dets(config):
     """Extracts detection images.
@@ -166,41 +455,48 @@ def extract_dets(config):
     # Arguments:
         config: ConfigInterface object.
     """
-    sys.path.append('../python')
-    import openem
-
     # Create directories to store detections.
     os.makedirs(config.train_dets_dir(), exist_ok=True)
 
     # Open the detection results csv.
     det_results = pd.read_csv(config.detect_inference_path())
 
-    bar = progressbar.ProgressBar(max_value=len(det_results),
-                                  redirect_stdout=True,
-                                  redirect_stderr=True)
-
     threshold=0
     if config.config.has_option('Detect', 'ExtractThreshold'):
         threshold= config.config.getfloat('Detect', 'ExtractThreshold')
+    det_results = det_results[det_results['det_conf'] >= threshold]
+    det_results = det_results.sort_values(['video_id', 'frame'], kind='stable')
+
+    # One job per video with its detections grouped by frame.
+    cols = ['frame', 'x', 'y', 'w', 'h', 'det_conf']
+    jobs = [
+        (vid_id, list(zip(group['frame'].astype(int),
+                          *[group[c].values for c in cols[1:]])))
+        for vid_id, group in det_results.groupby('video_id', sort=True)
+    ]
+
+    store = None
+    if config.use_frame_store():
+        store = FrameStore(config.train_rois_store_dir())
+    func = partial(
+        _extract_dets,
+        rois_dir=config.train_rois_dir(),
+        ext=config.train_img_ext(),
+        dets_dir=config.train_dets_dir(),
+        store=store)
 
     # Create the detection images.
-    for _, row in bar(det_results.iterrows()):
-
-        if row['det_conf'] < threshold:
-            continue
-
-        # Get the new path.
-        vid_id = row['video_id']
-        f = "{:04d}-conf{:04d}.jpg".format(row['frame'], row['det_conf'])
-        roi_path = os.path.join(config.train_rois_dir(), vid_id, f)
-        det_dir = os.path.join(config.train_dets_dir(), vid_id)
-        os.makedirs(det_dir, exist_ok=True)
-        det_path = os.path.join(det_dir, f)
-
-        # Extract detections.
-        print("Saving detection image to: {}".format(det_path))
-        roi = openem.Image()
-        roi.FromFile(roi_path)
-        rect = openem.Rect([row['x'], row['y'], row['w'], row['h']])
-        det = openem.GetDetImage(roi, rect)
-        det.ToFile(det_path)
+    bar = progressbar.ProgressBar(max_value=len(jobs),
+                                  redirect_stdout=True,
+                                  redirect_stderr=True)
+    manifest = config.media_manifest()
+    num_dets = 0
+    start = time.time()
+    with Pool(min(config.extract_num_workers(), max(1, len(jobs)))) as pool:
+        for vid_id, count in bar(pool.imap_unordered(func, jobs)):
+            num_dets += count
+            manifest.update_video(
+                'dets', config.train_dets_dir(), vid_id, ['jpg'])
+    elapsed = time.time() - start
+    print("Extracted {} detection images from {} videos in {:.1f}s.".format(
+        num_dets, len(jobs), elapsed))
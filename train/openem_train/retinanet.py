@@ -4,7 +4,6 @@ import subprocess
 import os
 import csv
 import pandas as pd
-import cv2
 import numpy as np
 
 from collections import namedtuple
@@ -12,6 +11,7 @@ from pprint import pprint
 
 from openem_train.util import utils
 from openem_train.util.roi_transform import RoiTransform
+from openem_train.util.frame_store import FrameStore
 from openem_train.util.img_augmentation import resizeAndFill
 
 import progressbar
@@ -41,6 +41,7 @@ def prep(config):
                         'id': idx})
     species_df = pd.DataFrame(columns=['species', 'id'], data=species)
     species_df.to_csv(species_csv, header=False, index=False)
+    retinanet_cols=['img_file', 'x1', 'y1', 'x2', 'y2', 'class_name']
 
     # Generate the annotations csv for retinanet; this is in the format
     # from the keras_retinanet.preprocessing.csv_generator module
@@ -63,113 +64,151 @@ def prep(config):
         lineMode = True
     elif all(x in keys for x in boxkeys):
         lineMode = False
-
-    retinanet_cols=['img_file', 'x1', 'y1', 'x2', 'y2', 'class_name']
-    retinanet_df = pd.DataFrame(columns=retinanet_cols)
-
-    bar = progressbar.ProgressBar(max_value=len(length), redirect_stdout=True)
-    # Iterate over each row in the length.csv and make a retinanet.csv
-    for sample, row in bar(length.iterrows()):
-        # Ignore no detections for retinanet csv
-        if row.species_id == 0:
+    else:
+        raise ValueError("Could not find line or box columns in {}!".format(
+            config.length_path()))
+
+    # Ignore no detections for retinanet csv
+    length = length[length.species_id != 0]
+
+    # Find the ROI image of each row (any ROI extension) and its size,
+    # reading image headers for unknown sizes.
+    rois = _roi_dims(config)
+    image_files = []
+    dims = np.zeros((len(length), 2), dtype=np.int64)
+    found = np.zeros(len(length), dtype=bool)
+    for idx, (video_id, frame) in enumerate(zip(length.video_id, length.frame)):
+        image_file = None
+        for ext in config.train_roi_exts():
+            path = os.path.join(config.train_rois_dir(), video_id,
+                                f"{frame:04d}.{ext}")
+            if path in rois:
+                image_file = path
+                break
+        image_files.append(image_file)
+        if image_file is None:
+            print(f"WARNING:\tCould not find ROI image for line {length.index[idx]}")
             continue
-
-
-        # Construct image path (either png or jpg)
-        jpg_image_file = os.path.join(config.train_rois_dir(),
-                                      row.video_id,
-                                      f"{row.frame:04d}.jpg")
-        png_image_file = os.path.join(config.train_rois_dir(),
-                                      row.video_id,
-                                      f"{row.frame:04d}.png")
-
-        if os.path.exists(jpg_image_file):
-            image_file = jpg_image_file
-        elif os.path.exists(png_image_file):
-            image_file = png_image_file
-
-        img_data = cv2.imread(image_file)
-
-        # TODO: Don't use detection width/height here, needs to be in
-        # image coordinates...
+        if rois[image_file][0] is None:
+            rois[image_file] = utils.image_size(image_file)
+        dims[idx] = rois[image_file]
+        found[idx] = True
+
+    # Species id in openem is 1-based index
+    species_id_0 = length.species_id.values.astype(np.int64) - 1
+    species_names = np.array(config.species())[species_id_0]
+
+    # OpenEM detection csv is in image coordinates, need to convert
+    # that to roi coordinates because that is what we train on.
+    # Logic is pretty similar for line+aspect ratio and box style
+    # annotations. Line endpoints or box corners are stacked per row.
+    if lineMode:
+        coords_image = np.stack((length[['x1', 'y1']].values,
+                                 length[['x2', 'y2']].values), axis=1)
+    else:
+        # Boxes are converted from x,y,w,h to 4 points representing
+        # each corner
+        coords_image = utils.batch_rotate_detections(length[boxkeys].values)
+    coords_image = coords_image.astype(np.float64)
+
+    # Transform all points of a video and ROI size at once. The transform
+    # only depends on those, so it is found once per group.
+    coords_roi = coords_image.copy()
+    groups = pd.DataFrame({
+        'video_id': length.video_id.values,
+        'w': dims[:, 0],
+        'h': dims[:, 1],
+    })[found].groupby(['video_id', 'w', 'h']).indices
+    found_idx = np.flatnonzero(found)
+    for (video_id, dst_w, dst_h), group_idx in groups.items():
+        rows = found_idx[group_idx]
         tform = roi_transform.transform_for_clip(
-            row.video_id,
-            dst_w=img_data.shape[1],
-            dst_h=img_data.shape[0])
-
-        # Species id in openem is 1-based index
-        species_id_0 = row.species_id - 1
-        species_name = config.species()[species_id_0]
-
-        # OpenEM detection csv is in image coordinates, need to convert
-        # that to roi coordinates because that is what we train on.
-        # Logic is pretty similar for line+aspect ratio and box style
-        # annotations
-        if lineMode:
-            aspect_ratio = config.aspect_ratios()[species_id_0]
-            coords_image = np.array([[row.x1,
-                                      row.y1],
-                                     [row.x2,
-                                      row.y2]])
-            if tform:
-                coords_roi = tform.inverse(coords_image)
-            else:
-                # There is no transform
-                coords_roi = coords_image
-            coords_box0, coords_box1 = utils.bbox_for_line(coords_roi[0,:],
-                                                           coords_roi[1,:],
-                                                           aspect_ratio)
-        else:
-            # Make the row a detection object (in image coords)
-            detection_image = FishBoxDetection(
-                video_id=row.video_id,
-                frame=row.frame,
-                x=row.x, y=row.y,
-                width=row.width,
-                height=row.height,
-                theta=row.theta,
-                class_id=row.species_id
-            )
-            rotated_detection_image = utils.rotate_detection(detection_image)
-            # Box is now converted from x,y,w,h to 4 points representing each
-            # corner
-            # We translate all 4 points
-            if tform:
-                coords_roi = tform.inverse(rotated_detecion_image)
-            else:
-                # There is no transform
-                coords_roi = rotated_detection_image
-
-            topLeftIdx,bottomRightIdx=utils.find_corners(coords_roi)
-            # These are now the diagnol representing the bounding box.
-            coords_box0=coords_roi[topLeftIdx]
-            coords_box1=coords_roi[bottomRightIdx]
-
-
-        # Coords are ints for retinanet
-        coords_box0=np.round(coords_box0).astype(np.int)
-        coords_box1=np.round(coords_box1).astype(np.int)
-
-        zero=np.array([0,0])
-        negative=np.max([coords_box0 < zero, coords_box1 < zero])
-
-        if negative == True:
-            print(f"WARNING:\tLocalization went off ROI, line {sample}")
-            print(f"\t\t {row.video_id}, frame={row.frame}")
-            continue
-
-        # Make the datum and append it to the big dataframe
-        datum={'img_file' : image_file,
-               'class_name' : species_name,
-               'x1': coords_box0[0],
-               'y1': coords_box0[1],
-               'x2': coords_box1[0],
-               'y2': coords_box1[1]}
+            video_id, dst_w=dst_w, dst_h=dst_h)
+        if tform:
+            points = coords_image[rows].reshape(-1, 2)
+            coords_roi[rows] = tform.inverse(points).reshape(
+                len(rows), -1, 2)
+        # else there is no transform
+
+    # Find the diagonal representing the bounding box of each row.
+    if lineMode:
+        aspect_ratios = np.array(config.aspect_ratios())[species_id_0]
+        coords_box = utils.batch_bbox_for_line(coords_roi[:, 0],
+                                               coords_roi[:, 1],
+                                               aspect_ratios)
+    else:
+        topLeftIdx,bottomRightIdx=utils.batch_find_corners(coords_roi)
+        rows = np.arange(len(coords_roi))
+        coords_box = np.stack((coords_roi[rows, topLeftIdx],
+                               coords_roi[rows, bottomRightIdx]), axis=1)
+
+    # Coords are ints for retinanet
+    coords_box = np.round(coords_box).astype(np.int64)
+
+    negative = (coords_box < 0).any(axis=(1, 2)) & found
+    for idx in np.flatnonzero(negative):
+        print(f"WARNING:\tLocalization went off ROI, line {length.index[idx]}")
+        print(f"\t\t {length.video_id.values[idx]}, frame={length.frame.values[idx]}")
+
+    keep = found & ~negative
+    if config.use_frame_store():
+        _write_store_rois(config,
+                          length.video_id.values[keep],
+                          length.frame.values[keep])
+    retinanet_df = pd.DataFrame({
+        'img_file': np.array(image_files, dtype=object)[keep],
+        'x1': coords_box[keep, 0, 0],
+        'y1': coords_box[keep, 0, 1],
+        'x2': coords_box[keep, 1, 0],
+        'y2': coords_box[keep, 1, 1],
+        'class_name': species_names[keep],
+    }, columns=retinanet_cols)
+    retinanet_df.to_csv(retinanet_csv, index=False, header=False)
 
-        retinanet_df = retinanet_df.append(pd.DataFrame(columns=retinanet_cols,
-                                                        data=[datum]))
+def _roi_dims(config):
+    """Returns dict of ROI image path to (width, height), which is
+    (None, None) where the size is unknown.
 
-    retinanet_df.to_csv(retinanet_csv, index=False, header=False)
+    Sizes come from the media manifest, brought up to date with the ROI
+    directory. In frame store mode the paths are those _write_store_rois
+    writes the ROIs to and sizes come from the frame store index.
+    """
+    if config.use_frame_store():
+        store = FrameStore(config.train_rois_store_dir())
+        rois = {}
+        for video_id in store.video_ids():
+            frames = store.frames(video_id)
+            if not frames:
+                continue
+            height, width = store.shape(video_id)[:2]
+            for frame in frames:
+                rois[config.train_roi_img(video_id, frame)] = (width, height)
+        return rois
+    manifest = config.media_manifest()
+    manifest.sync('rois', config.train_rois_dir(), config.train_roi_exts())
+    return {path: (width, height)
+            for _, _, path, width, height in manifest.entries('rois')}
+
+def _write_store_rois(config, video_ids, frames):
+    """Writes ROIs out of the frame store as image files, since the
+    keras_retinanet training script reads its images from files.
+
+    # Arguments
+        config: ConfigInterface object.
+        video_ids: Video ID of each ROI.
+        frames: Frame number of each ROI.
+    """
+    from cv2 import imwrite
+    from openem_train.preprocess import _imwrite_params
+    store = FrameStore(config.train_rois_store_dir())
+    params = _imwrite_params(config.train_img_ext(), config.extract_quality())
+    rois = sorted(set(zip(video_ids, frames)))
+    print(f"Writing {len(rois)} ROI images from the frame store...")
+    for video_id, frame in rois:
+        path = config.train_roi_img(video_id, frame)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not imwrite(path, store.read(video_id, frame), params):
+            raise IOError(f"Failed to write image {path}")
 
 def getPopulationStats(config, df):
     stats={}
@@ -286,8 +325,8 @@ def train(config):
 def predict(config):
     import openem
     from openem.Detect import Detection,RetinaNet
+    from openem_train.util.frame_store import iterate_frames
     import pandas as pd
-    import cv2
 
     image_dims = (config.detect_height(), config.detect_width())
     retinanet = RetinaNet.RetinaNetDetector(config.detect_retinanet_path(), imageShape=image_dims)
@@ -308,14 +347,13 @@ def predict(config):
                   'det_conf','det_species']
     result_df = pd.DataFrame(columns=result_cols)
     result_df.to_csv(result_csv, header=True, index=False)
+    if config.use_frame_store():
+        rois = iterate_frames(store_dir=config.train_rois_store_dir())
+    else:
+        rois = iterate_frames(paths=config.train_rois())
     bar = progressbar.ProgressBar(redirect_stdout=True)
     # TODO: Use test images here?
-    for img_path in bar(config.train_rois()):
-        path, f = os.path.split(img_path)
-        frame, _ = os.path.splitext(f)
-        frame=int(frame)
-        video_id = os.path.basename(os.path.normpath(path))
-        img = cv2.imread(img_path)
+    for video_id, frame, img in bar(rois):
         retinanet.addImage(img)
         results = retinanet.process(threshold, frame=frame, video_id=video_id)
         image_results=results[0]
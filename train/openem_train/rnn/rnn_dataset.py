@@ -17,10 +17,33 @@ __license__ = "GPLv3"
 """Classes for interfacing with RNN training data.
 """
 
-import random
+import os
+import json
+from functools import partial
 from sklearn.model_selection import train_test_split
 import pandas as pd
 import numpy as np
+from openem_train.util.loader import loader_for
+
+def _frame_rows(frames, offsets, counts):
+    """Finds rows of the video data array corresponding to frames.
+
+    # Arguments
+        frames: DataFrame with video_id and frame columns.
+        offsets: Dict mapping video ID to its first row.
+        counts: Dict mapping video ID to its number of frames.
+
+    # Returns
+        Tuple containing boolean mask of frames that are within a known
+        video and array of rows for those frames.
+    """
+    video_ids = frames.video_id.astype(str)
+    starts = video_ids.map(offsets)
+    nb_frames = video_ids.map(counts)
+    frame = frames.frame.values
+    valid = (starts.notna() & (frame >= 0) & (frame < nb_frames)).values
+    rows = starts.values[valid] + frame[valid]
+    return valid, rows.astype(np.int64)
 
 class RNNDataset:
     """Class for interfacing with RNN training data.
@@ -45,63 +68,176 @@ class RNNDataset:
         self.gt.dropna(axis=0, inplace=True)
         self.gt['have_frame'] = 1.0
 
-        self.video_frames_count = {}
-        self.video_data = {}
-        self.video_data_gt = {}
-
         print('load video data...')
-        self.video_frames_count, self.video_data, self.video_data_gt, self.columns = self.load()
+        (self.video_frames_count, self.video_offsets, self.video_data,
+         self.video_data_gt, self.columns) = self.load()
         print('loaded')
 
+    def _columns(self):
+        """Returns names of input features.
+        """
+        columns = ['species__',]
+        columns += ['species_' + s for s in self.config.species()]
+        columns += ['no_fish', 'covered', 'clear', 'x', 'y', 'w', 'h',
+                    'det_conf', 'det_species']
+        return columns
+
+    def _cache_key(self):
+        """Returns dict identifying the inputs of the video data, used to
+        check whether cached data is up to date.
+        """
+        inputs = []
+        for path in [self.config.num_frames_path(),
+                     self.config.detect_inference_path(),
+                     self.config.classify_inference_path(),
+                     self.config.length_path()]:
+            stat = os.stat(path)
+            inputs.append([path, stat.st_size, stat.st_mtime_ns])
+        return {
+            'inputs': inputs,
+            'columns': self._columns(),
+            'detect_width': self.config.detect_width(),
+            'detect_height': self.config.detect_height(),
+        }
+
     def load(self):
         """Loads RNN training data.
+
+        Data of all videos is stored back to back in one float32 array
+        with a row per frame, so the data of a video is a slice starting
+        at its offset. If caching is enabled the arrays are saved to the
+        work directory and memory mapped by later runs with the same
+        inputs.
+
+        # Returns
+            Tuple containing dict of frame counts per video, dict of
+            offsets per video, array of input features of shape
+            (num_frames, num_features), array of ground truth of shape
+            (num_frames,) and list of feature names.
+        """
+        cache_dir = self.config.count_data_cache_dir()
+        use_cache = self.config.count_cache_data()
+        if use_cache:
+            key = self._cache_key()
+            key_path = os.path.join(cache_dir, 'key.json')
+            if os.path.exists(key_path):
+                with open(key_path, 'r') as key_file:
+                    cached = json.load(key_file) == key
+                if cached:
+                    print('using cached video data from {}'.format(cache_dir))
+                    videos = pd.read_csv(os.path.join(cache_dir, 'videos.csv'))
+                    video_ids = videos.video_id.astype(str)
+                    return (
+                        dict(zip(video_ids, videos.num_frames.tolist())),
+                        dict(zip(video_ids, videos.offset.tolist())),
+                        np.load(os.path.join(cache_dir, 'data.npy'),
+                                mmap_mode='r'),
+                        np.load(os.path.join(cache_dir, 'gt.npy'),
+                                mmap_mode='r'),
+                        key['columns'])
+
+        frames_count, offsets, data, data_gt, columns = self._build()
+
+        if use_cache:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write the key last so that an interrupted write is rebuilt.
+            key_path = os.path.join(cache_dir, 'key.json')
+            if os.path.exists(key_path):
+                os.remove(key_path)
+            np.save(os.path.join(cache_dir, 'data.npy'), data)
+            np.save(os.path.join(cache_dir, 'gt.npy'), data_gt)
+            pd.DataFrame({
+                'video_id': list(frames_count.keys()),
+                'num_frames': list(frames_count.values()),
+                'offset': [offsets[vid] for vid in frames_count],
+            }).to_csv(os.path.join(cache_dir, 'videos.csv'), index=False)
+            with open(key_path, 'w') as key_file:
+                json.dump(key, key_file)
+        return frames_count, offsets, data, data_gt, columns
+
+    def _build(self):
+        """Builds RNN training data from inference and annotation files.
+
+        # Returns
+            Same as load.
         """
         print('generate video data...')
-        video_frames_count = {}
-        video_data = {}
-        video_data_gt = {}
         num_frames = pd.read_csv(self.config.num_frames_path())
+        num_frames = num_frames.drop_duplicates(subset='video_id', keep='last')
         detect_out = pd.read_csv(self.config.detect_inference_path())
         classify_out = pd.read_csv(self.config.classify_inference_path())
+        # Keep one detection and classification per frame.
         detect_out = detect_out.drop_duplicates(
             subset=['video_id', 'frame'],
             keep='first'
         )
-        species_cols = ['species_' + s for s in self.config.species()]
-        columns = ['species__',]
-        columns += species_cols
-        columns += ['no_fish', 'covered', 'clear', 'x', 'y', 'w', 'h',
-                    'det_conf', 'det_species']
+        classify_out = classify_out.drop_duplicates(
+            subset=['video_id', 'frame'],
+            keep='first'
+        )
+        columns = self._columns()
+        num_species = len(self.config.species())
+
+        # Lay out videos back to back.
+        video_ids = num_frames.video_id.astype(str).tolist()
+        counts = num_frames.num_frames.values.astype(np.int64)
+        starts = np.zeros(len(counts), dtype=np.int64)
+        starts[1:] = np.cumsum(counts)[:-1]
+        frames_count = dict(zip(video_ids, counts.tolist()))
+        offsets = dict(zip(video_ids, starts.tolist()))
+
+        # Frames without classification or detection are all zeros.
+        combined = classify_out.merge(
+            detect_out,
+            on=['video_id', 'frame'],
+            how='left'
+        )
+        combined.x /= self.config.detect_width()
+        combined.y /= self.config.detect_height()
+        combined.w /= self.config.detect_width()
+        combined.h /= self.config.detect_height()
+        valid, rows = _frame_rows(combined, offsets, frames_count)
+        data = np.zeros((counts.sum(), len(columns)), dtype=np.float32)
+        data[rows, 1:] = combined[columns[1:]].fillna(0.0).values[valid]
+        data[:, 0] = 1.0 - data[:, 1:1 + num_species].sum(axis=1)
+
+        valid, rows = _frame_rows(self.gt, offsets, frames_count)
+        data_gt = np.zeros((counts.sum(),), dtype=np.float32)
+        data_gt[rows] = self.gt.have_frame.values[valid]
+        return frames_count, offsets, data, data_gt, columns
+
+    def _gather(self, video_ids, offsets):
+        """Gathers examples from the video data with one index per array.
+
+        Input steps before the start or after the end of a video are
+        zeros, as are output steps after the end of a video.
 
-        for _, cnt in num_frames.iterrows():
-            video_id = cnt.video_id
-            nb_frames = cnt.num_frames
-            video_frames_count[video_id] = nb_frames
-            ds_detection = detect_out.loc[detect_out['video_id'] == video_id]
-            ds_classification = classify_out.loc[classify_out['video_id'] == video_id]
-            ds_combined = ds_classification.merge(
-                ds_detection,
-                on='frame',
-                how='left'
-            )
-            ds_combined.x /= self.config.detect_width()
-            ds_combined.y /= self.config.detect_height()
-            ds_combined.w /= self.config.detect_width()
-            ds_combined.h /= self.config.detect_height()
-            all_frames = pd.DataFrame({'frame': list(range(nb_frames))})
-            ds_combined = all_frames.merge(ds_combined, on='frame', how='left').fillna(0.0)
-            ds_combined['species__'] = 1.0 - sum([ds_combined[scol] for scol in species_cols])
-            video_data[video_id] = ds_combined.as_matrix(columns=columns)
-
-            all_frames = pd.DataFrame({'frame': list(range(nb_frames))})
-            gt_combined = all_frames.merge(
-                self.gt.loc[self.gt.video_id == video_id],
-                on='frame',
-                how='left'
-            ).fillna(0.0)
-            video_data_gt[video_id] = gt_combined.as_matrix(columns=['have_frame'])
-
-        return video_frames_count, video_data, video_data_gt, columns
+        # Arguments
+            video_ids: List of video IDs of the examples.
+            offsets: Time offsets of the examples.
+
+        # Returns
+            Tuple containing input data of shape
+            (num_examples, num_steps, num_features) and output data of
+            shape (num_examples, num_res_steps).
+        """
+        starts = np.array([self.video_offsets[v] for v in video_ids],
+                          dtype=np.int64)[:, None]
+        counts = np.array([self.video_frames_count[v] for v in video_ids],
+                          dtype=np.int64)[:, None]
+        offsets = np.asarray(offsets, dtype=np.int64)[:, None]
+
+        frames = offsets - self.config.count_num_steps_crop()
+        frames = frames + np.arange(self.config.count_num_steps())
+        valid = (frames >= 0) & (frames < counts)
+        batch_x = np.asarray(self.video_data[np.where(valid, starts + frames, 0)])
+        batch_x[~valid] = 0.0
+
+        frames = offsets + np.arange(self.config.count_num_res_steps())
+        valid = frames < counts
+        batch_y = np.asarray(self.video_data_gt[np.where(valid, starts + frames, 0)])
+        batch_y[~valid] = 0.0
+        return batch_x, batch_y
 
     def generate_x(self, video_id, offset):
         """Returns input data for a single training example.
@@ -113,19 +249,7 @@ class RNNDataset:
         # Returns
             Input data for single training example.
         """
-        nb_steps = self.config.count_num_steps()
-        res = np.zeros((nb_steps, self.config.count_num_features()))
-        nb_res_steps = nb_steps - self.config.count_num_steps_crop() * 2
-
-        nb_frames = self.video_frames_count[video_id]
-        steps_before = min(self.config.count_num_steps_crop(), offset)
-        steps_after = min(self.config.count_num_steps_crop(), nb_frames - offset - nb_res_steps)
-        res_start = self.config.count_num_steps_crop() - steps_before
-        res_stop = nb_steps - self.config.count_num_steps_crop() + steps_after
-        vid_start = offset - steps_before
-        vid_stop = offset + nb_res_steps + steps_after
-        res[res_start:res_stop, :] = self.video_data[video_id][vid_start:vid_stop, :]
-        return res
+        return self._gather([video_id], [offset])[0][0]
 
     def generate_y(self, video_id, offset):
         """Returns output data for single training example.
@@ -137,11 +261,91 @@ class RNNDataset:
         # Returns
             Output data for single training example.
         """
-        res = np.zeros((self.config.count_num_res_steps(),))
-        nb_frames = self.video_frames_count[video_id]
-        frames_used = min(self.config.count_num_res_steps(), nb_frames - offset)
-        res[0:frames_used] = self.video_data_gt[video_id][offset:offset + frames_used, 0]
-        return res
+        return self._gather([video_id], [offset])[1][0]
+
+    @staticmethod
+    def _outputs(batch_x, batch_y, use_cumsum):
+        """Returns batch in the format expected by the count model.
+
+        # Arguments
+            batch_x: Input data.
+            batch_y: Output data.
+            use_cumsum: Whether to include cumulative sum output.
+        """
+        if use_cumsum:
+            return (
+                batch_x,
+                {
+                    'current_values': batch_y,
+                    'cumsum_values': np.concatenate((
+                        np.cumsum(batch_y, axis=1),
+                        np.cumsum(np.flip(batch_y, axis=1), axis=1)
+                    ), axis=1)
+                }
+            )
+        return (batch_x, batch_y)
+
+    def _windows(self, video_ids):
+        """Returns consecutive non-overlapping examples covering videos.
+
+        # Arguments
+            video_ids: List of video IDs.
+
+        # Returns
+            Tuple containing array of video IDs and array of offsets, one
+            per example.
+        """
+        inc = self.config.count_num_res_steps()
+        counts = np.array([self.video_frames_count[v] for v in video_ids],
+                          dtype=np.int64)
+        num_windows = (counts + inc - 1) // inc
+        window_ids = np.repeat(np.array(video_ids, dtype=object), num_windows)
+        # Offset of each window within its video.
+        first = np.cumsum(num_windows) - num_windows
+        offsets = np.arange(num_windows.sum()) - np.repeat(first, num_windows)
+        return window_ids, offsets * inc
+
+    def random_batch(self, video_ids, batch_size, use_cumsum, batch_idx):
+        """Makes a batch from random offsets into random videos.
+
+        # Arguments
+            video_ids: List of video IDs to sample from.
+            batch_size: Batch size.
+            use_cumsum: Whether to include cumulative sum output.
+            batch_idx: Index of the batch, unused as batches are random.
+
+        # Returns
+            Batch of examples.
+        """
+        batch_ids = [video_ids[i] for i in
+                     np.random.randint(len(video_ids), size=batch_size)]
+        counts = np.array([self.video_frames_count[v] for v in batch_ids])
+        max_offsets = counts - self.config.count_num_res_steps()
+        offsets = np.random.randint(np.maximum(max_offsets, 1))
+        return self._outputs(*self._gather(batch_ids, offsets), use_cumsum)
+
+    def window_batch(self, window_ids, offsets, batch_size, use_cumsum,
+                     batch_idx):
+        """Makes a batch of consecutive examples from a fixed list.
+
+        The list is repeated, the last batch of each pass may be short.
+
+        # Arguments
+            window_ids: Array of video IDs of the examples.
+            offsets: Array of time offsets of the examples.
+            batch_size: Batch size.
+            use_cumsum: Whether to include cumulative sum output.
+            batch_idx: Index of the batch.
+
+        # Returns
+            Batch of examples.
+        """
+        num_batches = -(-len(offsets) // batch_size)
+        start = (batch_idx % num_batches) * batch_size
+        stop = start + batch_size
+        return self._outputs(
+            *self._gather(window_ids[start:stop], offsets[start:stop]),
+            use_cumsum)
 
     def generate(self, batch_size, use_cumsum=True):
         """Training batch generator.
@@ -150,40 +354,26 @@ class RNNDataset:
             batch_size: Batch size.
             use_cumsum: Whether to include cumulative sum output.
 
-        # Yields
-            Training batch.
-        """
-        valid_video_ids = list(self.train_video_ids.intersection(self.video_data.keys()))
-        shape = (self.config.count_num_steps(), self.config.count_num_features())
-        batch_x = np.zeros((batch_size,) + shape, dtype=np.float32)
-        batch_y = np.zeros((batch_size, self.config.count_num_res_steps()), dtype=np.float32)
-        while True:
-            for batch_idx in range(batch_size):
-                video_id = random.choice(valid_video_ids)
-
-                if self.video_frames_count[video_id] < self.config.count_num_res_steps():
-                    offset = 0
-                else:
-                    max_offset = self.video_frames_count[video_id]
-                    max_offset -= self.config.count_num_res_steps()
-                    offset = random.randrange(0, max_offset)
-
-                batch_x[batch_idx] = self.generate_x(video_id, offset)
-                batch_y[batch_idx] = self.generate_y(video_id, offset)
-
-            if use_cumsum:
-                yield (
-                    batch_x,
-                    {
-                        'current_values': batch_y,
-                        'cumsum_values': np.concatenate((
-                            np.cumsum(batch_y, axis=1),
-                            np.cumsum(np.flip(batch_y, axis=1), axis=1)
-                        ), axis=1)
-                    }
-                )
-            else:
-                yield (batch_x, batch_y)
+        # Returns
+            Iterator over training batches.
+        """
+        valid_video_ids = sorted(self.train_video_ids.intersection(self.video_offsets.keys()))
+        return loader_for(
+            self.config,
+            partial(self.random_batch, valid_video_ids, batch_size, use_cumsum))
+
+    def train_batches(self, batch_size):
+        """Returns number of training batches covering each training video
+        once.
+
+        # Arguments
+            batch_size: Batch size.
+
+        # Returns
+            Number of training batches for this dataset.
+        """
+        valid_video_ids = sorted(self.train_video_ids.intersection(self.video_offsets.keys()))
+        return -(-len(self._windows(valid_video_ids)[1]) // batch_size)
 
     def test_batches(self, batch_size):
         """Returns number of validation batches.
@@ -194,59 +384,29 @@ class RNNDataset:
         # Returns
             Number of validation batches for this dataset.
         """
-        valid_video_ids = sorted(self.test_video_ids.intersection(self.video_data.keys()))
-        batch_idx = 0
-        batches_count = 0
-        for video_id in valid_video_ids:
-            stop = self.video_frames_count[video_id]
-            inc = self.config.count_num_res_steps()
-            for _ in range(0, stop, inc):
-                batch_idx += 1
-
-                if batch_idx == batch_size:
-                    batch_idx = 0
-                    batches_count += 1
+        valid_video_ids = sorted(self.test_video_ids.intersection(self.video_offsets.keys()))
+        batches_count = -(-len(self._windows(valid_video_ids)[1]) // batch_size)
         print('val batches count:', batches_count)
         return batches_count
 
     def generate_test(self, batch_size, use_cumsum=True):
         """Validation batch generator.
 
+        Every validation video is split into consecutive non-overlapping
+        examples, which are visited in the same order every test_batches
+        batches.
+
         # Arguments
             batch_size: Batch size.
             use_cumsum: Whether to include cumulative sum output.
 
-        # Yields
-            Validation batch.
-        """
-        valid_video_ids = list(self.test_video_ids.intersection(self.video_data.keys()))
-        shape = (self.config.count_num_steps(), self.config.count_num_features())
-        batch_x = np.zeros((batch_size,) + shape, dtype=np.float32)
-        batch_y = np.zeros((batch_size, self.config.count_num_res_steps()), dtype=np.float32)
-        while True:
-            for batch_idx in range(batch_size):
-                video_id = random.choice(valid_video_ids)
-
-                if self.video_frames_count[video_id] < self.config.count_num_res_steps():
-                    offset = 0
-                else:
-                    max_offset = self.video_frames_count[video_id]
-                    max_offset -= self.config.count_num_res_steps()
-                    offset = random.randrange(0, max_offset)
-
-                batch_x[batch_idx] = self.generate_x(video_id, offset)
-                batch_y[batch_idx] = self.generate_y(video_id, offset)
-
-            if use_cumsum:
-                yield (
-                    batch_x,
-                    {
-                        'current_values': batch_y,
-                        'cumsum_values': np.concatenate((
-                            np.cumsum(batch_y, axis=1),
-                            np.cumsum(np.flip(batch_y, axis=1), axis=1)
-                        ), axis=1)
-                    }
-                )
-            else:
-                yield (batch_x, batch_y)
+        # Returns
+            Iterator over validation batches.
+        """
+        valid_video_ids = sorted(self.test_video_ids.intersection(self.video_offsets.keys()))
+        window_ids, offsets = self._windows(valid_video_ids)
+        return loader_for(
+            self.config,
+            partial(self.window_batch, window_ids, offsets, batch_size,
+                    use_cumsum),
+            seed_offset=1)
@@ -21,16 +21,17 @@ import os
 import random
 from collections import namedtuple
 from typing import List, Dict
-from multiprocessing.pool import ThreadPool
+from functools import partial
 import scipy
 import numpy as np
 import pandas as pd
-import skimage
 from sklearn.model_selection import train_test_split
 from keras.applications.imagenet_utils import preprocess_input
 from openem_train.util import utils
 from openem_train.util import img_augmentation
 from openem_train.util.roi_transform import RoiTransform
+from openem_train.util.frame_store import FrameStore
+from openem_train.util.loader import loader_for
 from openem_train.util.img_augmentation import resizeAndFill
 import math
 
@@ -160,6 +161,9 @@ class SSDDataset:
         self.preprocess_input = preproc
         self.frame_jitter = list(range(1+self.config.detect_frame_jitter()))
         self.frame_jitter += [-a for a in self.frame_jitter]
+        self.frame_store = None
+        if config.use_frame_store():
+            self.frame_store = FrameStore(config.train_imgs_store_dir())
 
     def load(self):
         """ Loads data to be used from annotation csv file.
@@ -203,29 +207,32 @@ class SSDDataset:
         frame = cfg.detection.frame + diff
         frame = max(0, frame)
         def get_path(frame_num):
-            return os.path.join(
-                self.config.train_imgs_dir(),
-                cfg.detection.video_id,
-                '{:04}.jpg'.format(frame_num))
-        if not os.path.exists(get_path(frame)):
-            frame -= 1
-        if os.stat(get_path(frame)).st_size == 0:
-            frame -= 1
-        img = scipy.misc.imread(get_path(frame))
+            return self.config.train_img(cfg.detection.video_id, frame_num)
+        if self.frame_store is not None:
+            if not self.frame_store.has(cfg.detection.video_id, frame):
+                frame -= 1
+            # Frame store is BGR, training data is RGB
+            img = self.frame_store.read(cfg.detection.video_id, frame)[:, :, ::-1]
+        else:
+            if not os.path.exists(get_path(frame)):
+                frame -= 1
+            if os.stat(get_path(frame)).st_size == 0:
+                frame -= 1
+            img = scipy.misc.imread(get_path(frame))
         # because each frame may have different dimensions resize and
-        # fill to match the detection size prior to warping
-        img,scale = resizeAndFill(img, (self.config.detect_height(),
-                                  self.config.detect_width())
-        )
+        # fill to match the detection size prior to warping; frames that
+        # already match are warped directly as uint8
+        detect_shape = (self.config.detect_height(), self.config.detect_width())
+        if img.shape[:2] == detect_shape:
+            scale = (1.0, 1.0)
+        else:
+            img,scale = resizeAndFill(img, detect_shape)
 
-        crop = skimage.transform.warp(
+        crop = utils.warp_affine(
             img,
             cfg.transformation,
-            mode='edge',
-            order=3,
-            output_shape=(
-                self.config.detect_height(),
-                self.config.detect_width()))
+            output_shape=detect_shape,
+            order=3)
 
         detection = cfg.detection
 
@@ -333,6 +340,35 @@ class SSDDataset:
                 [1, 1, 1, 1, 2, 2.5, 3, 4])
         return cfg
 
+    def ssd_batch(self, detections, batch_size, is_training, batch_idx):
+        """Makes a batch of SSD examples.
+
+        Training detections are shuffled once per pass over them, with
+        the order of a pass determined by its index.
+
+        # Arguments:
+            detections: List of detections to make examples from.
+            batch_size: Size of the batch.
+            is_training: True for training, False for validating.
+            batch_idx: Index of the batch.
+        """
+        batches_per_pass = max(1, len(detections) // batch_size)
+        pass_idx, batch_idx = divmod(batch_idx, batches_per_pass)
+        order = np.arange(len(detections))
+        if is_training:
+            order = np.random.RandomState(
+                self.config.loader_seed() + pass_idx).permutation(order)
+        start = batch_idx * batch_size
+        inputs = []
+        bboxes = []
+        for idx in order[start:start + batch_size]:
+            cfg = self.get_config(detections[idx], is_training)
+            img, bbox = self.generate_xy(cfg)
+            inputs.append(img)
+            bboxes.append(bbox)
+        targets = self.bbox_util.assign_boxes_batch(bboxes)
+        return self.preprocess_input(np.array(inputs)), targets
+
     def generate_ssd(self, batch_size, is_training):
         """Generator for SSD training examples.
 
@@ -340,33 +376,13 @@ class SSDDataset:
             batch_size: Size of the batch.
             is_training: True for training, False for validating.
         """
-        pool = ThreadPool(processes=8)
-
         detections = []  # type: List[fish_detection.FishDetection]
         if is_training:
             detections += sum([self.detections[video_id] for video_id in self.train_clips], [])
         else:
             detections += sum([self.detections[video_id] for video_id in self.test_clips], [])
 
-        while True:
-            samples_to_process = []
-            if is_training:
-                random.shuffle(detections)
-
-            for detection in detections:
-
-                cfg = self.get_config(detection, is_training)
-                samples_to_process.append(cfg)
-
-                if len(samples_to_process) >= batch_size:
-                    inputs = []
-                    targets = []
-                    for img, bbox in pool.map(self.generate_xy, samples_to_process):
-                        inputs.append(img)
-                        targets.append(self.bbox_util.assign_boxes(bbox))
-
-                    tmp_inp = np.array(inputs)
-                    inputs.clear()  # lets return some memory earlier
-                    samples_to_process = []
-
-                    yield self.preprocess_input(tmp_inp), np.array(targets)
+        return loader_for(
+            self.config,
+            partial(self.ssd_batch, detections, batch_size, is_training),
+            seed_offset=0 if is_training else 1)
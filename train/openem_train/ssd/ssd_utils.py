@@ -17,42 +17,99 @@ __license__ = "GPLv3"
 """Some utils for SSD."""
 
 import numpy as np
-import tensorflow as tf
 
 def _decode_boxes(mbox_loc, mbox_priorbox, variances):
     """Convert bboxes from local predictions to shifted priors.
 
     # Arguments
-        mbox_loc: Numpy array of predicted locations.
-        mbox_priorbox: Numpy array of prior boxes.
-        variances: Numpy array of variances.
+        mbox_loc: Numpy array of predicted locations, shape (..., 4).
+        mbox_priorbox: Numpy array of prior boxes, shape (..., 4).
+        variances: Numpy array of variances, shape (..., 4).
 
     # Return
         decode_bbox: Shifted priors.
     """
-    prior_width = mbox_priorbox[:, 2] - mbox_priorbox[:, 0]
-    prior_height = mbox_priorbox[:, 3] - mbox_priorbox[:, 1]
-    prior_center_x = 0.5 * (mbox_priorbox[:, 2] + mbox_priorbox[:, 0])
-    prior_center_y = 0.5 * (mbox_priorbox[:, 3] + mbox_priorbox[:, 1])
-    decode_bbox_center_x = mbox_loc[:, 0] * prior_width * variances[:, 0]
+    prior_width = mbox_priorbox[..., 2] - mbox_priorbox[..., 0]
+    prior_height = mbox_priorbox[..., 3] - mbox_priorbox[..., 1]
+    prior_center_x = 0.5 * (mbox_priorbox[..., 2] + mbox_priorbox[..., 0])
+    prior_center_y = 0.5 * (mbox_priorbox[..., 3] + mbox_priorbox[..., 1])
+    decode_bbox_center_x = mbox_loc[..., 0] * prior_width * variances[..., 0]
     decode_bbox_center_x += prior_center_x
-    decode_bbox_center_y = mbox_loc[:, 1] * prior_width * variances[:, 1]
+    decode_bbox_center_y = mbox_loc[..., 1] * prior_width * variances[..., 1]
     decode_bbox_center_y += prior_center_y
-    decode_bbox_width = np.exp(mbox_loc[:, 2] * variances[:, 2])
+    decode_bbox_width = np.exp(mbox_loc[..., 2] * variances[..., 2])
     decode_bbox_width *= prior_width
-    decode_bbox_height = np.exp(mbox_loc[:, 3] * variances[:, 3])
+    decode_bbox_height = np.exp(mbox_loc[..., 3] * variances[..., 3])
     decode_bbox_height *= prior_height
     decode_bbox_xmin = decode_bbox_center_x - 0.5 * decode_bbox_width
     decode_bbox_ymin = decode_bbox_center_y - 0.5 * decode_bbox_height
     decode_bbox_xmax = decode_bbox_center_x + 0.5 * decode_bbox_width
     decode_bbox_ymax = decode_bbox_center_y + 0.5 * decode_bbox_height
-    decode_bbox = np.concatenate((decode_bbox_xmin[:, None],
-                                  decode_bbox_ymin[:, None],
-                                  decode_bbox_xmax[:, None],
-                                  decode_bbox_ymax[:, None]), axis=-1)
+    decode_bbox = np.stack((decode_bbox_xmin,
+                            decode_bbox_ymin,
+                            decode_bbox_xmax,
+                            decode_bbox_ymax), axis=-1)
     decode_bbox = np.minimum(np.maximum(decode_bbox, 0.0), 1.0)
     return decode_bbox
 
+def batched_nms(boxes, scores, groups, iou_threshold, max_output_size):
+    """Greedy non maximum suppression of many groups of boxes at once.
+
+    Within each group this selects the same boxes as
+    tf.image.non_max_suppression: boxes are visited by descending score
+    and a box is kept unless its IoU with a kept box exceeds the
+    threshold. Every round keeps the best remaining box of all groups at
+    once, so the number of rounds is bounded by max_output_size rather
+    than by the number of groups.
+
+    # Arguments
+        boxes: Numpy array of boxes, shape (num_boxes, 4).
+        scores: Numpy array of scores, shape (num_boxes,).
+        groups: Numpy array of integer group IDs, shape (num_boxes,),
+            e.g. combining image and class. Boxes of different groups do
+            not suppress each other.
+        iou_threshold: Overlap above which boxes are suppressed.
+        max_output_size: Maximum number of boxes kept per group.
+
+    # Return
+        keep: Indices of kept boxes, sorted by group and then by
+            descending score.
+    """
+    order = np.lexsort((-scores, groups))
+    xmin, ymin, xmax, ymax = (
+        np.ascontiguousarray(boxes[order, i]) for i in range(4))
+    area = (xmax - xmin) * (ymax - ymin)
+    groups = groups[order]
+    remaining = np.arange(len(order))
+    keep = []
+    for _ in range(max_output_size):
+        if remaining.size == 0:
+            break
+        # Remaining boxes stay sorted, so the first of each group is its
+        # best remaining box.
+        rem_groups = groups[remaining]
+        first = np.empty(remaining.size, dtype=bool)
+        first[0] = True
+        np.not_equal(rem_groups[1:], rem_groups[:-1], out=first[1:])
+        leaders = remaining[first]
+        keep.append(leaders)
+        leader_of = leaders[np.cumsum(first) - 1]
+        inter_w = (np.minimum(xmax[remaining], xmax[leader_of]) -
+                   np.maximum(xmin[remaining], xmin[leader_of]))
+        inter_h = (np.minimum(ymax[remaining], ymax[leader_of]) -
+                   np.maximum(ymin[remaining], ymin[leader_of]))
+        inter = np.maximum(inter_w, 0) * np.maximum(inter_h, 0)
+        rem_area = area[remaining]
+        leader_area = area[leader_of]
+        # Boxes without area overlap nothing, as in TensorFlow.
+        valid = (rem_area > 0) & (leader_area > 0)
+        union = np.where(valid, rem_area + leader_area - inter, 1.0)
+        suppressed = valid & (inter / union > iou_threshold)
+        remaining = remaining[~(first | suppressed)]
+    if not keep:
+        return np.zeros((0,), dtype=np.int64)
+    return order[np.sort(np.concatenate(keep))]
+
 class BBoxUtility:
     """Utility class to do some stuff with bounding boxes and priors.
 
@@ -62,7 +119,8 @@ class BBoxUtility:
             priors[i] = [xmin, ymin, xmax, ymax, varxc, varyc, varw, varh].
         overlap_threshold: Threshold to assign box to a prior.
         nms_thresh: Nms threshold.
-        top_k: Number of total bboxes to be kept per image after nms step.
+        top_k: Number of bboxes to be kept per image and class after nms
+            step.
 
     # References
         https://arxiv.org/abs/1512.02325
@@ -75,12 +133,6 @@ class BBoxUtility:
         self.overlap_threshold = overlap_threshold
         self._nms_thresh = nms_thresh
         self._top_k = top_k
-        self.boxes = tf.placeholder(dtype='float32', shape=(None, 4))
-        self.scores = tf.placeholder(dtype='float32', shape=(None,))
-        self.nms = tf.image.non_max_suppression(self.boxes, self.scores,
-                                                self._top_k,
-                                                iou_threshold=self._nms_thresh)
-        self.sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
 
     @property
     def nms_thresh(self):
@@ -93,9 +145,6 @@ class BBoxUtility:
         """Setter for non-max suppression threshold.
         """
         self._nms_thresh = value
-        self.nms = tf.image.non_max_suppression(self.boxes, self.scores,
-                                                self._top_k,
-                                                iou_threshold=self._nms_thresh)
 
     @property
     def top_k(self):
@@ -108,9 +157,6 @@ class BBoxUtility:
         """Setter for top k anchor boxes.
         """
         self._top_k = value
-        self.nms = tf.image.non_max_suppression(self.boxes, self.scores,
-                                                self._top_k,
-                                                iou_threshold=self._nms_thresh)
 
     def iou(self, box):
         """Compute intersection over union for the box with all priors.
@@ -171,6 +217,29 @@ class BBoxUtility:
         encoded_box[:, 2:4][assign_mask] /= assigned_priors[:, -2:]
         return encoded_box.ravel()
 
+    def iou_matrix(self, boxes):
+        """Compute intersection over union for boxes with all priors.
+
+        # Arguments
+            boxes: Boxes, numpy tensor of shape (..., num_boxes, 4).
+
+        # Return
+            iou: Intersection over union,
+                numpy tensor of shape (..., num_boxes, num_priors).
+        """
+        boxes = boxes[..., None, :]
+        prior_xmin, prior_ymin, prior_xmax, prior_ymax = (
+            np.ascontiguousarray(self.priors[:, i]) for i in range(4))
+        inter_w = (np.minimum(prior_xmax, boxes[..., 2]) -
+                   np.maximum(prior_xmin, boxes[..., 0]))
+        inter_h = (np.minimum(prior_ymax, boxes[..., 3]) -
+                   np.maximum(prior_ymin, boxes[..., 1]))
+        inter = np.maximum(inter_w, 0) * np.maximum(inter_h, 0)
+        area_pred = ((boxes[..., 2] - boxes[..., 0]) *
+                     (boxes[..., 3] - boxes[..., 1]))
+        area_gt = (prior_xmax - prior_xmin) * (prior_ymax - prior_ymin)
+        return inter / (area_pred + area_gt - inter)
+
     def assign_boxes(self, boxes):
         """Assign boxes to priors for training.
 
@@ -186,33 +255,85 @@ class BBoxUtility:
                     or in other words is assigned to some ground truth box,
                 assignment[:, -7:] are all 0. See loss for more details.
         """
-        assignment = np.zeros((self.num_priors, 4 + self.num_classes + 8))
-        assignment[:, 4] = 1.0
-        if boxes.size == 0:
+        return self.assign_boxes_batch([boxes])[0]
+
+    def assign_boxes_batch(self, batch_boxes):
+        """Assign boxes of every image in a batch to priors for training.
+
+        Each ground truth box is assigned to the priors it overlaps by more
+        than the overlap threshold, or to its best prior if there are
+        none. A prior assigned to several boxes keeps the one it overlaps
+        most. The whole batch is matched and encoded with array operations
+        on a (batch, num_boxes, num_priors) IoU matrix.
+
+        # Arguments
+            batch_boxes: List of box tensors as passed to assign_boxes,
+                one per image. Images may have different numbers of boxes.
+
+        # Return
+            assignment: Numpy tensor of shape
+                (batch_size, num_priors, 4 + num_classes + 8), see
+                assign_boxes.
+        """
+        batch_size = len(batch_boxes)
+        assignment = np.zeros(
+            (batch_size, self.num_priors, 4 + self.num_classes + 8))
+        assignment[:, :, 4] = 1.0
+        counts = np.array([
+            len(boxes) if np.size(boxes) else 0 for boxes in batch_boxes],
+            dtype=np.int64)
+        max_boxes = counts.max() if batch_size else 0
+        if max_boxes == 0:
             return assignment
-        encoded_boxes = np.apply_along_axis(self.encode_box, 1, boxes[:, :4])
-        encoded_boxes = encoded_boxes.reshape(-1, self.num_priors, 5)
-        best_iou = encoded_boxes[:, :, -1].max(axis=0)
-        best_iou_idx = encoded_boxes[:, :, -1].argmax(axis=0)
-        best_iou_mask = best_iou > 0
-        best_iou_idx = best_iou_idx[best_iou_mask]
-        assign_num = len(best_iou_idx)
-        encoded_boxes = encoded_boxes[:, best_iou_mask, :]
-        assignment[:, :4][best_iou_mask] = encoded_boxes[best_iou_idx,
-                                                         np.arange(assign_num),
-                                                         :4]
-        assignment[:, 4][best_iou_mask] = 0
-        assignment[:, 5:-8][best_iou_mask] = boxes[best_iou_idx, 4:]
-        assignment[:, -8][best_iou_mask] = 1
+
+        # Pad images to the same number of boxes.
+        boxes = np.zeros((batch_size, max_boxes, 4 + self.num_classes - 1))
+        for idx, img_boxes in enumerate(batch_boxes):
+            if counts[idx]:
+                boxes[idx, :counts[idx]] = np.reshape(
+                    img_boxes, (counts[idx], -1))
+        valid = np.arange(max_boxes) < counts[:, None]
+
+        # Match boxes to priors.
+        iou = self.iou_matrix(boxes[..., :4])
+        iou[~valid] = 0
+        assign_mask = (iou > self.overlap_threshold) & valid[..., None]
+        unassigned = valid & ~assign_mask.any(axis=-1)
+        img_idx, box_idx = np.nonzero(unassigned)
+        assign_mask[img_idx, box_idx, iou[img_idx, box_idx].argmax(axis=-1)] = True
+        assigned_iou = np.where(assign_mask, iou, 0)
+        best_iou = assigned_iou.max(axis=1)
+        best_iou_idx = assigned_iou.argmax(axis=1)
+
+        # Encode the matched boxes relative to their priors.
+        img_idx, prior_idx = np.nonzero(best_iou > 0)
+        gt_boxes = boxes[img_idx, best_iou_idx[img_idx, prior_idx]]
+        priors = self.priors[prior_idx]
+        box_center = 0.5 * (gt_boxes[:, :2] + gt_boxes[:, 2:4])
+        box_wh = gt_boxes[:, 2:4] - gt_boxes[:, :2]
+        priors_center = 0.5 * (priors[:, :2] + priors[:, 2:4])
+        priors_wh = priors[:, 2:4] - priors[:, :2]
+        # we encode variance
+        assigned = assignment[img_idx, prior_idx]
+        assigned[:, :2] = (box_center - priors_center) / priors_wh
+        assigned[:, :2] /= priors[:, -4:-2]
+        assigned[:, 2:4] = np.log(box_wh / priors_wh) / priors[:, -2:]
+        assigned[:, 4] = 0
+        assigned[:, 5:-8] = gt_boxes[:, 4:]
+        assigned[:, -8] = 1
+        assignment[img_idx, prior_idx] = assigned
         return assignment
 
     def detection_out(self, predictions, background_label_id=0, keep_top_k=200,
                       confidence_threshold=0.01):
         """Do non maximum suppression (nms) on prediction results.
 
+        Boxes of all images and classes are decoded and suppressed
+        together, see batched_nms. At most top_k boxes are kept per image
+        and class before keeping the best keep_top_k per image.
+
         # Arguments
             predictions: Numpy array of predicted values.
-            num_classes: Number of classes for prediction.
             background_label_id: Label of background class.
             keep_top_k: Number of total bboxes to be kept per image
                 after nms step.
@@ -227,30 +348,30 @@ class BBoxUtility:
         variances = predictions[:, :, -4:]
         mbox_priorbox = predictions[:, :, -8:-4]
         mbox_conf = predictions[:, :, 4:-8]
+        decode_bbox = _decode_boxes(mbox_loc, mbox_priorbox, variances)
+
+        # Gather candidates of every image and foreground class.
+        classes = np.array([c for c in range(self.num_classes)
+                            if c != background_label_id], dtype=np.int64)
+        confs = mbox_conf[:, :, classes]
+        img_idx, prior_idx, class_pos = np.nonzero(
+            confs > confidence_threshold)
+        scores = confs[img_idx, prior_idx, class_pos]
+        boxes = decode_bbox[img_idx, prior_idx]
+        labels = classes[class_pos]
+        keep = batched_nms(boxes, scores, img_idx * self.num_classes + labels,
+                           self._nms_thresh, self._top_k)
+        dets = np.concatenate((labels[keep, None].astype(np.float64),
+                               scores[keep, None], boxes[keep]), axis=1)
+
+        # Kept boxes are sorted by image, so split them per image.
+        bounds = np.searchsorted(img_idx[keep], np.arange(len(predictions) + 1))
         results = []
-        for i, (loc, pbox, var) in enumerate(zip(mbox_loc, mbox_priorbox, variances)):
-            results.append([])
-            decode_bbox = _decode_boxes(loc, pbox, var)
-            for class_idx in range(self.num_classes):
-                if class_idx == background_label_id:
-                    continue
-                c_confs = mbox_conf[i, :, class_idx]
-                c_confs_m = c_confs > confidence_threshold
-                if c_confs[c_confs_m]:
-                    boxes_to_process = decode_bbox[c_confs_m]
-                    confs_to_process = c_confs[c_confs_m]
-                    feed_dict = {self.boxes: boxes_to_process,
-                                 self.scores: confs_to_process}
-                    idx = self.sess.run(self.nms, feed_dict=feed_dict)
-                    good_boxes = boxes_to_process[idx]
-                    confs = confs_to_process[idx][:, None]
-                    labels = class_idx * np.ones((len(idx), 1))
-                    c_pred = np.concatenate((labels, confs, good_boxes),
-                                            axis=1)
-                    results[-1].extend(c_pred)
-            if results[-1]:
-                results[-1] = np.array(results[-1])
-                argsort = np.argsort(results[-1][:, 1])[::-1]
-                results[-1] = results[-1][argsort]
-                results[-1] = results[-1][:keep_top_k]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if start == stop:
+                results.append([])
+                continue
+            img_dets = dets[start:stop]
+            argsort = np.argsort(-img_dets[:, 1], kind='stable')
+            results.append(img_dets[argsort][:keep_top_k])
         return results
@@ -18,7 +18,7 @@ import os
 import sys
 import math
 import glob
-from collections import defaultdict
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 sys.path.append('../python')
@@ -227,9 +227,38 @@ def _write_counts(
             length *= float(detect_width) / float(vid_width)
             csv.write("{},{},{}\n".format(i, species, length))
 
+def _nearest(frames, targets):
+    """Finds the nearest frame to each target frame.
+
+    # Arguments:
+        frames: Array of frame numbers to search.
+        targets: Array of frame numbers to find.
+
+    # Returns:
+        Array of indices into frames. A target halfway between two frames
+        goes to the earlier frame, and among equal frames the one with the
+        lowest index is chosen.
+    """
+    order = np.argsort(frames, kind='stable')
+    sorted_frames = frames[order]
+    pos = np.searchsorted(sorted_frames, targets)
+    before = np.clip(pos - 1, 0, len(frames) - 1)
+    after = np.clip(pos, 0, len(frames) - 1)
+    # Equal frames are sorted by index, so take the first of each.
+    before = np.searchsorted(sorted_frames, sorted_frames[before])
+    after = np.searchsorted(sorted_frames, sorted_frames[after])
+    dist_before = np.abs(sorted_frames[before] - targets)
+    dist_after = np.abs(sorted_frames[after] - targets)
+    return order[np.where(dist_after < dist_before, after, before)]
+
 def _losses(pred, truth, species):
     """Computes the losses between two sequences of keyframes.
 
+    Each prediction is assigned to the nearest truth keyframe, the earlier
+    one if two are equally near. A truth keyframe with predictions is a
+    true positive, matched to its nearest prediction, and its other
+    predictions are false positives.
+
     # Arguments:
         pred: N by 3 pandas data frame containing frame, species, length.
         truth: N by 3 pandas data frame containing frame, species, length.
@@ -244,43 +273,61 @@ def _losses(pred, truth, species):
         - Sum of absolute differences in length (for true positives only)
         - Confusion matrix (for true positives only)
     """
-    true_pos = 0
-    false_pos = 0
-    false_neg = 0
-    num_correct = 0
-    sum_abs_diff = 0.0
     num_classes = len(species)
     confusion = np.zeros((num_classes, num_classes))
-
-    # Map between truth index (key) and pred indices (values).
-    mapping = defaultdict(list)
-    for p_idx, p_row in pred.iterrows():
-        t_idx = (truth['frame'] - p_row.frame).abs().argsort()[0]
-        mapping[t_idx].append((p_row.frame, p_row.species, p_row.length))
-
-    # Iterate through map and compute statistics.
-    for t_idx, _ in truth.iterrows():
-        matches = mapping[t_idx]
-        t_row = truth.iloc[t_idx]
-        if matches:
-            true_pos += 1
-            false_pos += len(matches) - 1
-            matches.sort(key=lambda x: abs(x[0] - t_row.frame))
-            truth_species = t_row.species.lower()
-            pred_species = matches[0][1].lower()
-            if truth_species not in species:
-                truth_species = 'other'
-            confusion[
-                species.index(truth_species),
-                species.index(pred_species)
-            ] += 1
-            if pred_species == truth_species:
-                num_correct += 1
-            sum_abs_diff += abs(matches[0][2] - t_row.length)
-        else:
-            false_neg += 1
+    if len(truth) == 0 or len(pred) == 0:
+        return (0, len(pred), len(truth), 0, 0.0, confusion)
+
+    # Map each prediction to the nearest truth keyframe.
+    pred_frames = pred['frame'].values
+    truth_frames = truth['frame'].values
+    t_idx = _nearest(truth_frames, pred_frames)
+    counts = np.bincount(t_idx, minlength=len(truth))
+    true_pos = int(np.count_nonzero(counts))
+    false_pos = len(pred) - true_pos
+    false_neg = len(truth) - true_pos
+
+    # Nearest prediction of each matched truth keyframe, ties going to
+    # the first prediction, in truth order.
+    dist = np.abs(pred_frames - truth_frames[t_idx])
+    order = np.lexsort((np.arange(len(pred)), dist, t_idx))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = t_idx[order][1:] != t_idx[order][:-1]
+    best = order[first]
+    matched = t_idx[best]
+
+    # Accumulate classification and length statistics.
+    truth_species = truth['species'].str.lower().values[matched]
+    truth_species = np.where(np.isin(truth_species, species),
+                             truth_species, 'other')
+    pred_species = pred['species'].str.lower().values[best]
+    index = {s: species.index(s) for s in
+             set(truth_species) | set(pred_species)}
+    np.add.at(confusion, (
+        [index[s] for s in truth_species],
+        [index[s] for s in pred_species]), 1)
+    num_correct = int(np.count_nonzero(pred_species == truth_species))
+    abs_diff = np.abs(pred['length'].values[best] - truth['length'].values[matched])
+    sum_abs_diff = float(abs_diff.sum())
     return (true_pos, false_pos, false_neg, num_correct, sum_abs_diff, confusion)
 
+def _file_losses(job):
+    """Computes losses for a single truth file.
+
+    # Arguments:
+        job: Tuple containing truth file, test output file and list of
+            species names.
+
+    # Returns:
+        Output of _losses, or None if the test output does not exist.
+    """
+    truth_file, test_file, species = job
+    if not os.path.exists(test_file):
+        return None
+    truth = pd.read_csv(truth_file)
+    pred = pd.read_csv(test_file)
+    return _losses(pred, truth, species)
+
 def predict(config):
 
     # Get paths from config file.
@@ -347,24 +394,26 @@ def eval(config):
     sum_abs_diff = 0.0
     confusion = np.zeros((len(species), len(species)))
 
-    # Iterate through truth/test files and sum up the metrics.
+    # Compute metrics of truth/test files in parallel and sum them up in
+    # order.
+    jobs = []
     for truth_file in truth_files:
         _, fname = os.path.split(truth_file)
-        test_file = os.path.join(test_dir, fname)
-        if os.path.exists(test_file):
-            print("Evaluating performance with {}...".format(test_file))
-            truth = pd.read_csv(truth_file)
-            pred = pd.read_csv(test_file)
-            metrics = _losses(pred, truth, species)
-            true_pos += metrics[0]
-            false_pos += metrics[1]
-            false_neg += metrics[2]
-            num_correct += metrics[3]
-            sum_abs_diff += metrics[4]
-            confusion += metrics[5]
-        else:
-            msg = "Could not find test output {}! Excluding from evaluation..."
-            print(msg.format(test_file))
+        jobs.append((truth_file, os.path.join(test_dir, fname), species))
+    with Pool(config.test_num_workers()) as pool:
+        results = pool.imap(_file_losses, jobs)
+        for (_, test_file, _), metrics in zip(jobs, results):
+            if metrics is not None:
+                print("Evaluating performance with {}...".format(test_file))
+                true_pos += metrics[0]
+                false_pos += metrics[1]
+                false_neg += metrics[2]
+                num_correct += metrics[3]
+                sum_abs_diff += metrics[4]
+                confusion += metrics[5]
+            else:
+                msg = "Could not find test output {}! Excluding from evaluation..."
+                print(msg.format(test_file))
 
     # Compute summary statistics.
     print("True positives: {}".format(true_pos))
@@ -18,12 +18,16 @@ __license__ = "GPLv3"
 
 import glob
 import os
+import json
 import random
 from copy import copy
+from functools import partial
 from multiprocessing.pool import ThreadPool
+import cv2
 import numpy as np
-import scipy.misc
 from openem_train.util.utils import chunks
+from openem_train.util.frame_store import FrameStore
+from openem_train.util.loader import loader_for
 
 def preprocess_input(img):
     return img.astype(np.float32) / 128.0 - 1.0
@@ -68,75 +72,116 @@ class UnetDataset:
         self.config = config
 
         # Find all images.
-        image_files = glob.glob(os.path.join(config.train_mask_imgs_dir(), '*'))
+        image_files = sorted(glob.glob(os.path.join(config.train_mask_imgs_dir(), '*')))
 
         # Try to find corresponding masks.
+        masks_dir = config.train_mask_masks_dir()
+        masks_by_base = {}
+        for f in os.listdir(masks_dir) if os.path.isdir(masks_dir) else []:
+            base, _ = os.path.splitext(f)
+            masks_by_base.setdefault(base, []).append(os.path.join(masks_dir, f))
         mask_files = []
         for f in image_files:
             path, fname = os.path.split(f)
             base, ext = os.path.splitext(fname)
-            patt = os.path.join(config.train_mask_masks_dir(), base + '.*')
-            mask = glob.glob(patt)
+            mask = masks_by_base.get(base, [])
             if len(mask) != 1:
                 msg = "Could not find mask image corresponding to {}!"
                 msg += " Searched at: {}"
-                raise ValueError(msg.format(f, patt))
+                raise ValueError(msg.format(f, os.path.join(masks_dir, base + '.*')))
             mask_files += mask
 
         # Load in the masks and images.
-        self.images, self.masks = self.load(image_files, mask_files)
-        all_idx = list(range(self.images.shape[0]))
+        self.store = self.load(image_files, mask_files)
+        all_idx = list(range(len(self.store.frames('images'))))
         self.train_idx = all_idx[:-96]
         self.test_idx = all_idx[-96:]
 
     def load(self, image_files, mask_files):
+        """Returns frame store of resized images and masks.
+
+        The images and masks are resized to half size and stored as uint8
+        arrays named images and masks, with a frame per image. The store
+        is kept in the work directory and rebuilt only if the image or
+        mask files change. Batches read it lazily through memory maps.
+
+        # Arguments
+            image_files: List of paths to images.
+            mask_files: List of paths to corresponding masks.
+
+        # Returns
+            FrameStore containing images and masks.
+        """
+        store_dir = self.config.find_ruler_store_dir()
+        key = {'scale': 0.5, 'files': []}
+        for img_fn, mask_fn in zip(image_files, mask_files):
+            img_stat = os.stat(img_fn)
+            mask_stat = os.stat(mask_fn)
+            key['files'].append([img_fn, img_stat.st_size, img_stat.st_mtime_ns,
+                                 mask_fn, mask_stat.st_size, mask_stat.st_mtime_ns])
+        key_path = os.path.join(store_dir, 'key.json')
+        if os.path.exists(key_path):
+            with open(key_path, 'r') as key_file:
+                if json.load(key_file) == key:
+                    return FrameStore(store_dir)
+            os.remove(key_path)
+
         def load_image(img_fn):
-            img_data = scipy.misc.imread(img_fn)
-            img_data = scipy.misc.imresize(img_data, 0.5, interp='cubic')
+            img_data = cv2.imread(img_fn, cv2.IMREAD_COLOR)
+            img_data = cv2.resize(img_data, None, fx=0.5, fy=0.5,
+                                  interpolation=cv2.INTER_CUBIC)
             return img_data
 
         def load_mask(mask_fn):
-            mask_data = scipy.misc.imread(mask_fn, mode='L')
-            mask_data = scipy.misc.imresize(mask_data, 0.5, interp='bilinear', mode='L')
+            mask_data = cv2.imread(mask_fn, cv2.IMREAD_GRAYSCALE)
+            mask_data = cv2.resize(mask_data, None, fx=0.5, fy=0.5,
+                                   interpolation=cv2.INTER_LINEAR)
             return mask_data
 
-        pool = ThreadPool(processes=8)
-        images = pool.map(load_image, image_files)
-        images = np.array(images)
-        masks = pool.map(load_mask, mask_files)
-        masks = np.array(masks)
-        return images, masks
+        print("Building find ruler training store in {}...".format(store_dir))
+        store = FrameStore(store_dir)
+        with ThreadPool(processes=8) as pool:
+            for name, load_func, files in [('images', load_image, image_files),
+                                           ('masks', load_mask, mask_files)]:
+                with store.writer(name) as writer:
+                    for idx, data in enumerate(pool.imap(load_func, files)):
+                        writer.add(idx, data)
+        # Write the key last so that an interrupted build is redone.
+        with open(key_path, 'w') as key_file:
+            json.dump(key, key_file)
+        return store
 
     def prepare_x(self, cfg: SampleCfg):
-        img = preprocess_input(self.images[cfg.img_idx])
+        # Images are stored in BGR order, the model expects RGB.
+        img = preprocess_input(self.store.read('images', cfg.img_idx)[:, :, ::-1])
         return img
 
     def prepare_y(self, cfg: SampleCfg):
-        return np.expand_dims(self.masks[cfg.img_idx].astype(np.float32) / 256.0, axis=3)
+        mask = self.store.read('masks', cfg.img_idx)
+        return np.expand_dims(mask.astype(np.float32) / 256.0, axis=2)
+
+    def _make_batch(self, cfgs):
+        X_batch = np.array([self.prepare_x(cfg) for cfg in cfgs])
+        y_batch = np.array([self.prepare_y(cfg) for cfg in cfgs])
+        return X_batch, y_batch
+
+    def train_batch(self, batch_size, batch_idx):
+        """Makes a batch of randomly chosen training images.
+        """
+        return self._make_batch([SampleCfg(img_idx=random.choice(self.train_idx))
+                                 for _ in range(batch_size)])
+
+    def validation_batch(self, batch_size, batch_idx):
+        """Makes a validation batch, cycling through the validation images.
+        """
+        batches = list(chunks(self.test_idx, batch_size))
+        idxs = batches[batch_idx % len(batches)]
+        return self._make_batch([SampleCfg(idx) for idx in idxs])
 
     def generate(self, batch_size):
-        pool = ThreadPool(processes=8)
-        samples_to_process = []  # type: [SampleCfg]
-
-
-        while True:
-            img_idx = random.choice(self.train_idx)
-            cfg = SampleCfg(img_idx=img_idx)
-            samples_to_process.append(cfg)
-
-            if len(samples_to_process) == batch_size:
-                X_batch = np.array(pool.map(self.prepare_x, samples_to_process))
-                y_batch = np.array(pool.map(self.prepare_y, samples_to_process))
-                samples_to_process = []
-                yield X_batch, y_batch
+        return loader_for(self.config, partial(self.train_batch, batch_size))
 
     def generate_validation(self, batch_size):
-        pool = ThreadPool(processes=8)
-        while True:
-            for idxs in chunks(self.test_idx, batch_size):
-                samples_to_process = [SampleCfg(idx) for idx in idxs]
-                X_batch = np.array(pool.map(self.prepare_x, samples_to_process))
-                y_batch = np.array(pool.map(self.prepare_y, samples_to_process))
-                yield X_batch, y_batch
-
-
+        return loader_for(
+            self.config, partial(self.validation_batch, batch_size),
+            seed_offset=1)
@@ -20,6 +20,7 @@ import os
 import glob
 import configparser
 from datetime import datetime
+from multiprocessing import cpu_count
 
 class ConfigInterface:
     """Interface to config file.
@@ -47,6 +48,7 @@ class ConfigInterface:
                 msg.format(len(self._species), len(self._ratios))
                 raise ValueError(msg)
         self._num_classes = len(self._species) + 1
+        self._manifest = None
 
     def model_dir(self):
         """Gets model directory.
@@ -270,6 +272,43 @@ class ConfigInterface:
             steps_per_epoch = self.config.getint('Classify', 'StepsPerEpoch')
         return steps_per_epoch
 
+    def loader_num_workers(self):
+        """Returns number of worker processes making training batches if
+           the key exists, otherwise returns the number of cores up to 8.
+        """
+        num_workers = min(8, cpu_count())
+        if self.config.has_option('Loader', 'NumWorkers'):
+            num_workers = self.config.getint('Loader', 'NumWorkers')
+        return max(0, num_workers)
+
+    def loader_prefetch(self):
+        """Returns number of batches made ahead of training if the key
+           exists, otherwise returns twice the number of workers.
+        """
+        prefetch = 2 * max(1, self.loader_num_workers())
+        if self.config.has_option('Loader', 'Prefetch'):
+            prefetch = self.config.getint('Loader', 'Prefetch')
+        return max(1, prefetch)
+
+    def loader_seed(self):
+        """Returns seed for the random augmentation of training batches if
+           the key exists, otherwise returns default value of 0.
+        """
+        seed = 0
+        if self.config.has_option('Loader', 'Seed'):
+            seed = self.config.getint('Loader', 'Seed')
+        return seed
+
+    def classify_cache_mb(self):
+        """Returns total size in megabytes of the caches of decoded ROIs
+           used for classification training if the key exists, otherwise
+           returns default value of 1024.
+        """
+        cache_mb = 1024
+        if self.config.has_option('Classify', 'CacheMB'):
+            cache_mb = self.config.getfloat('Classify', 'CacheMB')
+        return max(0, cache_mb)
+
     def classify_do_validation(self):
         """Returns whether to do validation if the key exists, otherwise
            returns default value of True.
@@ -337,6 +376,21 @@ class ConfigInterface:
         """
         return self.count_num_steps() - self.count_num_steps_crop() * 2
 
+    def count_cache_data(self):
+        """Returns whether to cache the count model input data in the work
+           directory if the key exists, otherwise returns default value of
+           False.
+        """
+        cache_data = False
+        if self.config.has_option('Count', 'CacheData'):
+            cache_data = self.config.getboolean('Count', 'CacheData')
+        return cache_data
+
+    def count_data_cache_dir(self):
+        """Returns path to cached count model input data.
+        """
+        return os.path.join(self.work_dir(), 'count_data')
+
     def train_vids(self):
         """Returns list of paths to videos in training data.
         """
@@ -355,16 +409,24 @@ class ConfigInterface:
         patt = os.path.join(self.test_dir(), 'truth', '*.csv')
         return glob.glob(patt)
 
+    def test_num_workers(self):
+        """Returns number of worker processes used to evaluate test outputs
+        if the key exists, otherwise returns the number of cores up to 8.
+        """
+        num_workers = min(8, cpu_count())
+        if self.config.has_option('Test', 'NumWorkers'):
+            num_workers = self.config.getint('Test', 'NumWorkers')
+        return max(1, num_workers)
+
     def all_video_ids(self):
         """Gets all video IDs as a list.
         """
-        video_ids = []
+        video_ids = {}
         for vid in self.train_vids():
             _, f = os.path.split(vid)
             vid_id, _ = os.path.splitext(f)
-            if vid_id not in video_ids:
-                video_ids.append(vid_id)
-        return video_ids
+            video_ids[vid_id] = None
+        return list(video_ids)
 
     def length_path(self):
         """Returns path to length annotations.
@@ -405,11 +467,121 @@ class ConfigInterface:
         """
         return os.path.join(self.work_dir(), 'train_dets')
 
+    def train_img_ext(self):
+        """Returns file extension (and codec) of extracted training images
+        if the key exists, otherwise returns default value of jpg.
+        """
+        ext = 'jpg'
+        if self.config.has_option('Extract', 'ImageExt'):
+            ext = self.config.get('Extract', 'ImageExt').lower().lstrip('.')
+        return ext
+
+    def extract_quality(self):
+        """Returns codec quality used when writing extracted images if the
+        key exists, otherwise returns None to use the codec default.
+        """
+        quality = None
+        if self.config.has_option('Extract', 'Quality'):
+            quality = self.config.getint('Extract', 'Quality')
+        return quality
+
+    def extract_num_workers(self):
+        """Returns number of worker processes used to extract images if the
+        key exists, otherwise returns the number of cores.
+        """
+        num_workers = cpu_count()
+        if self.config.has_option('Extract', 'NumWorkers'):
+            num_workers = self.config.getint('Extract', 'NumWorkers')
+        return max(1, num_workers)
+
+    def extract_batch_size(self):
+        """Returns number of frames processed per task when extracting ROIs
+        if the key exists, otherwise returns default value of 32.
+        """
+        batch_size = 32
+        if self.config.has_option('Extract', 'BatchSize'):
+            batch_size = self.config.getint('Extract', 'BatchSize')
+        return max(1, batch_size)
+
+    def extract_frame_stride(self):
+        """Returns stride between extracted frames if the key exists,
+        otherwise returns default value of 1.
+        """
+        stride = 1
+        if self.config.has_option('Extract', 'FrameStride'):
+            stride = self.config.getint('Extract', 'FrameStride')
+        return max(1, stride)
+
+    def extract_annotated_only(self):
+        """Returns whether to only extract annotated frames if the key
+        exists, otherwise returns default value of False.
+        """
+        annotated_only = False
+        if self.config.has_option('Extract', 'AnnotatedOnly'):
+            annotated_only = self.config.getboolean('Extract', 'AnnotatedOnly')
+        return annotated_only
+
+    def use_frame_store(self):
+        """Returns whether extracted images and ROIs are kept in a frame
+        store instead of image files if the key exists, otherwise returns
+        default value of False.
+        """
+        use_store = False
+        if self.config.has_option('Extract', 'FrameStore'):
+            use_store = self.config.getboolean('Extract', 'FrameStore')
+        return use_store
+
+    def train_imgs_store_dir(self):
+        """Returns path to frame store of training images.
+        """
+        return os.path.join(self.work_dir(), 'train_imgs_store')
+
+    def train_rois_store_dir(self):
+        """Returns path to frame store of training roi images.
+        """
+        return os.path.join(self.work_dir(), 'train_rois_store')
+
+    def find_ruler_store_dir(self):
+        """Returns path to frame store of resized find ruler training
+        images and masks.
+        """
+        return os.path.join(self.work_dir(), 'find_ruler_store')
+
+    def train_img(self, video_id, frame):
+        """Returns path to a specific training image.
+        """
+        return os.path.join(
+            self.train_imgs_dir(),
+            video_id,
+            "{:04d}.{}".format(frame, self.train_img_ext())
+        )
+
+    def manifest_path(self):
+        """Returns path to the media manifest database.
+        """
+        return os.path.join(self.work_dir(), 'manifest.sqlite')
+
+    def media_manifest(self):
+        """Returns MediaManifest indexing the extracted media.
+        """
+        if self._manifest is None:
+            from openem_train.util.manifest import MediaManifest
+            self._manifest = MediaManifest(self.manifest_path())
+        return self._manifest
+
+    def _manifest_paths(self, kind, root_dir, exts):
+        """Returns indexed paths of one kind of media, refreshing the index
+        for any video directory that changed since it was last read.
+        """
+        manifest = self.media_manifest()
+        manifest.sync(kind, root_dir, exts)
+        return manifest.paths(kind)
+
     def train_imgs(self):
         """Returns list of all training images.
         """
-        patt = os.path.join(self.train_imgs_dir(), '**', '*.jpg')
-        return glob.glob(patt, recursive=True)
+        return self._manifest_paths(
+            'imgs', self.train_imgs_dir(), [self.train_img_ext()])
 
     def num_frames_path(self):
         """Returns path to csv containing number of frames per video.
@@ -422,22 +594,27 @@ class ConfigInterface:
         return os.path.join(
             self.train_rois_dir(),
             video_id,
-            "{:04d}.jpg".format(frame)
+            "{:04d}.{}".format(frame, self.train_img_ext())
         )
 
+    def train_roi_exts(self):
+        """Returns file extensions of training roi images, the extension
+        they are extracted with first, followed by jpg and png.
+        """
+        exts = [self.train_img_ext()]
+        exts += [ext for ext in ['jpg', 'png'] if ext not in exts]
+        return exts
+
     def train_rois(self):
         """Returns list of all training roi images.
         """
-        patt = os.path.join(self.train_rois_dir(), '**', '*.jpg')
-        patt2 = os.path.join(self.train_rois_dir(), '**', '*.png')
-        ## Bryan: extending array with empty array returns NONE
-        return glob.glob(patt, recursive=True)+(glob.glob(patt2, recursive=True))
+        return self._manifest_paths(
+            'rois', self.train_rois_dir(), self.train_roi_exts())
 
     def train_dets(self):
         """Returns list of all training detection images.
         """
-        patt = os.path.join(self.train_dets_dir(), '**', '*.jpg')
-        return glob.glob(patt, recursive=True)
+        return self._manifest_paths('dets', self.train_dets_dir(), ['jpg'])
 
     def checkpoints_dir(self, model):
         """Returns path to checkpoints directory.
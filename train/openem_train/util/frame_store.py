@@ -0,0 +1,220 @@
+__copyright__ = "Copyright (C) 2018 CVision AI."
+__license__ = "GPLv3"
+# This file is part of OpenEM, released under GPLv3.
+# OpenEM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OpenEM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Defines FrameStore class.
+
+A frame store keeps the frames of each video in a single uint8 array on
+disk, alongside a small index mapping frame numbers to rows. Reading a
+frame is a memory-mapped slice rather than a directory lookup plus an
+image decode. Frames are stored in BGR order, as returned by
+cv2.VideoCapture and cv2.imread.
+"""
+
+import os
+import json
+import threading
+import numpy as np
+
+class FrameStoreWriter:
+    """Appends frames of a single video to a frame store.
+
+    The video only becomes visible to readers once the writer is closed,
+    so an interrupted write never looks complete.
+    """
+    def __init__(self, data_path, index_path):
+        """Constructor.
+
+        # Arguments
+            data_path: Path to the frame data file.
+            index_path: Path to the frame index file.
+        """
+        self.data_path = data_path
+        self.index_path = index_path
+        self._data_tmp = data_path + '.tmp'
+        self._data_file = open(self._data_tmp, 'wb')
+        self._frames = []
+        self._shape = None
+
+    def add(self, frame, img):
+        """Adds a frame.
+
+        # Arguments
+            frame: Frame number.
+            img: Image data, every image of a video must have the same shape.
+        """
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        if self._shape is None:
+            self._shape = list(img.shape)
+        elif list(img.shape) != self._shape:
+            msg = "Frame {} has shape {}, expected {}!"
+            raise ValueError(msg.format(frame, img.shape, self._shape))
+        self._data_file.write(img.tobytes())
+        self._frames.append(int(frame))
+
+    def close(self):
+        """Finalizes the video in the store.
+        """
+        self._data_file.close()
+        os.replace(self._data_tmp, self.data_path)
+        index_tmp = self.index_path + '.tmp'
+        with open(index_tmp, 'w') as index_file:
+            json.dump({'shape': self._shape, 'frames': self._frames}, index_file)
+        os.replace(index_tmp, self.index_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._data_file.close()
+            os.remove(self._data_tmp)
+
+class FrameStore:
+    """Interface to a directory of per-video frame arrays.
+    """
+    def __init__(self, store_dir):
+        """Constructor.
+
+        # Arguments
+            store_dir: Directory containing the frame store.
+        """
+        self.store_dir = store_dir
+        self._videos = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Memory maps are reopened lazily in each process.
+        return {'store_dir': self.store_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['store_dir'])
+
+    def _data_path(self, video_id):
+        return os.path.join(self.store_dir, video_id + '.frames')
+
+    def _index_path(self, video_id):
+        return os.path.join(self.store_dir, video_id + '.json')
+
+    def writer(self, video_id):
+        """Returns a FrameStoreWriter for a video, replacing any existing
+        frames for it.
+
+        # Arguments
+            video_id: Video ID.
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        with self._lock:
+            self._videos.pop(video_id, None)
+        return FrameStoreWriter(self._data_path(video_id),
+                                self._index_path(video_id))
+
+    def video_ids(self):
+        """Returns list of video IDs in the store.
+        """
+        if not os.path.isdir(self.store_dir):
+            return []
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(self.store_dir)
+                      if f.endswith('.json'))
+
+    def _open(self, video_id):
+        """Returns memory map and frame lookup for a video.
+        """
+        video = self._videos.get(video_id)
+        if video is None:
+            with open(self._index_path(video_id), 'r') as index_file:
+                index = json.load(index_file)
+            frames = index['frames']
+            if frames:
+                data = np.memmap(self._data_path(video_id), dtype=np.uint8,
+                                 mode='r',
+                                 shape=tuple([len(frames)] + index['shape']))
+            else:
+                data = np.zeros((0,), dtype=np.uint8)
+            lookup = {frame: row for row, frame in enumerate(frames)}
+            video = (data, lookup)
+            with self._lock:
+                self._videos[video_id] = video
+        return video
+
+    def has_video(self, video_id):
+        """Returns whether a video is in the store.
+        """
+        return os.path.exists(self._index_path(video_id))
+
+    def frames(self, video_id):
+        """Returns sorted list of frame numbers stored for a video.
+        """
+        if not self.has_video(video_id):
+            return []
+        return sorted(self._open(video_id)[1].keys())
+
+    def shape(self, video_id):
+        """Returns shape of the frames of a video from its index, or None
+        if the video has no frames.
+        """
+        data, lookup = self._open(video_id)
+        if not lookup:
+            return None
+        return data.shape[1:]
+
+    def has(self, video_id, frame):
+        """Returns whether a frame is in the store.
+        """
+        if not self.has_video(video_id):
+            return False
+        return int(frame) in self._open(video_id)[1]
+
+    def read(self, video_id, frame):
+        """Reads a single frame.
+
+        # Arguments
+            video_id: Video ID.
+            frame: Frame number.
+
+        # Returns
+            Image as a read-only uint8 array in BGR order.
+
+        # Raises
+            KeyError: If the frame is not in the store.
+        """
+        data, lookup = self._open(video_id)
+        return data[lookup[int(frame)]]
+
+def iterate_frames(store_dir=None, paths=None):
+    """Iterates over images in a frame store or in image files.
+
+    # Arguments
+        store_dir: Directory containing a frame store, used if not None.
+        paths: List of image paths laid out as <video_id>/<frame>.<ext>,
+            used if store_dir is None.
+
+    # Yields
+        Tuple containing video ID, frame number and BGR image.
+    """
+    if store_dir is not None:
+        store = FrameStore(store_dir)
+        for video_id in store.video_ids():
+            for frame in store.frames(video_id):
+                yield video_id, frame, store.read(video_id, frame)
+        return
+    import cv2
+    for img_path in paths:
+        path, fname = os.path.split(img_path)
+        frame, _ = os.path.splitext(fname)
+        video_id = os.path.basename(os.path.normpath(path))
+        yield video_id, int(frame), cv2.imread(img_path)
@@ -0,0 +1,108 @@
+__copyright__ = "Copyright (C) 2018 CVision AI."
+__license__ = "GPLv3"
+# This file is part of OpenEM, released under GPLv3.
+# OpenEM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OpenEM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Defines ImageCache class."""
+
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+class ImageCache:
+    """Thread safe least recently used cache of decoded images, bounded by
+    the total size of the cached arrays.
+
+    Each forked process keeps its own images, while the hit and miss
+    counters are shared so they can be reported by the parent.
+    """
+    def __init__(self, max_mb):
+        """Constructor.
+
+        # Arguments
+            max_mb: Maximum size of cached images in megabytes. Caching is
+                disabled if zero.
+        """
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.num_bytes = 0
+        self._hits = multiprocessing.Value('q', 0)
+        self._misses = multiprocessing.Value('q', 0)
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """Returns a cached image, loading and caching it on a miss.
+
+        Cached images are marked read only as they are shared between
+        callers.
+
+        # Arguments
+            key: Hashable key of the image, e.g. (video_id, frame).
+            load: Function with no arguments that returns the image.
+
+        # Returns
+            Image as a numpy array.
+        """
+        with self._lock:
+            img = self._images.get(key)
+            if img is not None:
+                self._images.move_to_end(key)
+                self._count(self._hits)
+                return img
+        self._count(self._misses)
+
+        # Decode outside the lock so workers missing on different images
+        # are not serialized.
+        img = load()
+        if img.nbytes > self.max_bytes:
+            return img
+        img.flags.writeable = False
+        with self._lock:
+            if key not in self._images:
+                self._images[key] = img
+                self.num_bytes += img.nbytes
+            while self.num_bytes > self.max_bytes:
+                _, old = self._images.popitem(last=False)
+                self.num_bytes -= old.nbytes
+        return img
+
+    @staticmethod
+    def _count(counter):
+        with counter.get_lock():
+            counter.value += 1
+
+    @property
+    def hits(self):
+        """Number of lookups that found a cached image."""
+        return self._hits.value
+
+    @property
+    def misses(self):
+        """Number of lookups that loaded the image."""
+        return self._misses.value
+
+    def stats(self, reset=False):
+        """Returns string summarizing cache usage.
+
+        # Arguments
+            reset: Whether to reset the hit and miss counters.
+        """
+        with self._hits.get_lock(), self._misses.get_lock():
+            hits = self._hits.value
+            misses = self._misses.value
+            if reset:
+                self._hits.value = 0
+                self._misses.value = 0
+        return "{} hits, {} misses ({:.1%} hit rate)".format(
+            hits, misses, hits / max(hits + misses, 1))
@@ -0,0 +1,330 @@
+__copyright__ = "Copyright (C) 2018 CVision AI."
+__license__ = "GPLv3"
+# This file is part of OpenEM, released under GPLv3.
+# OpenEM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OpenEM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Defines BatchLoader class.
+
+A BatchLoader turns a function that makes batch number i into an
+iterator over batches that are made ahead of time by worker processes.
+Workers are forked, so the dataset holding the function is inherited
+rather than pickled, and write their batches into a ring of shared
+memory slots that the iterator copies out of. Forking a process that
+already runs a tensorflow session copies a process with live threads, so
+start the loaders before the model weights are loaded or trained. Before each batch the
+python and numpy random generators are seeded from the loader seed and
+the batch number, so the batches do not depend on which worker made
+them or on the number of workers.
+"""
+
+import queue
+import random
+import threading
+import weakref
+import multiprocessing
+import numpy as np
+
+# Offsets of arrays in a shared memory slot are aligned to this.
+_ALIGN = 64
+
+def _flatten(batch):
+    """Splits a batch into a structure spec and a list of arrays.
+
+    # Arguments
+        batch: Array, or tuple, list or dict nesting arrays.
+
+    # Returns
+        Tuple containing structure spec and list of arrays.
+    """
+    if isinstance(batch, dict):
+        keys = list(batch.keys())
+        specs, arrays = [], []
+        for key in keys:
+            spec, sub = _flatten(batch[key])
+            specs.append(spec)
+            arrays += sub
+        return ('dict', keys, specs), arrays
+    if isinstance(batch, (tuple, list)):
+        specs, arrays = [], []
+        for item in batch:
+            spec, sub = _flatten(item)
+            specs.append(spec)
+            arrays += sub
+        return (type(batch).__name__, None, specs), arrays
+    return ('array', None, None), [np.asarray(batch)]
+
+def _unflatten(spec, arrays):
+    """Inverse of _flatten, consumes arrays from the front of the list.
+    """
+    kind, keys, specs = spec
+    if kind == 'array':
+        return arrays.pop(0)
+    items = [_unflatten(sub, arrays) for sub in specs]
+    if kind == 'dict':
+        return dict(zip(keys, items))
+    if kind == 'tuple':
+        return tuple(items)
+    return items
+
+def _layout(arrays):
+    """Returns list of (offset, shape, dtype) and total size in bytes.
+    """
+    layout = []
+    offset = 0
+    for arr in arrays:
+        layout.append((offset, arr.shape, arr.dtype))
+        offset += -(-arr.nbytes // _ALIGN) * _ALIGN
+    return layout, max(offset, 1)
+
+def _fits(layout, arrays):
+    """Returns whether arrays match a slot layout.
+    """
+    return len(layout) == len(arrays) and all(
+        arr.shape == shape and arr.dtype == dtype
+        for (_, shape, dtype), arr in zip(layout, arrays))
+
+def _views(slot, layout):
+    """Returns arrays viewing a shared memory slot.
+    """
+    buf = memoryview(slot).cast('B')
+    return [np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+            for offset, shape, dtype in layout]
+
+def _seed(seed, batch_idx):
+    """Seeds python and numpy random generators for a batch.
+    """
+    batch_seed = (seed * 1000003 + batch_idx) % (2 ** 32)
+    random.seed(batch_seed)
+    np.random.seed(batch_seed)
+
+def _worker(make_batch, seed, slots, layout, tasks, free_slots, done):
+    """Worker process loop.
+
+    # Arguments
+        make_batch: Function returning batch for a batch index.
+        seed: Loader seed.
+        slots: List of shared RawArray slots inherited from the parent.
+        layout: Layout of arrays in a slot.
+        tasks: Queue of batch indices, None to exit.
+        free_slots: Queue of slot indices that may be written.
+        done: Queue receiving (batch index, slot index, payload).
+    """
+    while True:
+        batch_idx = tasks.get()
+        if batch_idx is None:
+            break
+        try:
+            _seed(seed, batch_idx)
+            _, arrays = _flatten(make_batch(batch_idx))
+        except Exception as exc: # pylint: disable=broad-except
+            done.put((batch_idx, None, exc))
+            continue
+        if not _fits(layout, arrays):
+            # Batches of another shape, e.g. a short final batch, are
+            # sent through the queue instead.
+            done.put((batch_idx, None, arrays))
+            continue
+        slot = free_slots.get()
+        for view, arr in zip(_views(slots[slot], layout), arrays):
+            view[...] = arr
+        done.put((batch_idx, slot, None))
+
+def _shutdown(workers, tasks):
+    """Stops workers.
+    """
+    for _ in workers:
+        tasks.put(None)
+    for proc in workers:
+        proc.join(timeout=5)
+        if proc.is_alive():
+            proc.terminate()
+
+class BatchLoader:
+    """Iterator over batches made ahead of time by worker processes.
+    """
+    def __init__(self, make_batch, num_workers=8, prefetch=16, seed=0):
+        """Constructor.
+
+        # Arguments
+            make_batch: Function returning batch number i. A batch is an
+                array or a tuple, list or dict nesting arrays. Every batch
+                should have the same shapes, others are sent through a
+                slower queue.
+            num_workers: Number of worker processes. Batches are made in
+                the calling process if zero.
+            prefetch: Maximum number of batches made ahead of the one
+                being consumed, also the number of shared memory slots.
+            seed: Seed for batch random number generators.
+        """
+        self.make_batch = make_batch
+        self.num_workers = num_workers
+        self.prefetch = max(1, prefetch)
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._next_idx = 0
+        self._spec = None
+        self._first = None
+        self._started = False
+        self._ready = {}
+
+    def _call(self, batch_idx):
+        """Makes a batch in this process without disturbing its random
+        state.
+        """
+        py_state = random.getstate()
+        np_state = np.random.get_state()
+        try:
+            _seed(self.seed, batch_idx)
+            return self.make_batch(batch_idx)
+        finally:
+            random.setstate(py_state)
+            np.random.set_state(np_state)
+
+    def _prepare(self):
+        """Makes the first batch, which determines the slot layout.
+        """
+        if self._spec is None:
+            self._spec, self._first = _flatten(self._call(0))
+            self._leaf_specs = [(arr.shape, arr.dtype) for arr in self._first]
+
+    def _start(self):
+        """Allocates slots and starts worker processes.
+        """
+        self._prepare()
+        self._started = True
+        if self.num_workers <= 0:
+            return
+        self._layout, nbytes = _layout(self._first)
+        ctx = multiprocessing.get_context('fork')
+        self._slots = [ctx.RawArray('B', nbytes)
+                       for _ in range(self.prefetch)]
+        self._tasks = ctx.Queue()
+        self._free_slots = ctx.Queue()
+        self._done = ctx.Queue()
+        for slot in range(self.prefetch):
+            self._free_slots.put(slot)
+        self._workers = [
+            ctx.Process(
+                target=_worker,
+                args=(self.make_batch, self.seed, self._slots, self._layout,
+                      self._tasks, self._free_slots, self._done),
+                daemon=True)
+            for _ in range(self.num_workers)]
+        for proc in self._workers:
+            proc.start()
+        self._finalizer = weakref.finalize(
+            self, _shutdown, self._workers, self._tasks)
+        # Batch zero was already made to find the layout.
+        for batch_idx in range(1, self.prefetch + 1):
+            self._tasks.put(batch_idx)
+
+    def _receive(self):
+        """Waits for a batch from the workers and stores it by index.
+        """
+        while True:
+            try:
+                batch_idx, slot, payload = self._done.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not all(proc.is_alive() for proc in self._workers):
+                    raise RuntimeError("A batch loader worker died!")
+        if isinstance(payload, Exception):
+            raise payload
+        if slot is not None:
+            payload = [np.array(view) for view in
+                       _views(self._slots[slot], self._layout)]
+            self._free_slots.put(slot)
+        self._ready[batch_idx] = payload
+
+    def start(self):
+        """Forks the worker processes now rather than on the first batch.
+
+        Call before a tensorflow session is created, e.g. before loading
+        weights or fitting a model.
+        """
+        with self._lock:
+            if not self._started:
+                self._start()
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            if not self._started:
+                self._start()
+            batch_idx = self._next_idx
+            self._next_idx += 1
+            if batch_idx == 0:
+                arrays = self._first
+                self._first = None
+            elif self.num_workers <= 0:
+                _, arrays = _flatten(self._call(batch_idx))
+            else:
+                while batch_idx not in self._ready:
+                    self._receive()
+                arrays = self._ready.pop(batch_idx)
+                self._tasks.put(batch_idx + self.prefetch)
+            return _unflatten(self._spec, list(arrays))
+
+    def close(self):
+        """Stops worker processes.
+        """
+        with self._lock:
+            if self._started and self.num_workers > 0:
+                self._finalizer()
+
+    def as_tf_dataset(self):
+        """Returns a tf.data.Dataset yielding the batches of this loader,
+        for example to feed Model.fit.
+        """
+        import tensorflow as tf
+        with self._lock:
+            self._prepare()
+            spec = self._spec
+            dtypes = list(self._leaf_specs)
+
+        def _signature(sub, leaves):
+            kind, keys, specs = sub
+            if kind == 'array':
+                shape, dtype = leaves.pop(0)
+                # Leave the batch dimension open for short batches.
+                shape = (None,) + shape[1:] if shape else ()
+                return tf.as_dtype(dtype), tf.TensorShape(shape)
+            items = [_signature(s, leaves) for s in specs]
+            types = [item[0] for item in items]
+            shapes = [item[1] for item in items]
+            if kind == 'dict':
+                return dict(zip(keys, types)), dict(zip(keys, shapes))
+            return tuple(types), tuple(shapes)
+
+        output_types, output_shapes = _signature(spec, dtypes)
+        return tf.data.Dataset.from_generator(
+            lambda: self, output_types, output_shapes)
+
+def loader_for(config, make_batch, seed_offset=0):
+    """Returns a BatchLoader configured by the Loader section of a config.
+
+    # Arguments
+        config: ConfigInterface object.
+        make_batch: Function returning batch number i.
+        seed_offset: Added to the configured seed, so that different
+            streams of the same dataset differ.
+    """
+    return BatchLoader(
+        make_batch,
+        num_workers=config.loader_num_workers(),
+        prefetch=config.loader_prefetch(),
+        seed=config.loader_seed() + seed_offset)
@@ -0,0 +1,210 @@
+__copyright__ = "Copyright (C) 2018 CVision AI."
+__license__ = "GPLv3"
+# This file is part of OpenEM, released under GPLv3.
+# OpenEM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OpenEM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Defines MediaManifest class.
+
+The manifest is a SQLite index of the extracted media in the work
+directory, laid out as <root>/<video_id>/<frame>*.<ext>. Each kind of
+media (imgs, rois, dets) is indexed per video directory together with
+the directory mtime. Queries only rescan video directories whose mtime
+changed, so listing millions of files is done once rather than by every
+task. Overwriting files in place leaves the directory mtime unchanged, so
+extraction reindexes every video it writes with update_video.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+_FRAME_RE = re.compile(r'(\d+)')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    kind TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    frame INTEGER,
+    path TEXT NOT NULL,
+    size INTEGER,
+    width INTEGER,
+    height INTEGER,
+    PRIMARY KEY (kind, path)
+);
+CREATE INDEX IF NOT EXISTS media_frame ON media (kind, video_id, frame);
+CREATE TABLE IF NOT EXISTS dirs (
+    kind TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (kind, video_id)
+);
+"""
+
+def _parse_frame(fname):
+    """Returns frame number at the start of a file name, or None.
+    """
+    match = _FRAME_RE.match(fname)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+class MediaManifest:
+    """Persisted index of extracted media.
+    """
+    def __init__(self, db_path):
+        """Constructor.
+
+        # Arguments
+            db_path: Path to the SQLite database, created if missing.
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        """Yields a connection, committing on success and always closing.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _scan_video(self, conn, kind, root_dir, video_id, exts, mtime_ns,
+                    keep_dims=True):
+        """Reindexes a single video directory.
+
+        If keep_dims is true, dimensions recorded for files that are still
+        present with the same size are kept.
+        """
+        video_dir = os.path.join(root_dir, video_id)
+        dims = {}
+        if keep_dims:
+            dims = {
+                (path, size): (width, height)
+                for path, size, width, height in conn.execute(
+                    "SELECT path, size, width, height FROM media "
+                    "WHERE kind=? AND video_id=?", (kind, video_id))
+            }
+        rows = []
+        with os.scandir(video_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                _, ext = os.path.splitext(entry.name)
+                if ext.lower().lstrip('.') not in exts:
+                    continue
+                size = entry.stat().st_size
+                width, height = dims.get((entry.path, size), (None, None))
+                rows.append((kind, video_id, _parse_frame(entry.name),
+                             entry.path, size, width, height))
+        conn.execute("DELETE FROM media WHERE kind=? AND video_id=?",
+                     (kind, video_id))
+        conn.executemany("INSERT INTO media VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                     (kind, video_id, mtime_ns))
+
+    def sync(self, kind, root_dir, exts):
+        """Brings the index of one kind of media up to date.
+
+        # Arguments
+            kind: Name of the media kind, e.g. imgs, rois or dets.
+            root_dir: Directory containing one subdirectory per video.
+            exts: Image file extensions to index.
+        """
+        exts = {e.lower().lstrip('.') for e in exts}
+        current = {}
+        if os.path.isdir(root_dir):
+            with os.scandir(root_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        current[entry.name] = entry.stat().st_mtime_ns
+        with self._lock, self._connect() as conn:
+            recorded = dict(conn.execute(
+                "SELECT video_id, mtime_ns FROM dirs WHERE kind=?", (kind,)))
+            for video_id in recorded.keys() - current.keys():
+                conn.execute("DELETE FROM media WHERE kind=? AND video_id=?",
+                             (kind, video_id))
+                conn.execute("DELETE FROM dirs WHERE kind=? AND video_id=?",
+                             (kind, video_id))
+            for video_id, mtime_ns in current.items():
+                if recorded.get(video_id) != mtime_ns:
+                    self._scan_video(conn, kind, root_dir, video_id, exts,
+                                     mtime_ns)
+
+    def update_video(self, kind, root_dir, video_id, exts, dims=None):
+        """Reindexes a video directory after it has been written.
+
+        Files may have been overwritten in place, which leaves the directory
+        mtime unchanged, so dimensions recorded before are dropped.
+
+        # Arguments
+            kind: Name of the media kind.
+            root_dir: Directory containing one subdirectory per video.
+            video_id: Video ID.
+            exts: Image file extensions to index.
+            dims: Optional (width, height) of every image of the video.
+        """
+        exts = {e.lower().lstrip('.') for e in exts}
+        video_dir = os.path.join(root_dir, video_id)
+        with self._lock, self._connect() as conn:
+            self._scan_video(conn, kind, root_dir, video_id, exts,
+                             os.stat(video_dir).st_mtime_ns, keep_dims=False)
+            if dims is not None:
+                conn.execute(
+                    "UPDATE media SET width=?, height=? "
+                    "WHERE kind=? AND video_id=?",
+                    (int(dims[0]), int(dims[1]), kind, video_id))
+
+    def paths(self, kind):
+        """Returns list of indexed paths ordered by video and frame.
+        """
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT path FROM media WHERE kind=? "
+                "ORDER BY video_id, frame, path", (kind,))]
+
+    def entries(self, kind):
+        """Returns list of (video_id, frame, path, width, height) tuples
+        ordered by video and frame. Width and height are None if unknown.
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT video_id, frame, path, width, height FROM media "
+                "WHERE kind=? ORDER BY video_id, frame, path",
+                (kind,)).fetchall()
+
+    def video_ids(self, kind):
+        """Returns sorted list of video IDs with indexed media.
+        """
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT DISTINCT video_id FROM media WHERE kind=? "
+                "ORDER BY video_id", (kind,))]
+
+    def dims(self, kind, video_id, frame):
+        """Returns recorded (width, height) of an image, or None if unknown.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT width, height FROM media WHERE kind=? AND video_id=? "
+                "AND frame=? AND width IS NOT NULL LIMIT 1",
+                (kind, video_id, int(frame))).fetchone()
+        return row
@@ -66,3 +66,25 @@ class RoiTransform:
 
         return tform
 
+    def maps_for_clip(self, video_id, dst_w=720, dst_h=360):
+        """Finds lookup tables that apply the transform to crop around the
+        ruler with cv2.remap.
+
+        The tables only depend on the ruler points and output size, so they
+        are computed once and reused for every frame of a video.
+
+        # Arguments
+            video_id: Video ID.
+            dst_w: Width of cropped image.
+            dst_h: Height of cropped image.
+
+        # Returns
+            Tuple of fixed point maps for cv2.remap, or None if there are no
+            ruler points for the video.
+        """
+        from openem.image import affine_remap_maps
+        tform = self.transform_for_clip(video_id, dst_w, dst_h)
+        if tform is None:
+            return None
+        # The transform maps crop coordinates to image coordinates.
+        return affine_remap_maps(tform.params[:2], (dst_h, dst_w))
@@ -20,52 +20,96 @@ import os
 import glob
 import math
 import numpy as np
-import skimage
+import cv2
+from PIL import Image
 from skimage.transform import AffineTransform
 import math
 
+def batch_find_corners(coords):
+    """Finds the corners closest to the top left and bottom right of the
+    bounding rect of each of a batch of boxes.
+
+    # Arguments
+        coords: Array of shape (N, 4, 2) containing box corners.
+
+    # Returns
+        Tuple of arrays of shape (N,) containing index of the top left
+        and bottom right corner of each box.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    minimum = coords.min(axis=1, keepdims=True)
+    maximum = coords.max(axis=1, keepdims=True)
+    min_dist = np.hypot(coords[..., 1] - minimum[..., 1],
+                        coords[..., 0] - minimum[..., 0])
+    max_dist = np.hypot(coords[..., 1] - maximum[..., 1],
+                        coords[..., 0] - maximum[..., 0])
+    return np.argmin(min_dist, axis=1), np.argmin(max_dist, axis=1)
+
 def find_corners(coords):
     """ Find the left and right corner of the given box
     :param coords: 4-element array-type
     :returns idx of Left Corner
     """
-    minimum=np.min(coords, axis=0)
-    maximum=np.max(coords, axis=0)
-    minDistances=np.zeros(4)
-    maxDistances=np.zeros(4)
-    for idx,coord in enumerate(coords):
-        minDistances[idx] = math.hypot(coord[1]-minimum[1],coord[0]-minimum[0])
-        maxDistances[idx] = math.hypot(coord[1]-maximum[1],coord[0]-maximum[0])
-    minIdx=np.argmin(minDistances)
-    maxIdx=np.argmin(maxDistances)
-    return (minIdx,maxIdx)
+    min_idx, max_idx = batch_find_corners(np.asarray(coords)[np.newaxis])
+    return (min_idx[0], max_idx[0])
+
+def batch_rotate_detections(boxes):
+    """Rotates a batch of boxes around their first point.
+
+    # Arguments
+        boxes: Array of shape (N, 5) containing x, y, width, height and
+            theta of each box, theta in radians.
+
+    # Returns
+        Array of shape (N, 4, 2) containing the corners of each box in
+        NE,SE,SW,NW ordering.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 5)
+    x, y, width, height, theta = boxes.T
+    zero = np.zeros_like(width)
+    # Corner offsets from the first point before rotation.
+    offset_x = np.stack([zero, zero, width, width], axis=1)
+    offset_y = np.stack([zero, height, height, zero], axis=1)
+    cos = np.cos(theta)[:, np.newaxis]
+    sin = np.sin(theta)[:, np.newaxis]
+    return np.stack([
+        x[:, np.newaxis] + cos * offset_x - sin * offset_y,
+        y[:, np.newaxis] + sin * offset_x + cos * offset_y], axis=2)
 
 def rotate_detection(detection):
     """ Given a box detection, rotate it around point 0 by theta
         Points are in NE,SE,SW,NW ordering
     """
-    Rot=np.array([[math.cos(detection.theta), -1.0*math.sin(detection.theta), 0],
-                  [math.sin(detection.theta), math.cos(detection.theta), 0],
-                  [0,0,1]])
-    Translation=np.array([[1,0,detection.x],
-                          [0,1,detection.y],
-                          [0,0,1]])
-    InverseTranslation=np.array([[1,0,-detection.x],
-                                 [0,1,-detection.y],
-                                 [0,0,1]])
-    #Shift it, rotate it, shift it back
-    RotTranslation=Translation.dot(Rot.dot(InverseTranslation));
-
-    NorthEast=np.array([detection.x,detection.y])
-    SouthEast=RotTranslation.dot(np.array([detection.x,detection.y+detection.height,1]))
-    NorthWest=RotTranslation.dot(np.array([detection.x+detection.width,detection.y,1]))
-    SouthWest=RotTranslation.dot(np.array([detection.x+detection.width,detection.y+detection.height,1]))
-
-    SouthEast=SouthEast[:2]
-    NorthWest=NorthWest[:2]
-    SouthWest=SouthWest[:2]
-    box=np.array([NorthEast,SouthEast,SouthWest,NorthWest])
-    return box
+    return batch_rotate_detections([[detection.x,
+                                     detection.y,
+                                     detection.width,
+                                     detection.height,
+                                     detection.theta]])[0]
+
+def batch_bbox_for_line(pt0, pt1, aspect_ratio=0.5):
+    """Calculates bounding rects around a batch of boxes with lines in the
+    center.
+
+    # Arguments
+        pt0: Array of shape (N, 2) containing first points.
+        pt1: Array of shape (N, 2) containing second points.
+        aspect_ratio: Rect aspect ratio, scalar or array of shape (N,).
+
+    # Returns
+        Array of shape (N, 2, 2) containing the top left and bottom right
+        corner of each bounding box.
+    """
+    pt0 = np.asarray(pt0, dtype=np.float64)
+    pt1 = np.asarray(pt1, dtype=np.float64)
+    diff = pt1 - pt0
+    # vector perpendicular to p0-p1 with 0.5 aspect ratio norm
+    scale = np.asarray(aspect_ratio, dtype=np.float64) * 0.5
+    perp = np.stack([diff[:, 1], -diff[:, 0]], axis=1) * np.reshape(scale, (-1, 1))
+
+    points = np.stack([pt0 + perp, pt0 - perp, pt1 + perp, pt1 - perp], axis=1)
+    min_idx, max_idx = batch_find_corners(points)
+    rows = np.arange(len(points))
+    return np.stack([points[rows, min_idx], points[rows, max_idx]], axis=1)
 
 def bbox_for_line(pt0, pt1, aspect_ratio=0.5):
     """Calculate bounding rect around box with line in the center
@@ -78,13 +122,10 @@ def bbox_for_line(pt0, pt1, aspect_ratio=0.5):
     # Returns
         Bounding box.
     """
-    diff = pt1 - pt0
-    # vector perpendicular to p0-p1 with 0.5 aspect ratio norm
-    perp = np.array([diff[1], -diff[0]]) * aspect_ratio * 0.5
-
-    points = np.row_stack([pt0 + perp, pt0 - perp, pt1 + perp, pt1 - perp])
-    cornerIdx=find_corners(points)
-    return points[cornerIdx[0]], points[cornerIdx[1]]
+    corners = batch_bbox_for_line(np.asarray(pt0)[np.newaxis],
+                                  np.asarray(pt1)[np.newaxis],
+                                  aspect_ratio)
+    return corners[0, 0], corners[0, 1]
 
 def lock_layers_until(model, first_trainable_layer, verbose=False):
     """Locks layers until a given layer name.
@@ -105,6 +146,44 @@ def lock_layers_until(model, first_trainable_layer, verbose=False):
 
         layer.trainable = found_first_layer
 
+_CV2_INTERPOLATION = {
+    0: cv2.INTER_NEAREST,
+    1: cv2.INTER_LINEAR,
+    3: cv2.INTER_CUBIC,
+}
+
+def warp_affine(image, tform, output_shape, order=3):
+    """Warps an image with OpenCV, as a drop in for skimage.transform.warp
+    with mode='edge'.
+
+    cv2.warpAffine releases the GIL, so warps done by a thread pool run in
+    parallel. As with skimage, uint8 images are returned as floats in the
+    range [0, 1]; they are warped as uint8 and converted afterwards.
+
+    # Arguments
+        image: Image as uint8 or float array.
+        tform: skimage transform mapping output to input coordinates.
+        output_shape: Tuple containing (height, width) of output.
+        order: Interpolation order, one of 0, 1 or 3.
+
+    # Returns
+        Warped image as float32 array.
+    """
+    if image.dtype != np.uint8:
+        image = image.astype(np.float32, copy=False)
+    warped = cv2.warpAffine(
+        image,
+        tform.params[:2],
+        (int(output_shape[1]), int(output_shape[0])),
+        flags=_CV2_INTERPOLATION[order] | cv2.WARP_INVERSE_MAP,
+        borderMode=cv2.BORDER_REPLICATE)
+    if warped.ndim < image.ndim:
+        # cv2 drops a trailing single channel.
+        warped = warped[..., np.newaxis]
+    if image.dtype == np.uint8:
+        return warped.astype(np.float32) / 255.0
+    return warped
+
 def get_image_crop(full_rgb, rect, scale_rect_x=1.0, scale_rect_y=1.0,
                    shift_x_ratio=0.0, shift_y_ratio=0.0,
                    angle=0.0, out_size=299, order=3):
@@ -142,12 +221,11 @@ def get_image_crop(full_rgb, rect, scale_rect_x=1.0, scale_rect_y=1.0,
     tform = AffineTransform(rotation=angle * math.pi / 180) + tform
     tform = AffineTransform(scale=(1 / scale_x, 1 / scale_y)) + tform
     tform = AffineTransform(translation=(-out_center, -out_center)) + tform
-    return skimage.transform.warp(
+    return warp_affine(
         full_rgb,
         tform,
-        mode='edge',
-        order=order,
-        output_shape=(out_size, out_size)
+        output_shape=(out_size, out_size),
+        order=order
     )
 
 def chunks(l, n):
@@ -156,30 +234,62 @@ def chunks(l, n):
         if l[i:i + n]:
             yield l[i:i + n]
 
+def image_size(path):
+    """Reads the size of an image from its header without decoding it.
+
+    # Arguments
+        path: Path to the image.
+
+    # Returns
+        Tuple containing width and height.
+
+    # Raises
+        IOError: If the image cannot be read.
+    """
+    with Image.open(path) as img:
+        return img.size
+
+def best_detection_index(dets, min_conf=0.075):
+    """Finds the best detection for every video ID and frame.
+
+    # Arguments:
+        dets: DataFrame containing detection data.
+        min_conf: Detections whose confidence is below this are dropped
+            after picking the best one.
+
+    # Returns:
+        DataFrame with one row per video ID and frame, indexed by
+        (video_id, frame).
+    """
+    dets = dets.reset_index(drop=True)
+    best = dets.loc[dets.groupby(['video_id', 'frame'])['det_conf'].idxmax()]
+    best = best[best['det_conf'] >= min_conf]
+    best.index = [best['video_id'], best['frame']]
+    best.index.names = ['video_id', 'frame']
+    return best.sort_index()
+
 def get_best_detection(video_id, frame, dets):
     """Gets the best detection for a given video ID and frame.
 
     # Arguments:
         video_id: Video ID.
         frame: Frame number.
-        dets: DataFrame containing detection data.
+        dets: Index of the best detections returned by
+            best_detection_index.
 
     # Returns:
         None if no detection found, best row otherwise.
-    """
-    same_vid = dets['video_id'] == video_id
-    same_frame = dets['frame'] == frame
-    matches = dets[same_vid & same_frame]
-
-    if matches.shape[0] == 0:
-        return None
 
-    best = matches.sort_values('det_conf', ascending=False).iloc[0]
-    if best.det_conf < 0.075:
+    # Raises:
+        ValueError: If dets is not indexed by video ID and frame.
+    """
+    if list(dets.index.names) != ['video_id', 'frame']:
+        raise ValueError("Detections must be indexed with best_detection_index!")
+    try:
+        return dets.loc[(video_id, frame)]
+    except KeyError:
         return None
 
-    return best
-
 def find_epoch(checkpoints_dir, epoch):
     """Finds checkpoint associated with the given epoch.
 